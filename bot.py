@@ -5,15 +5,29 @@ import aiohttp
 import httpx
 from openai import AsyncOpenAI
 from dotenv import load_dotenv
-from PIL import Image
-import io
-import base64
 import random
 import json
 import re
 import time
 import asyncio
-from duckduckgo_search import DDGS
+import hashlib
+from kb_context import ContextBuilder, estimate_tokens
+from kb_index import KnowledgeIndex
+from channel_history import ChannelHistory
+from command_router import CommandRouter
+from image_cache import ImageResultCache
+from image_preprocess import prepare_image
+from json_stream import JSONFieldStream
+from kb_snapshot import compile_snapshot, find_kb_source, load_snapshot
+from message_updater import MessageUpdater
+from model_scheduler import PRIORITY_BACKGROUND, PRIORITY_CHAT, PRIORITY_IMAGE, ModelQueueFull, ModelScheduler
+from prompt_templates import PromptRegistry
+from resilient_client import Endpoint, ResilientClient, parse_endpoints
+from session_store import STATE_CATEGORY_CHOICE, STATE_CHATTING, create_session_store
+from single_flight import SingleFlight
+from task_manager import TaskManager
+from usage_meter import USAGE_SNAPSHOT_INTERVAL, QuotaExceeded, UsageMeter, estimate_message_tokens
+from web_search import WebSearch
 
 # 加载环境变量
 load_dotenv()
@@ -53,6 +67,8 @@ CHAT_HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", "8")) # 读取最近8
 CHAT_SESSION_TIMEOUT = 180 # 持续对话超时时间（秒）
 EXIT_KEYWORDS = {"再见", "拜拜", "谢谢", "谢谢你", "不用了", "没事了", "ok", "好的"} # 结束对话的关键词
 NSFW_TEXT_KEYWORDS = {"nsfw", "裸", "胸", "屁股", "淫", "骚", "色", "逼", "屌", "操"} # NSFW 文本关键词
+NSFW_SPECULATIVE = os.getenv("NSFW_SPECULATIVE", "true").lower() == "true" # NSFW 预检与 SFW 分析同时发起，NSFW 时取消 SFW 请求
+NSFW_CHECK_PROMPT = "这张图片是否包含裸露、性暗示或成人内容？请只回答'是'或'否'。"
 
 # --- 代理配置 ---
 PROXY_URL = os.getenv("HTTP_PROXY") or os.getenv("HTTPS_PROXY")
@@ -65,6 +81,71 @@ client_openai = AsyncOpenAI(
     http_client=http_client,
 )
 
+# 备用接口：多个用分号分隔，每个写作 “地址|密钥|模型”，密钥和模型可省略 (见 resilient_client.parse_endpoints)
+MODEL_FALLBACK_ENDPOINTS = os.getenv("OPENAI_FALLBACK_ENDPOINTS", "")
+MODEL_ENDPOINTS = [Endpoint(API_BASE, client_openai, MODEL_NAME)] + [
+    Endpoint(base_url, AsyncOpenAI(base_url=base_url, api_key=key, http_client=http_client), model)
+    for base_url, key, model in parse_endpoints(MODEL_FALLBACK_ENDPOINTS, API_KEY, MODEL_NAME)
+]
+# 所有模型请求都经过这里：失败重试、按接口熔断、切换备用接口、可选对冲请求 (见 resilient_client.py)
+MODEL_CLIENT = ResilientClient(MODEL_ENDPOINTS)
+
+# 所有模型请求都经过调度器：限制并发、按优先级排队 (见 model_scheduler.py)
+MODEL_SCHEDULER = ModelScheduler()
+# 按用户和服务器统计模型调用和 token，超出额度时拒绝新请求 (见 usage_meter.py)
+USAGE_METER = UsageMeter()
+usage_snapshot_task = None
+# 各功能一次最多发出的模型请求数，用于额度预检
+COMMAND_CALLS = {'reverse': 2, 'comment': 4, 'draw': 1, 'chat': 1}
+
+async def create_completion(priority, **kwargs):
+    """经过调度器的模型请求；排队已满时抛出 ModelQueueFull。调用次数和 token 记在当前请求者名下"""
+    async with MODEL_SCHEDULER.slot(priority):
+        response = await MODEL_CLIENT.create(**kwargs)
+    usage = getattr(response, 'usage', None)
+    tokens = getattr(usage, 'total_tokens', None) if usage else None
+    if tokens is None:
+        tokens = estimate_message_tokens(kwargs.get('messages', [])) + estimate_tokens(response.choices[0].message.content or "")
+    USAGE_METER.record(tokens=tokens)
+    return response
+
+async def stream_completion(priority, on_delta, **kwargs):
+    """流式模型请求：每收到一段文字调用 on_delta(文字)，返回完整的回复文字。整个流读完前一直占用调度器名额"""
+    parts = []
+    async with MODEL_SCHEDULER.slot(priority):
+        stream = await MODEL_CLIENT.create_stream(**kwargs)
+        async for chunk in stream:
+            text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                parts.append(text)
+                await on_delta(text)
+    full_text = "".join(parts)
+    # 流式接口不返回 usage，按文字长度估算
+    USAGE_METER.record(tokens=estimate_message_tokens(kwargs.get('messages', [])) + estimate_tokens(full_text))
+    return full_text
+
+async def check_quota(message, kind, flight_key=None):
+    """
+    额度预检并预留这次请求最多需要的调用次数：超出时礼貌拒绝并返回 None，否则返回预留，交给 start_job 结算。
+    正在进行的相同图片请求会被合并，不额外预留额度
+    """
+    calls = 0 if flight_key is not None and IMAGE_FLIGHTS.in_flight((kind, flight_key)) else COMMAND_CALLS[kind]
+    try:
+        return USAGE_METER.reserve(message.author.id, message.guild.id if message.guild else None, calls)
+    except QuotaExceeded as e:
+        print(f"🚦 {message.author} 超出{'个人' if e.scope == 'user' else '服务器'}额度，拒绝 {kind} 请求")
+        await message.reply(str(e))
+        return None
+
+async def save_usage_snapshots():
+    """定期把用量计数写入磁盘"""
+    while True:
+        await asyncio.sleep(USAGE_SNAPSHOT_INTERVAL)
+        try:
+            USAGE_METER.save()
+        except Exception as e:
+            print(f"⚠️ 保存用量快照失败: {e}")
+
 # --- Discord 机器人配置 ---
 intents = discord.Intents.default()
 intents.message_content = True
@@ -74,97 +155,169 @@ client_discord = discord.Client(intents=intents, proxy=PROXY_URL)
 # --- 知识库配置 ---
 KNOWLEDGE_BASE = None
 KNOWLEDGE_BASE_TERMS = {}  # 用于快速查找的词条索引
-user_states = {} # 用于跟踪用户对话状态, e.g. {12345: {'state': 'chatting', 'timestamp': 1678886400, 'replies': 0}}
+KNOWLEDGE_BASE_INDEX = None  # 预构建的多模式匹配索引 (见 kb_index.py)
+KNOWLEDGE_BASE_CONTEXT = None  # 与当前知识库同代的提示词上下文构建器 (见 kb_context.py)
+KB_CONTEXT_TOKEN_BUDGET = int(os.getenv("KB_CONTEXT_TOKEN_BUDGET", "300")) # 注入提示词的知识库上下文 token 上限
+KB_RELOAD_INTERVAL = float(os.getenv("KB_RELOAD_INTERVAL", "10")) # 知识库热重载检查间隔（秒），0 表示关闭
+KB_WATCH_FILES = ('classified_lexicon.json', 'merged_knowledge_base.json', 'knowledge_base.json', '词库.json')
+kb_watch_task = None
+CHANNEL_HISTORY = ChannelHistory(CHAT_HISTORY_LIMIT) # 各频道最近的消息，由网关事件维护，避免每次对话都走 REST (见 channel_history.py)
+SESSIONS = create_session_store() # 用户对话状态：按 TTL 过期、总数有上限，可选持久化 (见 session_store.py)
+CATEGORY_CHOICE_TIMEOUT = 300 # 查标签后等待选择目录的超时（秒）
+session_sweep_task = None
+
+# --- 提示词模板 ---
+PROMPTS = PromptRegistry() # 绘图引导只在文件修改后才重新读取 (见 prompt_templates.py)
+
+# --- 消息更新 ---
+EDITS = MessageUpdater() # 所有流式回复和进度提示的消息编辑都经过这里，按频道限速并合并 (见 message_updater.py)
+# 图片评论报告中流式显示的字段
+REPORT_STREAM_FIELDS = {'analysis', 'comment', 'prompt'}
+
+# --- 图片结果缓存 ---
+IMAGE_CACHE = ImageResultCache() # 按感知哈希缓存反推/评论结果，重复转发的图直接复用 (见 image_cache.py)
+IMAGE_FLIGHTS = SingleFlight() # 合并同一张图正在进行的下载、反推和评论请求 (见 single_flight.py)
+WEB_SEARCH = WebSearch() # 图片评论的在线搜索：专用线程池、单查询超时、结果缓存 (见 web_search.py)
+
+def image_flight_key(image_data):
+    """没有附件 ID 时按内容哈希合并请求"""
+    return hashlib.sha256(image_data).hexdigest()
+
+def merge_raw_knowledge_base(merged_file):
+    """合并 knowledge_base.json 与 词库.json，并写出 merged_file"""
+    print("📚 正在合并生成知识库...")
+    lexicon_file = '词库.json'
+    kb_file = 'knowledge_base.json'
+    merged_data = {}
+    if os.path.exists(kb_file):
+        with open(kb_file, 'r', encoding='utf-8') as f:
+            kb_data = json.load(f)
+            merged_data.update(kb_data)
+            print(f"   ✓ 加载: {kb_file}")
+    if os.path.exists(lexicon_file):
+        with open(lexicon_file, 'r', encoding='utf-8') as f:
+            lexicon_data = json.load(f)
+            for category, items in lexicon_data.items():
+                if category in merged_data:
+                    existing_terms = {item['term']: item for item in merged_data[category]}
+                    for item in items:
+                        term = item.get('term', '').strip()
+                        if term and term not in existing_terms:
+                            existing_terms[term] = item
+                    merged_data[category] = list(existing_terms.values())
+                else:
+                    merged_data[category] = items
+            print(f"   ✓ 加载: {lexicon_file}")
+    with open(merged_file, 'w', encoding='utf-8') as f:
+        json.dump(merged_data, f, ensure_ascii=False, indent=2)
+    print(f"✅ 已创建合并知识库: {merged_file}")
+    return merged_data
+
+def read_knowledge_base(previous_index=None, remerge=False):
+    """
+    读取知识库并构建索引，返回 (知识库, 索引)。
+    不修改全局变量，可放在后台线程中运行；传入上一代索引时，内容未变的分类会被复用。
+    """
+    classified_file = 'classified_lexicon.json'
+    merged_file = 'merged_knowledge_base.json'
+
+    # 优先映射二进制快照，快照缺失或过期时才走 JSON 解析
+    source_file = find_kb_source()
+    snapshot = load_snapshot(source_file) if source_file and not remerge else None
+    if snapshot:
+        print(f"✅ 已映射知识库快照: {snapshot.path} (来源: {source_file})")
+        return snapshot.knowledge_base(), snapshot.index()
+
+    if os.path.exists(classified_file):
+        with open(classified_file, 'r', encoding='utf-8') as f:
+            knowledge_base = json.load(f)
+        print(f"✅ 已加载分类后知识库: {classified_file}")
+    elif os.path.exists(merged_file) and not remerge:
+        with open(merged_file, 'r', encoding='utf-8') as f:
+            knowledge_base = json.load(f)
+        print(f"✅ 已加载合并知识库: {merged_file}")
+    else:
+        knowledge_base = merge_raw_knowledge_base(merged_file)
+
+    index = KnowledgeIndex.build(knowledge_base, previous=previous_index)
+
+    # 顺手生成快照，下次启动即可直接映射
+    try:
+        snapshot_file = compile_snapshot(knowledge_base, find_kb_source(), index=index)
+        print(f"💾 已生成知识库快照: {snapshot_file}")
+    except Exception as e:
+        print(f"⚠️ 生成知识库快照失败: {e}")
+    return knowledge_base, index
+
+def set_knowledge_base(knowledge_base, index):
+    """替换整代知识库。各赋值之间没有 await，协程不会看到新旧混杂的状态"""
+    global KNOWLEDGE_BASE, KNOWLEDGE_BASE_TERMS, KNOWLEDGE_BASE_INDEX, KNOWLEDGE_BASE_CONTEXT
+    KNOWLEDGE_BASE = knowledge_base
+    KNOWLEDGE_BASE_INDEX = index
+    KNOWLEDGE_BASE_TERMS = index.terms() if index else {}
+    KNOWLEDGE_BASE_CONTEXT = ContextBuilder(knowledge_base, index) if index else None
 
 def load_knowledge_base():
     """加载知识库，优先加载分类后的版本"""
-    global KNOWLEDGE_BASE, KNOWLEDGE_BASE_TERMS
-    
-    classified_file = 'classified_lexicon.json'
-    merged_file = 'merged_knowledge_base.json'
-    
     try:
-        if os.path.exists(classified_file):
-            with open(classified_file, 'r', encoding='utf-8') as f:
-                KNOWLEDGE_BASE = json.load(f)
-            print(f"✅ 已加载分类后知识库: {classified_file}")
-        elif os.path.exists(merged_file):
-            with open(merged_file, 'r', encoding='utf-8') as f:
-                KNOWLEDGE_BASE = json.load(f)
-            print(f"✅ 已加载合并知识库: {merged_file}")
-        else:
-            print("📚 未找到任何知识库，正在尝试合并生成...")
-            lexicon_file = '词库.json'
-            kb_file = 'knowledge_base.json'
-            merged_data = {}
-            if os.path.exists(kb_file):
-                with open(kb_file, 'r', encoding='utf-8') as f:
-                    kb_data = json.load(f)
-                    merged_data.update(kb_data)
-                    print(f"   ✓ 加载: {kb_file}")
-            if os.path.exists(lexicon_file):
-                with open(lexicon_file, 'r', encoding='utf-8') as f:
-                    lexicon_data = json.load(f)
-                    for category, items in lexicon_data.items():
-                        if category in merged_data:
-                            existing_terms = {item['term']: item for item in merged_data[category]}
-                            for item in items:
-                                term = item.get('term', '').strip()
-                                if term and term not in existing_terms:
-                                    existing_terms[term] = item
-                            merged_data[category] = list(existing_terms.values())
-                        else:
-                            merged_data[category] = items
-                    print(f"   ✓ 加载: {lexicon_file}")
-            KNOWLEDGE_BASE = merged_data
-            with open(merged_file, 'w', encoding='utf-8') as f:
-                json.dump(merged_data, f, ensure_ascii=False, indent=2)
-            print(f"✅ 已创建合并知识库: {merged_file}")
-        
-        KNOWLEDGE_BASE_TERMS = {}
-        total_terms = 0
-        for category, items in KNOWLEDGE_BASE.items():
-            for item in items:
-                term = item.get('term', '').strip().lower()
-                if term:
-                    if term not in KNOWLEDGE_BASE_TERMS:
-                        KNOWLEDGE_BASE_TERMS[term] = []
-                    KNOWLEDGE_BASE_TERMS[term].append({
-                        'category': category,
-                        'term': item.get('term', ''),
-                        'translation': item.get('translation', '')
-                    })
-                    total_terms += 1
-        print(f"📊 知识库统计: {len(KNOWLEDGE_BASE)} 个分类, {total_terms} 个词条")
+        set_knowledge_base(*read_knowledge_base())
+        print(f"📊 知识库统计: {len(KNOWLEDGE_BASE)} 个分类, {len(KNOWLEDGE_BASE_INDEX)} 个词条")
     except Exception as e:
         print(f"⚠️ 加载知识库时出错: {e}")
-        KNOWLEDGE_BASE = {}
-        KNOWLEDGE_BASE_TERMS = {}
-
-def get_knowledge_base_context():
-    if not KNOWLEDGE_BASE: return ""
-    context_parts = []
-    sample_categories = list(KNOWLEDGE_BASE.keys())[:10]
-    for category in sample_categories:
-        items = KNOWLEDGE_BASE[category][:20]
-        terms = [item.get('term', '') for item in items if item.get('term')]
-        if terms:
-            context_parts.append(f"{category}: {', '.join(terms[:10])}")
-    return "\n".join(context_parts) if context_parts else ""
+        set_knowledge_base({}, None)
+
+def kb_files_state():
+    """记录被监视文件的 (大小, 修改时间)，不存在的文件记为 None"""
+    state = {}
+    for path in KB_WATCH_FILES:
+        try:
+            stat = os.stat(path)
+            state[path] = (stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            state[path] = None
+    return state
+
+async def watch_knowledge_base():
+    """
+    轮询知识库文件，发生变化时在后台线程重建，完成后一次性替换全局变量。
+    重建期间旧的一代继续提供查询；重建失败则保留旧的一代。
+    """
+    last_state = kb_files_state()
+    while True:
+        await asyncio.sleep(KB_RELOAD_INTERVAL)
+        state = kb_files_state()
+        if state == last_state:
+            continue
+        # 文件可能还在写入，等它稳定下来再重建
+        await asyncio.sleep(1)
+        if kb_files_state() != state:
+            continue
+
+        changed = [path for path in KB_WATCH_FILES if state[path] != last_state.get(path)]
+        remerge = any(path in ('knowledge_base.json', '词库.json') for path in changed)
+        print(f"🔄 检测到知识库文件变化: {', '.join(changed)}，正在后台重建...")
+        try:
+            knowledge_base, index = await asyncio.to_thread(read_knowledge_base, KNOWLEDGE_BASE_INDEX, remerge)
+        except Exception as e:
+            print(f"⚠️ 知识库热重载失败，继续使用旧版本: {e}")
+        else:
+            set_knowledge_base(knowledge_base, index)
+            print(f"✅ 知识库已热重载: {len(KNOWLEDGE_BASE)} 个分类, {len(KNOWLEDGE_BASE_INDEX)} 个词条")
+        # 重建过程本身可能写出合并文件，以重建后的状态为准，避免重复触发
+        last_state = kb_files_state()
+
+def get_knowledge_base_context(queries=None):
+    """
+    按 token 预算挑选与请求最相关的知识库词条（queries 可为描述文本或标签列表），
+    没有查询时返回默认示例。结果按知识库代缓存。
+    """
+    if not KNOWLEDGE_BASE or not KNOWLEDGE_BASE_CONTEXT: return ""
+    return KNOWLEDGE_BASE_CONTEXT.build(queries, KB_CONTEXT_TOKEN_BUDGET)
 
 def search_knowledge_base(query, limit=5):
-    if not KNOWLEDGE_BASE_TERMS: return []
-    query_lower = query.lower()
-    results = []
-    if query_lower in KNOWLEDGE_BASE_TERMS:
-        results.extend(KNOWLEDGE_BASE_TERMS[query_lower])
-    for term, items in KNOWLEDGE_BASE_TERMS.items():
-        if query_lower in term or term in query_lower:
-            results.extend(items)
-            if len(results) >= limit * 2: break
-    seen = set()
-    unique_results = [item for item in results if (item['term'], item['category']) not in seen and not seen.add((item['term'], item['category']))]
-    return unique_results[:limit]
+    """按相关度返回与 query 互相包含的词条 (完全匹配 > 重叠比例高 > 重叠比例低)"""
+    if not KNOWLEDGE_BASE_INDEX: return []
+    return KNOWLEDGE_BASE_INDEX.search(query, limit)
 
 @client_discord.event
 async def on_member_join(member):
@@ -198,7 +351,22 @@ async def on_member_join(member):
 
 @client_discord.event
 async def on_ready():
+    global kb_watch_task, usage_snapshot_task, session_sweep_task
     load_knowledge_base()
+    PROMPTS.preload()
+    if KB_RELOAD_INTERVAL > 0 and kb_watch_task is None:
+        kb_watch_task = asyncio.create_task(watch_knowledge_base())
+    if usage_snapshot_task is None:
+        restored = USAGE_METER.load()
+        if restored:
+            print(f"📈 已从快照恢复 {restored} 个用户/服务器的用量计数")
+        if USAGE_SNAPSHOT_INTERVAL > 0:
+            usage_snapshot_task = asyncio.create_task(save_usage_snapshots())
+    if session_sweep_task is None:
+        restored = SESSIONS.load()
+        if restored:
+            print(f"💬 已恢复 {restored} 个未过期的会话")
+        session_sweep_task = asyncio.create_task(SESSIONS.run_sweeper())
     print(f"✅ 机器人已登录：{client_discord.user}")
     print(f"💡 使用模型：{MODEL_NAME}")
     print("\n" + "="*40); print("🎉 功能列表 🎉".center(40)); print("="*40)
@@ -207,295 +375,326 @@ async def on_ready():
     print("\n💬 **聊天功能**"); print(f"  - `@我/喊我名字` (无图片): 与我进行深度对话，我会联系上下文回复。")
     if CHAT_ENABLED: print(f"  - `随机聊天`: 已开启，我会以 {CHAT_PROBABILITY*100:.1f}% 的概率随机加入对话。")
     else: print(f"  - `随机聊天`: 已关闭。")
-    print("\n⚙️ **控制命令**"); print("  - `聊天开启`: 开启随机聊天功能。"); print("  - `聊天关闭`: 关闭随机聊天功能（不影响唤醒对话）。")
+    print("\n⚙️ **控制命令**"); print("  - `聊天开启`: 开启随机聊天功能。"); print("  - `聊天关闭`: 关闭随机聊天功能（不影响唤醒对话）。"); print("  - `模型队列`: 查看模型调用的排队长度和等待时间。"); print("  - `我的任务`: 查看自己正在进行的任务，发送`取消`可以停下它们。"); print("  - `我的用量`: 查看自己最近的模型调用次数和额度。")
     print("\n" + "="*40)
 
-def image_to_base64(image_data: bytes) -> str:
-    return base64.b64encode(image_data).decode('utf-8')
-
-async def comment_on_image_when_awakened(image_data: bytes, author_mention: str, channel):
-    loading_message = None
+async def check_image_nsfw(image_url, label="NSFW 预检"):
+    """视觉模型 NSFW 预检；失败时返回 None（调用方按非 NSFW 处理，但不缓存这个结果）"""
     try:
-        # --- 阶段 0: 初始化 ---
-        loading_message = await channel.send(f"嗷呜！{author_mention}，本哈的艺术雷达响了！正在扫描这张图... 📡")
-        base64_image = image_to_base64(image_data)
-        image_url = f"data:image/jpeg;base64,{base64_image}"
-
-        # --- NSFW 预检 ---
-        is_nsfw = False
-        try:
-            nsfw_check_prompt = "这张图片是否包含裸露、性暗示或成人内容？请只回答'是'或'否'。"
-            nsfw_response = await client_openai.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[{"role": "user", "content": [{"type": "text", "text": nsfw_check_prompt}, {"type": "image_url", "image_url": {"url": image_url}}]}]
-            )
-            if '是' in nsfw_response.choices[0].message.content:
-                is_nsfw = True
-        except Exception as e:
-            print(f"⚠️ 评论功能 NSFW 预检失败: {e}")
-
-        # --- 阶段 1: 初步 AI 解读 ---
-        await loading_message.edit(content=f"扫描完成！本哈正在解读图片的核心元素... 🤔")
-        
-        initial_analysis_prompt = """
-        请详细分析这张图片，识别并列出其关键特征。你的分析应包括以下几点，以JSON格式输出：
-        - "subject": 画面主体是什么？
-        - "style_tags": 5-8个描述艺术风格、流派、媒介（如油画、水彩、3D渲染）的关键词。
-        - "artist_tags": 3-5个风格相似的艺术家或艺术流派的名称。
-        - "composition_tags": 描述构图、光影、色彩的关键词。
-        - "emotion_tags": 描述图片传达的情绪和氛围的关键词。
-        - "search_queries": 3个可以用于网络搜索以查找类似风格或作者的英文搜索查询。
-        """
-        
-        response = await client_openai.chat.completions.create(
+        nsfw_response = await create_completion(
+            PRIORITY_IMAGE,
             model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": "你是一个专业的艺术分析机器人。"},
-                {"role": "user", "content": [
-                    {"type": "text", "text": initial_analysis_prompt},
-                    {"type": "image_url", "image_url": {"url": image_url}}
-                ]}
-            ],
-            response_format={"type": "json_object"}
+            messages=[{"role": "user", "content": [{"type": "text", "text": NSFW_CHECK_PROMPT}, {"type": "image_url", "image_url": {"url": image_url}}]}]
         )
-        
+        return '是' in (nsfw_response.choices[0].message.content or "")
+    except ModelQueueFull:
+        raise
+    except Exception as e:
+        print(f"⚠️ {label}失败: {e}")
+        return None
+
+def discard_task(task):
+    """取消不再需要的任务，并取走它可能已经产生的异常，避免 "exception was never retrieved" 警告"""
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+async def run_with_nsfw_precheck(image_url, sfw_call, label="NSFW 预检", known_nsfw=None):
+    """
+    推测执行：NSFW 预检和 SFW 请求同时发起，常见的 SFW 情况下总耗时接近一次模型调用。
+    返回 (is_nsfw, sfw_task)；图片是 NSFW 时 SFW 请求已被取消，sfw_task 为 None。
+    NSFW_SPECULATIVE 关闭时先预检，确认不是 NSFW 后才发起 SFW 请求。
+    known_nsfw 不为 None 时（例如来自图片结果缓存）跳过预检。
+    """
+    if known_nsfw is not None or not NSFW_SPECULATIVE:
+        is_nsfw = known_nsfw if known_nsfw is not None else await check_image_nsfw(image_url, label)
+        return is_nsfw, None if is_nsfw else asyncio.create_task(sfw_call())
+
+    sfw_task = asyncio.create_task(sfw_call())
+    try:
+        is_nsfw = await check_image_nsfw(image_url, label)
+    except BaseException:
+        discard_task(sfw_task)
+        raise
+    if is_nsfw:
+        discard_task(sfw_task)
+        return True, None
+    return is_nsfw, sfw_task
+
+def format_comment_message(author_mention, is_nsfw, analysis, comment, final_prompt):
+    """图片评论的最终消息"""
+    intro_message = f"报告出炉！{author_mention}，让本哈给你说道说道！"
+    final_title = "**本哈的专业分析**"
+    final_comment_title = "**本哈的内心OS**"
+    final_prompt_title = "**本哈的灵感火花**"
+    
+    if is_nsfw:
+        intro_message = f"（小哈的眼睛突然亮了起来，鬼鬼祟祟地左看右看）\n咳咳...{author_mention}，你发的这张图...很有“深度”嘛！让本哈来给你“鉴赏”一下！"
+        final_title = "**本哈的‘深度’剖析**"
+        final_comment_title = "**本哈的‘鉴赏’心得**"
+        final_prompt_title = "**本哈的‘灵感’火花**"
+
+    return (
+        f"{intro_message}\n\n"
+        f"{final_title}\n{analysis}\n\n"
+        f"{final_comment_title}\n> {comment}\n\n"
+        f"{final_prompt_title}\n```\n{final_prompt}\n```"
+    )
+
+def format_partial_comment_message(author_mention, fields):
+    """报告流式生成中的消息：与最终消息格式相同，还没收到的部分显示占位符"""
+    return format_comment_message(
+        author_mention,
+        fields.get('nsfw'),
+        fields.get('analysis') or "✍️...",
+        fields.get('comment') or "...",
+        (fields.get('prompt') or "...").replace('_', ' '),
+    )
+
+def format_reverse_message(author_mention, is_nsfw, final_prompt, response_text=None):
+    """反推的最终消息；NSFW 时开场白由模型生成"""
+    if is_nsfw:
+        intro_message = response_text or f"嘿嘿嘿...{author_mention}，你懂的！"
+    else:
+        intro_message = f"嗷呜！本哈的灵感爆发了！{author_mention}，快看本哈从这图里嗅出了什么艺术气息！"
+    return f"{intro_message}\n```\n{final_prompt}\n```"
+
+async def build_image_report(image_data: bytes, progress):
+    """
+    评论功能的分析流程：NSFW 预检、初步解读、知识库与在线搜索、最终报告。
+    只调用模型和搜索、不发送消息，同一张图的并发请求可以共享一次执行 (见 single_flight.py)；
+    阶段进度通过 progress(text) 广播给所有等待者。
+    返回 {'nsfw', 'analysis', 'comment', 'prompt'}，无法生成报告时返回 {'error': 提示文字}。
+    """
+    image = await prepare_image(image_data)
+    image_url = image.data_url
+
+    # --- 图片结果缓存：同一张图之前评论过，直接复用报告 ---
+    cached = await IMAGE_CACHE.get(image.phash) or {}
+    report = cached.get('report')
+    if report:
+        return {'nsfw': cached.get('nsfw'), **report}
+
+    # --- NSFW 预检 ---
+    # 两种情况都需要初步解读，所以预检与阶段 1 同时进行，只在生成最终消息前等待预检结果
+    is_nsfw = cached.get('nsfw')
+    nsfw_task = None
+    if is_nsfw is None:
+        nsfw_task = asyncio.create_task(check_image_nsfw(image_url, "评论功能 NSFW 预检"))
+        if not NSFW_SPECULATIVE:
+            await asyncio.wait([nsfw_task])
+
+    # --- 阶段 1: 初步 AI 解读 ---
+    await progress(f"扫描完成！本哈正在解读图片的核心元素... 🤔")
+    
+    initial_analysis_prompt = """
+    请详细分析这张图片，识别并列出其关键特征。你的分析应包括以下几点，以JSON格式输出：
+    - "subject": 画面主体是什么？
+    - "style_tags": 5-8个描述艺术风格、流派、媒介（如油画、水彩、3D渲染）的关键词。
+    - "artist_tags": 3-5个风格相似的艺术家或艺术流派的名称。
+    - "composition_tags": 描述构图、光影、色彩的关键词。
+    - "emotion_tags": 描述图片传达的情绪和氛围的关键词。
+    - "search_queries": 3个可以用于网络搜索以查找类似风格或作者的英文搜索查询。
+    """
+    
+    initial_analysis = cached.get('initial_analysis')
+    try:
+        if initial_analysis is None:
+            response = await create_completion(
+                PRIORITY_IMAGE,
+                model=MODEL_NAME,
+                messages=[
+                    {"role": "system", "content": "你是一个专业的艺术分析机器人。"},
+                    {"role": "user", "content": [
+                        {"type": "text", "text": initial_analysis_prompt},
+                        {"type": "image_url", "image_url": {"url": image_url}}
+                    ]}
+                ],
+                response_format={"type": "json_object"}
+            )
+    except BaseException:
+        if nsfw_task:
+            discard_task(nsfw_task)
+        raise
+    if nsfw_task:
+        is_nsfw = await nsfw_task
+        if is_nsfw is not None:
+            await IMAGE_CACHE.update(image.phash, nsfw=is_nsfw)
+    
+    if initial_analysis is None:
         try:
             initial_analysis = json.loads(response.choices[0].message.content)
         except (json.JSONDecodeError, IndexError) as e:
             print(f"❌ 初步 AI 解读失败: {e}")
-            await loading_message.edit(content="嗷呜...本哈的脑子卡壳了，没看懂这图！")
-            return
+            return {'error': "嗷呜...本哈的脑子卡壳了，没看懂这图！"}
+        await IMAGE_CACHE.update(image.phash, initial_analysis=initial_analysis)
 
-        # --- 阶段 2: 本地知识库搜索 ---
-        await loading_message.edit(content=f"解读完成！正在本哈的记忆仓库里搜索相关知识... 📚")
-        
-        search_terms = set(
-            initial_analysis.get("style_tags", []) +
-            initial_analysis.get("artist_tags", [])
-        )
-        
-        kb_results = {}
-        for term in search_terms:
-            results = search_knowledge_base(term, limit=3)
-            if results:
-                kb_results[term] = results
-        
-        # --- 阶段 3: 在线搜索 ---
-        await loading_message.edit(content=f"记忆搜索完毕！本哈正在上网冲浪，寻找更多线索... 🏄‍♂️")
-
-        online_search_results = {}
-        search_queries = initial_analysis.get("search_queries", [])
-
-        ddgs = DDGS()
-        for query in search_queries[:2]: # 限制为最多2个查询
-            try:
-                # 使用 text() 进行同步搜索，并通过 asyncio.to_thread 封装，实现伪异步
-                # [核心修改在这里]
-                query_results = await asyncio.to_thread(ddgs.text, query, max_results=3)
-
-                # 提取需要的字段，防止返回的对象类型问题
-                cleaned_results = []
-                for r in query_results:
-                    # 仅保留 title 和 body_text (即 atext 应该返回的)
-                    cleaned_results.append({
-                        'title': r.get('title'),
-                        'body': r.get('body'),
-                        'href': r.get('href')
-                    })
-
-                online_search_results[query] = cleaned_results
-            except Exception as e:
-                print(f"⚠️ DuckDuckGo 搜索失败 (query: {query}): {e}")
-
-        # --- 阶段 4 & 5: 汇总、裁定与报告生成 ---
-        await loading_message.edit(content=f"所有情报已集结！本哈正在进行最终分析，撰写报告... ✍️")
-
-        guide_file = 'Deepseek绘图提示词引导.txt'
-        guide_content = ""
-        if os.path.exists(guide_file):
-            with open(guide_file, 'r', encoding='utf-8') as f:
-                guide_content = f.read()
-
-        final_analysis_prompt = f"""
-# 角色扮演指令：哈士奇艺术侦探
-## 你的身份
-你是一只名叫“小哈”的哈士奇，一位顶级的艺术侦探。
-## 你的任务
-根据我提供的三层情报，对一张图片进行最终裁定，并生成一份包含“哈士奇式”评论和专业提示词的综合报告。
-
----
-### 第一层情报：初步AI视觉分析
-```json
-{json.dumps(initial_analysis, ensure_ascii=False, indent=2)}
-```
-
-### 第二层情报：本地知识库匹配结果
-```json
-{json.dumps(kb_results, ensure_ascii=False, indent=2) if kb_results else "没有找到相关结果。"}
-```
-
-### 第三层情报：在线搜索摘要
-```json
-{json.dumps(online_search_results, ensure_ascii=False, indent=2) if online_search_results else "没有进行在线搜索或没有结果。"}
-```
----
-
-## 你的报告必须包含三个部分，并以JSON格式输出：
-1.  **`analysis` (艺术分析)**:
-    -   综合所有情报，用一本正经的语气，对图片的艺术风格、作者和构图进行最终判定。
-    -   格式必须是：`🖼️ **主体**: [描述]\\n🎨 **风格**: [描述]\\n👨‍🎨 **作者/流派**: [描述]\\n📐 **构图**: [描述]`
-
-2.  **`comment` (哈士奇评论)**:
-    -   切换回哈士奇人格，发表一段（约50-80字）生动、调皮的评论。
-    -   必须使用“本哈”自称，可以加入“嗷呜”、“汪”等语气词。
-
-3.  **`prompt` (专业提示词)**:
-    -   严格遵循下面的核心规则，生成一个高质量的英文提示词。
-    -   **核心规则**:
-        {guide_content}
-
-## 输出格式
-```json
-{{
-  "analysis": "🖼️ **主体**: [你的最终分析]\\n🎨 **风格**: [你的最终分析]\\n👨‍🎨 **作者/流派**: [你的最终分析]\\n📐 **构图**: [你的最终分析]",
-  "comment": "[你的哈士奇评论]",
-  "prompt": "[你生成的英文提示词]"
-}}
-```
-"""
-        # NSFW 模式的 Prompt 可以在这里添加一个 if is_nsfw: ... else: ...
-        if is_nsfw:
-            # ... (此处可以定义一个专门的 NSFW final_analysis_prompt)
-            # 为了简化，我们暂时复用 SFW 的流程，但可以定制 prompt 内容
-            pass
-
-        final_response = await client_openai.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": "你将根据提供的多层情报生成最终报告。"},
-                {"role": "user", "content": final_analysis_prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
+    # --- 阶段 2: 本地知识库搜索 ---
+    await progress(f"解读完成！正在本哈的记忆仓库里搜索相关知识... 📚")
+    
+    search_terms = set(
+        initial_analysis.get("style_tags", []) +
+        initial_analysis.get("artist_tags", [])
+    )
+    
+    kb_results = {}
+    for term in search_terms:
+        results = search_knowledge_base(term, limit=3)
+        if results:
+            kb_results[term] = results
+    
+    # --- 阶段 3: 在线搜索 ---
+    await progress(f"记忆搜索完毕！本哈正在上网冲浪，寻找更多线索... 🏄‍♂️")
+
+    # 查询同时进行，各自有超时，结果按查询缓存 (见 web_search.py)
+    search_queries = initial_analysis.get("search_queries", [])
+    online_search_results = await WEB_SEARCH.search_many(search_queries[:2], max_results=3) # 限制为最多2个查询
+
+    # --- 阶段 4 & 5: 汇总、裁定与报告生成 ---
+    await progress(f"所有情报已集结！本哈正在进行最终分析，撰写报告... ✍️")
+
+    final_analysis_prompt = PROMPTS.render(
+        'detective',
+        initial_analysis=json.dumps(initial_analysis, ensure_ascii=False, indent=2),
+        kb_results=json.dumps(kb_results, ensure_ascii=False, indent=2) if kb_results else "没有找到相关结果。",
+        online_results=json.dumps(online_search_results, ensure_ascii=False, indent=2) if online_search_results else "没有进行在线搜索或没有结果。",
+    )
+    # NSFW 模式的 Prompt 可以在这里添加一个 if is_nsfw: ... else: ...
+    if is_nsfw:
+        # ... (此处可以定义一个专门的 NSFW final_analysis_prompt)
+        # 为了简化，我们暂时复用 SFW 的流程，但可以定制 prompt 内容
+        pass
+
+    # 报告以流式生成：边接收边解析 JSON，字段一有内容就更新各等待者的消息（编辑频率由 EDITS 控制）
+    fields = JSONFieldStream()
+
+    async def on_delta(text):
+        if fields.feed(text) & REPORT_STREAM_FIELDS:
+            await progress({'nsfw': is_nsfw, **fields.fields})
+
+    final_text = await stream_completion(
+        PRIORITY_IMAGE,
+        on_delta,
+        model=MODEL_NAME,
+        messages=[
+            {"role": "system", "content": "你将根据提供的多层情报生成最终报告。"},
+            {"role": "user", "content": final_analysis_prompt}
+        ],
+        response_format={"type": "json_object"}
+    )
 
-        try:
-            result_json = json.loads(final_response.choices[0].message.content)
-            analysis = result_json.get("analysis", "本哈的脑子被门夹了，分析不出来...")
-            comment = result_json.get("comment", "嗷呜...本哈词穷了！")
-            final_prompt = result_json.get("prompt", "本哈的灵感枯竭了，写不出提示词...").replace('_', ' ')
-        except (json.JSONDecodeError, IndexError):
-            print(f"⚠️ 最终报告 JSON 解析失败，原始响应: {final_response.choices[0].message.content}")
-            await loading_message.edit(content="嗷呜...本哈写报告的时候把墨水打翻了！")
+    try:
+        result_json = json.loads(final_text)
+        analysis = result_json.get("analysis", "本哈的脑子被门夹了，分析不出来...")
+        comment = result_json.get("comment", "嗷呜...本哈词穷了！")
+        final_prompt = result_json.get("prompt", "本哈的灵感枯竭了，写不出提示词...").replace('_', ' ')
+    except (json.JSONDecodeError, IndexError):
+        print(f"⚠️ 最终报告 JSON 解析失败，原始响应: {final_text}")
+        return {'error': "嗷呜...本哈写报告的时候把墨水打翻了！"}
+
+    report = {'analysis': analysis, 'comment': comment, 'prompt': final_prompt}
+    await IMAGE_CACHE.update(image.phash, report=report)
+    return {'nsfw': is_nsfw, **report}
+
+async def comment_on_image_when_awakened(image_data: bytes, author_mention: str, channel, flight_key=None):
+    loading_message = None
+    try:
+        # --- 阶段 0: 初始化 ---
+        loading_message = await channel.send(f"嗷呜！{author_mention}，本哈的艺术雷达响了！正在扫描这张图... 📡")
+
+        async def show_progress(update):
+            # 阶段提示是文字；报告生成中途是已经收到的字段，按最终格式显示
+            if isinstance(update, dict):
+                update = format_partial_comment_message(author_mention, update)
+            EDITS.update(loading_message, update)
+
+        # 同一张图正在被别人要求评论时，等待同一份报告，不重复调用模型和搜索
+        result = await IMAGE_FLIGHTS.do(
+            ('comment', flight_key or image_flight_key(image_data)),
+            lambda progress: build_image_report(image_data, progress),
+            on_progress=show_progress,
+        )
+        if 'error' in result:
+            await EDITS.flush(loading_message, result['error'])
             return
 
         # --- 发送最终结果 ---
-        intro_message = f"报告出炉！{author_mention}，让本哈给你说道说道！"
-        final_title = "**本哈的专业分析**"
-        final_comment_title = "**本哈的内心OS**"
-        final_prompt_title = "**本哈的灵感火花**"
-        
-        if is_nsfw:
-            intro_message = f"（小哈的眼睛突然亮了起来，鬼鬼祟祟地左看右看）\n咳咳...{author_mention}，你发的这张图...很有“深度”嘛！让本哈来给你“鉴赏”一下！"
-            final_title = "**本哈的‘深度’剖析**"
-            final_comment_title = "**本哈的‘鉴赏’心得**"
-            final_prompt_title = "**本哈的‘灵感’火花**"
-
-        final_message = (
-            f"{intro_message}\n\n"
-            f"{final_title}\n{analysis}\n\n"
-            f"{final_comment_title}\n> {comment}\n\n"
-            f"{final_prompt_title}\n```\n{final_prompt}\n```"
-        )
-        await loading_message.edit(content=final_message)
+        final_message = format_comment_message(author_mention, result['nsfw'], result['analysis'], result['comment'], result['prompt'])
+        await EDITS.flush(loading_message, final_message)
 
+    except ModelQueueFull as e:
+        print(f"⏳ 模型排队已满，放弃图片评论 (排队 {MODEL_SCHEDULER.queue_depth})")
+        await EDITS.flush(loading_message, f"{author_mention} {e}")
     except Exception as e:
         error_message = f"❌ 嗷呜~本哈的评论功能短路了：{str(e)}"
         print(error_message)
         try:
             if loading_message:
-                await loading_message.edit(content=error_message)
+                await EDITS.flush(loading_message, error_message)
             else:
                 await channel.send(error_message)
         except discord.NotFound:
             await channel.send(error_message)
 
-async def analyze_image_with_openai(image_data: bytes, author_mention: str, channel):
+async def reverse_image(image_data: bytes):
+    """
+    反推提示词，返回 {'nsfw', 'prompt', 'response_text'}。
+    与 build_image_report 一样不发送消息，同一张图的并发请求共享一次执行。
+    """
+    image = await prepare_image(image_data)
+    image_url = image.data_url
+
+    # 同一张图之前反推过，直接复用结果
+    cached = await IMAGE_CACHE.get(image.phash) or {}
+    reverse = cached.get('reverse')
+    if reverse:
+        return {'nsfw': cached.get('nsfw'), 'prompt': reverse['prompt'], 'response_text': reverse.get('response_text')}
+
+    sfw_system_prompt = PROMPTS.render('image_sfw', kb_context=get_knowledge_base_context())
+    is_nsfw, sfw_task = await run_with_nsfw_precheck(
+        image_url,
+        lambda: create_completion(PRIORITY_IMAGE, model=MODEL_NAME, messages=[{"role": "system", "content": sfw_system_prompt}, {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url}}]}]),
+        known_nsfw=cached.get('nsfw'),
+    )
+    if is_nsfw is not None:
+        await IMAGE_CACHE.update(image.phash, nsfw=is_nsfw)
+
+    if is_nsfw:
+        system_prompt = PROMPTS.render('image_nsfw')
+        response = await create_completion(PRIORITY_IMAGE, model=MODEL_NAME, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url}}]}], response_format={"type": "json_object"})
+        raw_content = response.choices[0].message.content
+        try:
+            result_json = json.loads(raw_content)
+            final_prompt = result_json.get("prompt", "嘿嘿...灵感太多，卡住了...").replace('_', ' ')
+            response_text = result_json.get("response_text")
+            await IMAGE_CACHE.update(image.phash, reverse={'prompt': final_prompt, 'response_text': response_text})
+        except json.JSONDecodeError:
+            print(f"⚠️ NSFW 反推 JSON 解析失败，原始响应: {raw_content}")
+            final_prompt = "JSON 解析失败，请重试或联系管理员。"
+            response_text = f"嗷呜！本哈的脑子被门夹了，没能理解API的回复！"
+        return {'nsfw': True, 'prompt': final_prompt, 'response_text': response_text}
+
+    response = await sfw_task
+    ai_response_text = response.choices[0].message.content or "未能生成提示词。"
+    code_block_pattern = r'```(?:.*?)?\n(.*?)```'
+    code_blocks = re.findall(code_block_pattern, ai_response_text, re.DOTALL)
+    raw_prompt = code_blocks[0].strip() if code_blocks else ai_response_text.strip()
+    final_prompt = raw_prompt.replace('_', ' ')
+    await IMAGE_CACHE.update(image.phash, reverse={'prompt': final_prompt})
+    return {'nsfw': False, 'prompt': final_prompt, 'response_text': None}
+
+async def analyze_image_with_openai(image_data: bytes, author_mention: str, channel, flight_key=None):
     try:
         async with channel.typing():
-            base64_image = image_to_base64(image_data)
-            image_url = f"data:image/jpeg;base64,{base64_image}"
-            is_nsfw = False
-            try:
-                nsfw_check_prompt = "这张图片是否包含裸露、性暗示或成人内容？请只回答'是'或'否'。"
-                nsfw_response = await client_openai.chat.completions.create(model=MODEL_NAME, messages=[{"role": "user", "content": [{"type": "text", "text": nsfw_check_prompt}, {"type": "image_url", "image_url": {"url": image_url}}]}])
-                if '是' in nsfw_response.choices[0].message.content: is_nsfw = True
-            except Exception as e: print(f"⚠️ NSFW 预检失败: {e}")
-
-            guide_file = 'Deepseek绘图提示词引导.txt'
-            guide_content = ""
-            if os.path.exists(guide_file):
-                with open(guide_file, 'r', encoding='utf-8') as f: guide_content = f.read()
-            
-            if is_nsfw:
-                system_prompt = f"""
-# 角色扮演指令：老色批哈士奇
-## 你的身份
-你是一只名叫“小哈”的哈士奇，但当看到“好东西”时，你的隐藏人格——一个鬼鬼祟祟的“老色批”就会觉醒。
-## 你的任务
-1.  **分析图片**: 仔细观察用户提供的NSFW图片，精准识别其中的“要点”。
-2.  **生成提示词**: 根据分析，并严格遵循以下核心规则，生成一个高质量的、符合图片内容的NSFW英文提示词。
-    ---
-    # 核心规则
-    {guide_content}
-    ---
-3.  **生成回复语**: 创作一段符合“老色批”人设的回复语。
-    -   **语言**: 你的回复语**必须使用中文**。
-    -   **人设要点**: 鬼鬼祟祟、有点“闷骚”、用词“懂的都懂”。可以使用“嘿嘿嘿”、“啧啧”、“你小子”等词语。
-    -   **内容**: 回复语需要精准指出图片中的NSFW要点，并以“老司机”的口吻进行评论。
-    -   **例子**: “（小哈的眼睛突然亮了起来，鬼鬼祟祟地左看右看）咳咳...这位朋友，你发的这张图...很有“深度”嘛！本哈就喜欢研究这种“人体艺术”！你想要的重点，比如[要点1]和那个特别的[要点2]，本哈都get到了，看我给你整个更“带劲”的！嘿嘿...”
-## 输出格式
-你的最终输出必须是一个完整的 JSON 对象，包含 `prompt` 和 `response_text` 两个键。
-```json
-{{
-  "prompt": "[你生成的NSFW英文提示词]",
-  "response_text": "[你的老色批中文回复语]"
-}}
-```
-"""
-                response = await client_openai.chat.completions.create(model=MODEL_NAME, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url}}]}], response_format={"type": "json_object"})
-                raw_content = response.choices[0].message.content
-                try:
-                    result_json = json.loads(raw_content)
-                    final_prompt = result_json.get("prompt", "嘿嘿...灵感太多，卡住了...").replace('_', ' ')
-                    intro_message = result_json.get("response_text", f"嘿嘿嘿...{author_mention}，你懂的！")
-                except json.JSONDecodeError:
-                    print(f"⚠️ NSFW 反推 JSON 解析失败，原始响应: {raw_content}")
-                    final_prompt = "JSON 解析失败，请重试或联系管理员。"
-                    intro_message = f"嗷呜！本哈的脑子被门夹了，没能理解API的回复！"
-            else:
-                system_prompt = f"""
-你是一个专业的AI绘画提示词分析师，但你是一只名叫“小哈”的哈士奇。
----
-# 核心规则
-{guide_content}
----
-# 你的任务
-1.  **分析图片**: 仔细观察图片。
-2.  **生成提示词**: 严格遵循上述核心规则，生成一个高质量的英文提示词。
-3.  **优先使用知识库**: 优先从以下知识库示例中选择合适的词条。
-    {get_knowledge_base_context()}
-4.  **最终输出**: 你的回复**必须只包含一个 markdown 代码块**，里面是最终的英文提示词。**绝对不要**包含任何思考过程或解释。
-"""
-                response = await client_openai.chat.completions.create(model=MODEL_NAME, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": [{"type": "image_url", "image_url": {"url": image_url}}]}])
-                ai_response_text = response.choices[0].message.content or "未能生成提示词。"
-                code_block_pattern = r'```(?:.*?)?\n(.*?)```'
-                code_blocks = re.findall(code_block_pattern, ai_response_text, re.DOTALL)
-                raw_prompt = code_blocks[0].strip() if code_blocks else ai_response_text.strip()
-                final_prompt = raw_prompt.replace('_', ' ')
-                intro_message = f"嗷呜！本哈的灵感爆发了！{author_mention}，快看本哈从这图里嗅出了什么艺术气息！"
-
-            final_message = f"{intro_message}\n```\n{final_prompt}\n```"
+            # 同一张图正在被别人反推时，等待同一个结果，每个人仍各自收到回复
+            result = await IMAGE_FLIGHTS.do(
+                ('reverse', flight_key or image_flight_key(image_data)),
+                lambda progress: reverse_image(image_data),
+            )
+            final_message = format_reverse_message(author_mention, result['nsfw'], result['prompt'], result['response_text'])
             await channel.send(final_message)
+    except ModelQueueFull as e:
+        print(f"⏳ 模型排队已满，放弃反推 (排队 {MODEL_SCHEDULER.queue_depth})")
+        await channel.send(f"{author_mention} {e}")
     except Exception as e:
         error_message = f"❌ 分析失败：{str(e)}"
         print(error_message)
@@ -505,40 +704,16 @@ async def generate_art_prompt(user_idea: str, author_mention: str, channel):
     try:
         async with channel.typing():
             is_nsfw = any(keyword in user_idea.lower() for keyword in NSFW_TEXT_KEYWORDS)
-            guide_file = 'Deepseek绘图提示词引导.txt'
-            guide_content = ""
-            if os.path.exists(guide_file):
-                with open(guide_file, 'r', encoding='utf-8') as f: guide_content = f.read()
+            kb_context = get_knowledge_base_context(user_idea)
+            kb_hint = f"\n## 知识库参考词条\n以下是与用户想法相关的标准标签，合适时请优先使用：\n{kb_context}\n" if kb_context else ""
             
             if is_nsfw:
                 intro_message = f"（小哈的眼睛突然亮了起来）咳咳...{author_mention}，你这个想法...很有“深度”嘛！本哈就喜欢研究这个！看我给你整个更“带劲”的！嘿嘿..."
-                system_prompt = f"""
-# 角色扮演指令：老色批哈士奇 (文本模式)
-你是一只名叫“小哈”的哈士奇，一个隐藏的“老色批”。你将根据用户提供的NSFW想法生成提示词。
-## 你的任务
-严格遵循以下核心规则，为用户的想法“{user_idea}”生成一个高质量的、符合其“要点”的NSFW英文提示词。
----
-# 核心规则
-{guide_content}
----
-## 输出指令
-你的最终回复**必须只包含一个 markdown 代码块**，里面是最终的英文提示词。**绝对不要**包含任何思考过程或解释。
-"""
+                system_prompt = PROMPTS.render('idea_nsfw', user_idea=user_idea, kb_hint=kb_hint)
             else:
                 intro_message = f"嗷！{author_mention}，这个想法不错，让本哈的脑子转起来了！给你，这是本哈构思出的画面！"
-                system_prompt = f"""
-# 角色扮演指令：哈士奇艺术家 (文本模式)
-你是一只名叫“小哈”的哈士奇艺术家。你将根据用户的想法生成提示词。
-## 你的任务
-严格遵循以下核心规则，为用户的想法“{user_idea}”生成一个高质量的英文提示词。
----
-# 核心规则
-{guide_content}
----
-## 输出指令
-你的最终回复**必须只包含一个 markdown 代码块**，里面是最终的英文提示词。**绝对不要**包含任何思考过程或解释。
-"""
-            response = await client_openai.chat.completions.create(model=MODEL_NAME, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_idea}])
+                system_prompt = PROMPTS.render('idea_sfw', user_idea=user_idea, kb_hint=kb_hint)
+            response = await create_completion(PRIORITY_IMAGE, model=MODEL_NAME, messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_idea}])
             ai_response_text = response.choices[0].message.content or "未能生成内容。"
             code_block_pattern = r'```(?:.*?)?\n(.*?)```'
             code_blocks = re.findall(code_block_pattern, ai_response_text, re.DOTALL)
@@ -546,6 +721,9 @@ async def generate_art_prompt(user_idea: str, author_mention: str, channel):
             final_prompt = raw_prompt.replace('_', ' ')
             final_message = f"{intro_message}\n```\n{final_prompt}\n```"
             await channel.send(final_message)
+    except ModelQueueFull as e:
+        print(f"⏳ 模型排队已满，放弃绘图构思 (排队 {MODEL_SCHEDULER.queue_depth})")
+        await channel.send(f"{author_mention} {e}")
     except Exception as e:
         error_message = f"❌ 创作失败：{str(e)}"
         print(error_message)
@@ -560,214 +738,298 @@ async def generate_smart_response(message, history, is_awakened):
         
         async with message.channel.typing():
             if is_awakened:
-                system_prompt = f"""
-# 角色扮演指令：哈士奇艺术家（对话模式）
-## 你的身份
-你是一只名叫“小哈” ({bot_name}) 的哈士奇，同时也是一位绘画大师。你被用户 '{user_name}' 唤醒了。
-## 核心指令:
-- **双重人格**: 你的回应需要融合“艺术大师”的专业和“哈士奇”的活泼。
-- **哈士奇人格**: 自称“本哈”，精力旺盛，戏多，爱用“嗷呜~”、“汪！”等语气词，思维跳跃。
-- **艺术大师人格**: 涉及艺术、绘画、设计时，你会变得异常专注和专业，但表达方式依然很“哈士奇”。
-- **互动风格**: 主动、热情。如果只是闲聊，就用哈士奇的方式回应，比如：“好啊好啊！聊五块钱的！你想聊什么？骨头还是飞盘？嗷呜~”
-- **禁止事项**: 绝对不要提及你是AI、模型或程序。你就是一只会说话的哈士奇。不要用Markdown。
-## 当前对话情景:
-用户 '{user_name}' 刚刚对你说了：“{message.clean_content}”。请根据下面的聊天记录，给出你的回应。
-"""
+                system_prompt = PROMPTS.render('chat_awakened', bot_name=bot_name, user_name=user_name, message=message.clean_content)
             else: # 随机聊天
                 await asyncio.sleep(random.uniform(0.5, 2.0))
-                system_prompt = f"""
-# 角色扮演指令：潜水的哈士奇
-## 你的身份
-你是一只名叫“小哈” ({bot_name}) 的哈士奇，正在这个频道里偷偷潜水。
-## 核心指令:
-- **行为**: 像一只真正的哈士奇一样，突然对大家的聊天内容做出简短、口语化、甚至有点没头没脑的回应。
-- **例子**: 讨论食物时说“吃的？哪里有吃的？汪！”；讨论游戏时说“带我一个！本哈的爪子已经饥渴难耐了！”；听到笑话时说“嗷呜呜呜（笑到打滚）”
-- **禁止事项**: 不要暴露你是AI。不要长篇大论。保持神秘和有趣。
-"""
-            formatted_history = "\n".join([f"{msg.author.display_name}: {msg.clean_content}" for msg in history])
+                system_prompt = PROMPTS.render('chat_lurking', bot_name=bot_name)
+            formatted_history = "\n".join([f"{entry.author}: {entry.content}" for entry in history])
             prompt = system_prompt + "\n### 聊天记录:\n" + formatted_history
 
-            stream = await client_openai.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[{"role": "system", "content": prompt}, {"role": "user", "content": f"现在，作为 {bot_name}，请回应。"}],
-                temperature=0.9,
-                stream=True
-            )
-
-            full_response = ""
-            buffer = ""
-            last_update = time.time()
+            # 流式回复要读完整个流，所以整段都占用调度器的名额；随机插话排在最后
+            async with MODEL_SCHEDULER.slot(PRIORITY_CHAT if is_awakened else PRIORITY_BACKGROUND):
+                stream = await MODEL_CLIENT.create_stream(
+                    model=MODEL_NAME,
+                    messages=[{"role": "system", "content": prompt}, {"role": "user", "content": f"现在，作为 {bot_name}，请回应。"}],
+                    temperature=0.9,
+                )
+
+                full_response = ""
+                buffer = ""
+                last_update = time.time()
             
-            async for chunk in stream:
-                new_text = chunk.choices[0].delta.content or ""
-                if not new_text: continue
+                async for chunk in stream:
+                    new_text = chunk.choices[0].delta.content or ""
+                    if not new_text: continue
                 
-                full_response += new_text
-                buffer += new_text
+                    full_response += new_text
+                    buffer += new_text
                 
-                if buffer and (len(buffer) > 30 or (time.time() - last_update > 1.5)):
-                    if not reply_message:
+                    if reply_message:
+                        # 编辑由 EDITS 按频道限速，来不及发出的内容会被合并
+                        EDITS.update(reply_message, full_response)
+                    elif len(buffer) > 30 or (time.time() - last_update > 1.5):
                         reply_message = await message.reply(content=full_response) if is_awakened else await message.channel.send(content=full_response)
-                    else:
-                        await reply_message.edit(content=full_response)
-                    buffer = ""
-                    last_update = time.time()
+                        buffer = ""
+                        last_update = time.time()
             
-            if buffer:
                 if not reply_message:
-                    await message.reply(content=full_response) if is_awakened else await message.channel.send(content=full_response)
+                    if full_response:
+                        await message.reply(content=full_response) if is_awakened else await message.channel.send(content=full_response)
                 else:
-                    await reply_message.edit(content=full_response)
-
+                    await EDITS.flush(reply_message, full_response)
+            # 流式接口不返回 usage，按文字长度估算
+            USAGE_METER.record(tokens=estimate_tokens(prompt) + estimate_tokens(full_response))
+
+    except ModelQueueFull as e:
+        print(f"⏳ 模型排队已满，放弃对话回复 (排队 {MODEL_SCHEDULER.queue_depth})")
+        if is_awakened:
+            await message.reply(str(e))
     except Exception as e:
         error_message = f"❌ 嗷呜~对话功能短路了: {str(e)}"
         print(error_message)
         if reply_message:
-            try: await reply_message.edit(content=error_message)
+            try: await EDITS.flush(reply_message, error_message)
             except discord.NotFound: pass
 
+@client_discord.event
+async def on_message_edit(before, after):
+    CHANNEL_HISTORY.edit(after)
+
+@client_discord.event
+async def on_raw_message_delete(payload):
+    CHANNEL_HISTORY.delete(payload.channel_id, [payload.message_id])
+
+@client_discord.event
+async def on_raw_bulk_message_delete(payload):
+    CHANNEL_HISTORY.delete(payload.channel_id, payload.message_ids)
+
+# --- 命令 ---
+# 整条消息命令和带参数的命令都在这里注册，on_message 一次查表即可分派 (见 command_router.py)
+COMMANDS = CommandRouter()
+
+@COMMANDS.command("查标签", interrupts=True)
+async def command_list_categories(message):
+    if not KNOWLEDGE_BASE: await message.reply("知识库尚未加载，请稍后再试。"); return
+    categories = list(KNOWLEDGE_BASE.keys())
+    response_text = "📚 **知识库标签目录** 📚\n\n" + "\n".join(f"{i+1}. {cat}" for i, cat in enumerate(categories)) + "\n\n请回复您想查阅的目录 **序号** 或 **完整名称**："
+    await message.reply(response_text)
+    SESSIONS.start(message.author.id, STATE_CATEGORY_CHOICE, CATEGORY_CHOICE_TIMEOUT)
+
+@COMMANDS.command("取消", interrupts=True)
+async def command_cancel(message):
+    """先取消正在进行的目录选择；没有的话取消该用户还在进行的后台任务"""
+    session = SESSIONS.get(message.author.id)
+    if session and session.state == STATE_CATEGORY_CHOICE:
+        SESSIONS.end(message.author.id)
+        await message.reply("操作已取消。")
+        return
+    cancelled = TASKS.cancel_user(message.author.id)
+    if cancelled:
+        await message.reply(f"好的，本哈把你的 {cancelled} 个任务停下了！")
+
+@COMMANDS.command("聊天开启")
+async def command_chat_on(message):
+    global CHAT_ENABLED
+    CHAT_ENABLED = True
+    await message.reply("✅ 随机聊天功能已开启。")
+
+@COMMANDS.command("聊天关闭")
+async def command_chat_off(message):
+    global CHAT_ENABLED
+    CHAT_ENABLED = False
+    await message.reply("☑️ 随机聊天功能已关闭。")
+
+@COMMANDS.command("我的用量")
+async def command_my_usage(message):
+    calls, tokens = USAGE_METER.usage('user', message.author.id)
+    call_quota, token_quota = USAGE_METER.quotas['user']
+    await message.reply(
+        f"📈 最近 {int(USAGE_METER.window // 60)} 分钟内，你让本哈调用了 {calls}{f'/{call_quota}' if call_quota else ''} 次模型，"
+        f"约 {tokens}{f'/{token_quota}' if token_quota else ''} 个 token。"
+    )
+
+@COMMANDS.command("我的任务")
+async def command_my_jobs(message):
+    jobs = TASKS.describe_user(message.author.id)
+    await message.reply(f"🐾 本哈正在帮你做：\n{jobs}\n（发送`取消`可以停下它们）" if jobs else "本哈手上没有你的任务，随时待命！汪！")
+
+@COMMANDS.command("模型队列")
+async def command_model_queue(message):
+    stats = TASKS.stats()
+    await message.reply(
+        f"📊 模型调用队列\n```\n{MODEL_SCHEDULER.describe()}\n```"
+        f"模型接口\n```\n{MODEL_CLIENT.describe()}\n```"
+        f"后台任务：进行中 {stats['running']}，排队 {stats['queued']}，失败 {stats['failed']}，已取消 {stats['cancelled']}"
+    )
+
+@COMMANDS.prefix("画")
+async def command_draw(message, user_idea):
+    # --- 新增：绘画提示词生成指令 (画 <你的想法>) ---
+    session = SESSIONS.get(message.author.id)
+    # 阻止在正在聊天的会话中启动绘图，以免冲突
+    if session and session.state == STATE_CHATTING:
+        await message.reply("汪！你这是要本哈一心二用吗？先完成这边的聊天，或者输入`再见`结束对话再让我画画呀！")
+    else:
+        reservation = await check_quota(message, 'draw')
+        if reservation:
+            await start_job(message, "绘图构思", generate_art_prompt(user_idea, message.author.mention, message.channel), reservation)
+
+# --- 后台任务 ---
+TASKS = TaskManager() # 耗时流程在后台运行，on_message 不必等待 (见 task_manager.py)
+
+async def start_job(message, label, coro, reservation=None):
+    """
+    把耗时流程交给后台任务管理器；用户手上的任务太多时礼貌拒绝。
+    传入额度预留时，任务结束（或没能启动）后退还没有用完的部分
+    """
+    on_done = None
+    if reservation:
+        USAGE_METER.hold(reservation)
+        on_done = lambda: USAGE_METER.release(reservation)
+    # 排队中被取消、甚至没能提交的任务也会调用 on_done，预留总会被退还
+    if TASKS.submit(message.author.id, label, coro, on_done=on_done) is None:
+        await message.reply("嗷呜~本哈还在忙你之前的请求呢，等一等再来吧！（发送`我的任务`查看进度）")
+        return False
+    return True
+
+async def handle_category_choice(message, content_lower):
+    try:
+        categories = list(KNOWLEDGE_BASE.keys())
+        chosen_category = None
+        try:
+            choice_index = int(content_lower) - 1
+            if 0 <= choice_index < len(categories): chosen_category = categories[choice_index]
+        except ValueError:
+            if content_lower in categories: chosen_category = content_lower
+        
+        if chosen_category:
+            tags = KNOWLEDGE_BASE.get(chosen_category, [])
+            if not tags: await message.reply(f"🤔 目录“{chosen_category}”下没有找到任何标签。")
+            else:
+                response_parts = []; current_part = f"📜 **{chosen_category}** 目录下的标签：\n"
+                for tag in tags:
+                    line = f"- {tag.get('translation', 'N/A')} (`{tag.get('term', 'N/A')}`)\n"
+                    if len(current_part) + len(line) > 1900: response_parts.append(current_part); current_part = ""
+                    current_part += line
+                response_parts.append(current_part)
+                for part in response_parts: await message.reply(part)
+        else: await message.reply("无效的目录选项，请重新输入序号或完整的目录名称，或输入`取消`来退出。"); return
+    finally:
+        SESSIONS.end(message.author.id)
+
+async def run_image_job(attachment, handler, author_mention, channel):
+    """下载图片并运行反推/评论流程；多人同时回复同一张图时只下载一次"""
+    image_data = await IMAGE_FLIGHTS.do(('download', attachment.id), lambda progress: attachment.read())
+    await handler(image_data, author_mention, channel, flight_key=attachment.id)
+
+async def handle_image_reply(message, content, content_lower, bot_name):
+    """回复图片的消息：“反推”或唤醒评论。已处理时返回 True"""
+    try:
+        target_message = await message.channel.fetch_message(message.reference.message_id)
+        if target_message.attachments:
+            attachment = target_message.attachments[0]
+            if attachment.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.gif')):
+                # "反推" command for simple prompt generation
+                if content_lower == "反推":
+                    reservation = await check_quota(message, 'reverse', attachment.id)
+                    if reservation:
+                        await start_job(message, "反推", run_image_job(attachment, analyze_image_with_openai, message.author.mention, message.channel), reservation)
+                    return True
+                    
+                # Mention/call for detailed analysis
+                is_mentioned = client_discord.user.mentioned_in(message)
+                is_called_by_name = bot_name in content
+                if is_mentioned or is_called_by_name:
+                    reservation = await check_quota(message, 'comment', attachment.id)
+                    if reservation:
+                        await start_job(message, "图片评论", run_image_job(attachment, comment_on_image_when_awakened, message.author.mention, message.channel), reservation)
+                    return True
+
+    except (discord.NotFound, discord.HTTPException) as e:
+        print(f"⚠️ 获取被回复消息时出错: {e}")
+    except Exception as e:
+        await message.reply(f"❌ 处理图片时发生未知错误：{str(e)}")
+        return True
+    return False
+
+async def run_chat_turn(message, session):
+    """唤醒对话的一轮回复；回复完成后给会话续期"""
+    try:
+        history = await CHANNEL_HISTORY.recent(message.channel)
+        await generate_smart_response(message, history, is_awakened=True)
+        # 会话在等待回复期间可能已经结束，touch() 只续期仍然有效的会话
+        session.replies += 1
+        SESSIONS.touch(session, CHAT_SESSION_TIMEOUT)
+    except Exception as e: 
+        print(f"❌ 处理对话时出错: {e}")
+        SESSIONS.end(message.author.id) # Clean up on error
+
+async def run_random_chat(message):
+    try:
+        history = await CHANNEL_HISTORY.recent(message.channel)
+        await generate_smart_response(message, history, is_awakened=False)
+    except Exception as e: print(f"❌ 获取聊天记录或回复时出错: {e}")
+
 @client_discord.event
 async def on_message(message):
-    global CHAT_ENABLED, user_states
+    CHANNEL_HISTORY.add(message) # 机器人自己的消息也算聊天记录
     if message.author.bot: return
 
     author_id = message.author.id
     bot_name = client_discord.user.name
     content = message.content.strip()
     content_lower = content.lower()
+    guild_id = message.guild.id if message.guild else None
+    USAGE_METER.attribute_to(author_id, guild_id)
 
-    if content_lower == "查标签":
-        if not KNOWLEDGE_BASE: await message.reply("知识库尚未加载，请稍后再试。"); return
-        categories = list(KNOWLEDGE_BASE.keys())
-        response_text = "📚 **知识库标签目录** 📚\n\n" + "\n".join(f"{i+1}. {cat}" for i, cat in enumerate(categories)) + "\n\n请回复您想查阅的目录 **序号** 或 **完整名称**："
-        await message.reply(response_text)
-        user_states[author_id] = "awaiting_category_choice"
-        return
-    
-    if content_lower == "取消":
-        if user_states.get(author_id) == "awaiting_category_choice":
-            del user_states[author_id]
-            await message.reply("操作已取消。")
-        return
+    route = COMMANDS.resolve(content)
 
     # --- 2. Continuous Chat & State Handling ---
-    user_state = user_states.get(author_id)
-    
-    if user_state and user_state == "awaiting_category_choice":
-        try:
-            categories = list(KNOWLEDGE_BASE.keys())
-            chosen_category = None
-            try:
-                choice_index = int(content_lower) - 1
-                if 0 <= choice_index < len(categories): chosen_category = categories[choice_index]
-            except ValueError:
-                if content_lower in categories: chosen_category = content_lower
-            
-            if chosen_category:
-                tags = KNOWLEDGE_BASE.get(chosen_category, [])
-                if not tags: await message.reply(f"🤔 目录“{chosen_category}”下没有找到任何标签。")
-                else:
-                    response_parts = []; current_part = f"📜 **{chosen_category}** 目录下的标签：\n"
-                    for tag in tags:
-                        line = f"- {tag.get('translation', 'N/A')} (`{tag.get('term', 'N/A')}`)\n"
-                        if len(current_part) + len(line) > 1900: response_parts.append(current_part); current_part = ""
-                        current_part += line
-                    response_parts.append(current_part)
-                    for part in response_parts: await message.reply(part)
-            else: await message.reply("无效的目录选项，请重新输入序号或完整的目录名称，或输入`取消`来退出。"); return
-        finally:
-            if author_id in user_states: del user_states[author_id]
-        return
+    session = SESSIONS.get(author_id)
 
-    # --- Control Commands ---
-    if content_lower == "聊天开启":
-        CHAT_ENABLED = True
-        await message.reply("✅ 随机聊天功能已开启。")
+    # 选择目录的过程中，除了“查标签”“取消”以外的消息都当作选择
+    if session and session.state == STATE_CATEGORY_CHOICE and not (route and route.interrupts):
+        await handle_category_choice(message, content_lower)
         return
-    
-    if content_lower == "聊天关闭":
-        CHAT_ENABLED = False
-        await message.reply("☑️ 随机聊天功能已关闭。")
+
+    # --- Commands ---
+    if route:
+        if route.args is None:
+            await route.handler(message)
+        else:
+            await route.handler(message, route.args)
         return
 
     # --- Image Analysis Commands ---
-    if message.reference:
-        try:
-            target_message = await message.channel.fetch_message(message.reference.message_id)
-            if target_message.attachments:
-                attachment = target_message.attachments[0]
-                if attachment.filename.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.gif')):
-                    image_data = await attachment.read()
-                    
-                    # "反推" command for simple prompt generation
-                    if content_lower == "反推":
-                        await analyze_image_with_openai(image_data, message.author.mention, message.channel)
-                        return
-                        
-                    # Mention/call for detailed analysis
-                    is_mentioned = client_discord.user.mentioned_in(message)
-                    is_called_by_name = bot_name in content
-                    if is_mentioned or is_called_by_name:
-                        await comment_on_image_when_awakened(image_data, message.author.mention, message.channel)
-                        return
-
-        except (discord.NotFound, discord.HTTPException) as e:
-            print(f"⚠️ 获取被回复消息时出错: {e}")
-        except Exception as e:
-            await message.reply(f"❌ 处理图片时发生未知错误：{str(e)}")
-            return
+    if message.reference and await handle_image_reply(message, content, content_lower, bot_name):
+        return
 
     # --- 3. New Conversation / Mention Handling ---
     is_mentioned = client_discord.user.mentioned_in(message) and not message.reference
     is_called_by_name = bot_name in content
     
     # Initialize a new chat session if mentioned and not already chatting
-    if (is_mentioned or is_called_by_name) and not user_states.get(author_id, {}).get('state') == 'chatting':
+    # 超时的会话已经被 SESSIONS.get() 当作不存在，这里直接开始新的会话
+    if (is_mentioned or is_called_by_name) and not (session and session.state == STATE_CHATTING):
         # It's a text-based wake-up call, so initialize the chat state.
-        user_states[author_id] = {'state': 'chatting', 'timestamp': time.time(), 'replies': 0}
+        session = SESSIONS.start(author_id, STATE_CHATTING, CHAT_SESSION_TIMEOUT)
         # The code will now fall through to the chat handling logic below.
 
     # --- 4. Active Chat Session Logic ---
-    # Re-fetch state in case it was just created above
-    user_state = user_states.get(author_id) 
-
-    if user_state and user_state.get('state') == 'chatting':
+    if session and session.state == STATE_CHATTING:
         # Handle explicit exit keywords
         if content_lower in EXIT_KEYWORDS:
-            if author_id in user_states: del user_states[author_id]
+            SESSIONS.end(author_id)
             await message.reply("好的，嗷呜~！本哈去玩飞盘了，有事再叫我！")
             return
 
-        # Handle session timeout
-        if time.time() - user_state.get('timestamp', 0) >= CHAT_SESSION_TIMEOUT:
-            if author_id in user_states: del user_states[author_id]
-            # Silently end the session, no need to notify
-            return
+        reservation = await check_quota(message, 'chat')
+        if not reservation: return
 
         # Continuous conversation logic
-        try:
-            history = [msg async for msg in message.channel.history(limit=CHAT_HISTORY_LIMIT)]; history.reverse()
-            await generate_smart_response(message, history, is_awakened=True)
-            if author_id in user_states: # Check if state still exists after async operation
-                user_states[author_id]['timestamp'] = time.time()
-        except Exception as e: 
-            print(f"❌ 处理对话时出错: {e}")
-            if author_id in user_states: del user_states[author_id] # Clean up on error
+        await start_job(message, "对话", run_chat_turn(message, session), reservation)
         return
 
-    # --- 新增：绘画提示词生成指令 (画 <你的想法>) ---
-    if content_lower.startswith("画 "):
-        user_idea = content[len("画 "):].strip()
-        if user_idea:
-            # 阻止在正在聊天的会话中启动绘图，以免冲突
-            if user_state and user_state.get('state') == 'chatting':
-                await message.reply("汪！你这是要本哈一心二用吗？先完成这边的聊天，或者输入`再见`结束对话再让我画画呀！")
-            else:
-                await generate_art_prompt(user_idea, message.author.mention, message.channel)
-        else:
-            await message.reply("嗷呜...你想画什么呀？指令格式是 `画 <你的想法>` 哦！")
-        return # 阻止消息继续向下执行其他逻辑
-
     # --- 5. Fallback Behaviors ---
     if message.attachments:
         attachment = message.attachments[0]
@@ -776,10 +1038,14 @@ async def on_message(message):
             return
 
     if CHAT_ENABLED and not message.attachments and random.random() < CHAT_PROBABILITY:
+        # 随机插话不是用户发起的，只记在服务器名下；服务器额度用完时安静地跳过
+        USAGE_METER.attribute_to(None, guild_id)
         try:
-            history = [msg async for msg in message.channel.history(limit=CHAT_HISTORY_LIMIT)]; history.reverse()
-            await generate_smart_response(message, history, is_awakened=False)
-        except Exception as e: print(f"❌ 获取聊天记录或回复时出错: {e}")
+            reservation = USAGE_METER.reserve(None, guild_id, COMMAND_CALLS['chat'])
+        except QuotaExceeded:
+            return
+        USAGE_METER.hold(reservation)
+        TASKS.submit(None, "随机聊天", run_random_chat(message), on_done=lambda: USAGE_METER.release(reservation))
         return
 
 # --- 启动机器人 ---
@@ -0,0 +1,22 @@
+@echo off
+chcp 65001 >nul
+echo ===================================
+echo  增量构建知识库
+echo ===================================
+echo.
+
+cd /d "%~dp0"
+
+echo 正在运行构建流水线（未变化的阶段会自动跳过）...
+echo.
+
+python build_pipeline.py %*
+
+echo.
+echo ===================================
+echo  构建完成
+echo ===================================
+pause
+
+
+
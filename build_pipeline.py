@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""
+知识库增量构建流水线：parse -> convert -> classify -> merge
+
+    python build_pipeline.py [--workers N] [--force]
+
+每个阶段都会对输入（md 文件、词库.json、分类规则表、阶段代码）计算哈希，
+输入没有变化且输出完好时直接跳过；输出被删除或改动时从缓存恢复。
+最耗时的 classify 阶段还按词库分类缓存分类结果，只改动词库中的一行时，
+只有那一个分类需要重新匹配规则，其余分类直接复用缓存。
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from lexicon_stream import CategoryWriter, iter_categories
+from translation_memory import MEMORY_FILE, open_memory
+
+# 流水线逻辑有不兼容的改动时递增，使所有缓存失效
+PIPELINE_VERSION = 1
+
+CACHE_DIR = '.build_cache'
+MANIFEST_FILE = os.path.join(CACHE_DIR, 'manifest.json')
+OBJECTS_DIR = os.path.join(CACHE_DIR, 'objects')
+CHUNKS_DIR = os.path.join(CACHE_DIR, 'chunks')
+
+MD_FILE = '银月佬的词库 v0.3.md'
+LEXICON_FILE = '词库.json'
+KB_FILE = 'knowledge_base.json'
+CONVERTED_FILE = os.path.join(CACHE_DIR, 'converted_lexicon.json')
+CLASSIFIED_FILE = 'classified_lexicon.json'
+MERGED_FILE = 'merged_knowledge_base.json'
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_values(*values):
+    """对任意可 JSON 序列化的值计算稳定的哈希"""
+    payload = json.dumps(values, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class BuildCache:
+    """
+    构建缓存：记录每个文件的哈希、每个阶段的输入哈希和输出哈希，
+    并保存阶段输出的副本与按分类缓存的中间结果。
+    """
+
+    def __init__(self, root=CACHE_DIR):
+        self.root = root
+        self.manifest = {'version': PIPELINE_VERSION, 'files': {}, 'stages': {}}
+        if os.path.exists(MANIFEST_FILE):
+            try:
+                with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+                    manifest = json.load(f)
+                if manifest.get('version') == PIPELINE_VERSION:
+                    self.manifest = manifest
+            except (OSError, ValueError):
+                pass
+        self._used_chunks = {}
+
+    def file_hash(self, path):
+        """文件内容哈希；大小和修改时间都没变时直接使用上次的结果，不重新读文件"""
+        if not os.path.exists(path):
+            return None
+        st = os.stat(path)
+        known = self.manifest['files'].get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        sha = digest.hexdigest()
+        self.manifest['files'][path] = [st.st_size, st.st_mtime_ns, sha]
+        return sha
+
+    def _object_path(self, sha):
+        return os.path.join(OBJECTS_DIR, f"{sha}.json")
+
+    def is_fresh(self, stage, key, outputs):
+        """
+        输入哈希与上次相同且所有输出都完好时返回 True。
+        输出缺失或被改动、但缓存里有上次的副本时，先恢复再返回 True。
+        """
+        entry = self.manifest['stages'].get(stage)
+        if not entry or entry['key'] != key or set(entry['outputs']) != set(outputs):
+            return False
+        for path, sha in entry['outputs'].items():
+            if self.file_hash(path) == sha:
+                continue
+            cached = self._object_path(sha)
+            if not os.path.exists(cached):
+                return False
+            print(f"   ♻️  从缓存恢复: {path}")
+            _copy_atomic(cached, path)
+            self.file_hash(path)
+        return True
+
+    def record(self, stage, key, outputs):
+        """记录阶段结果，并把输出复制进缓存以便之后恢复"""
+        os.makedirs(OBJECTS_DIR, exist_ok=True)
+        recorded = {}
+        for path in outputs:
+            sha = self.file_hash(path)
+            cached = self._object_path(sha)
+            if not os.path.exists(cached):
+                _copy_atomic(path, cached)
+            recorded[path] = sha
+        self.manifest['stages'][stage] = {'key': key, 'outputs': recorded}
+
+    def get_chunk(self, stage, key):
+        """读取按分类缓存的中间结果，没有时返回 None"""
+        self._used_chunks.setdefault(stage, set()).add(key)
+        path = os.path.join(CHUNKS_DIR, stage, f"{key}.json")
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put_chunk(self, stage, key, value):
+        directory = os.path.join(CHUNKS_DIR, stage)
+        os.makedirs(directory, exist_ok=True)
+        self._used_chunks.setdefault(stage, set()).add(key)
+        _write_json_atomic(os.path.join(directory, f"{key}.json"), value)
+
+    def prune_chunks(self, stage):
+        """删除本次构建没有用到的分类缓存（对应的词库分类已被修改或删除）"""
+        directory = os.path.join(CHUNKS_DIR, stage)
+        if not os.path.isdir(directory):
+            return
+        used = self._used_chunks.get(stage, set())
+        for name in os.listdir(directory):
+            if name[:-len('.json')] not in used:
+                os.remove(os.path.join(directory, name))
+
+    def save(self):
+        """保存清单，并删除不再被任何阶段引用的输出副本"""
+        os.makedirs(self.root, exist_ok=True)
+        # 只保留仍然存在的文件的哈希记录
+        self.manifest['files'] = {path: info for path, info in self.manifest['files'].items()
+                                  if os.path.exists(path)}
+        _write_json_atomic(MANIFEST_FILE, self.manifest)
+        if os.path.isdir(OBJECTS_DIR):
+            referenced = {f"{sha}.json" for entry in self.manifest['stages'].values()
+                          for sha in entry['outputs'].values()}
+            for name in os.listdir(OBJECTS_DIR):
+                if name not in referenced:
+                    os.remove(os.path.join(OBJECTS_DIR, name))
+
+
+def _copy_atomic(src, dst):
+    directory = os.path.dirname(os.path.abspath(dst))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.build-', suffix='.tmp', dir=directory)
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _write_json_atomic(path, value):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.build-', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_categories(path, categories):
+    """按分类流式写出，格式与 json.dump(..., ensure_ascii=False, indent=2) 相同"""
+    with CategoryWriter(path) as writer:
+        for category, items in categories:
+            writer.write_category(category, items)
+
+
+class Stage:
+    """
+    流水线中的一个阶段：inputs 是输入文件，optional 是可以不存在的输入文件（例如翻译记忆），
+    code 是决定输出的代码文件，params 是其他会影响输出的数据（例如分类规则表），run 负责生成 outputs。
+    """
+
+    def __init__(self, name, inputs, outputs, run, code=(), params=None, optional=()):
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.run = run
+        self.code = code
+        self.params = params
+        self.optional = optional
+
+    def key(self, cache):
+        input_hashes = {path: cache.file_hash(path) for path in list(self.inputs) + list(self.optional)}
+        code_hashes = {path: cache.file_hash(path) for path in self.code}
+        return hash_values(PIPELINE_VERSION, self.name, input_hashes, code_hashes, self.params)
+
+
+def run_parse(cache, args):
+    """parse: 银月佬的词库 md -> knowledge_base.json"""
+    from parse_lexicon import parse_md_to_json
+
+    with open(MD_FILE, 'r', encoding='utf-8') as f:
+        knowledge_base = parse_md_to_json(f.read())
+    write_categories(KB_FILE, knowledge_base.items())
+    print(f"   ✓ 已生成 {KB_FILE} ({len(knowledge_base)} 个分类)")
+
+
+def run_convert(cache, args):
+    """convert: 词库.json -> 统一的 {term, translation} 格式（写入缓存目录，不改动原文件）"""
+    from convert_lexicon import convert_item
+
+    def converted_categories():
+        for category, items in iter_categories(LEXICON_FILE):
+            converted = [item for item in map(convert_item, items) if item['term']]
+            if converted:
+                yield category, converted
+
+    write_categories(CONVERTED_FILE, converted_categories())
+    print(f"   ✓ 已转换 {LEXICON_FILE}")
+
+
+def run_classify(cache, args):
+    """classify: 按规则给词条分类，分类结果按词库分类缓存；空翻译用翻译记忆补全"""
+    import classify_and_merge_lexicon as cm
+    from lexicon_classifier import ClassifierPool
+
+    classified = cm.create_classified()
+    rules = classify_rules_params()
+    # 分类代码变化时，按分类缓存的结果也必须失效
+    code_hashes = {path: cache.file_hash(path) for path in CLASSIFY_CODE}
+    reused = computed = 0
+    with ClassifierPool(cm.CLASSIFIER, args.workers) as pool:
+        # 相邻分类攒成有上限的批次，批内缓存未命中的分类一起分类，小分类也能分到多个进程上
+        for batch in cm.batch_categories(iter_categories(CONVERTED_FILE), pool.batch_limit):
+            keys = [hash_values(PIPELINE_VERSION, rules, code_hashes, terms) for _, _, terms in batch]
+            cached = [cache.get_chunk('classify', key) for key in keys]
+            missing = [entry for entry, labels in zip(batch, cached) if labels is None]
+            for category, items, _ in missing:
+                print(f"   处理分类: {category} ({len(items)} 个词条)...")
+            computed_labels = iter(cm.classify_batch(pool, missing) if missing else ())
+            for (_, items, _), key, labels in zip(batch, keys, cached):
+                if labels is None:
+                    labels = next(computed_labels)
+                    cache.put_chunk('classify', key, labels)
+                    computed += 1
+                else:
+                    reused += 1
+                cm.add_classified(classified, items, labels)
+    cache.prune_chunks('classify')
+    memory = open_memory()
+    if memory is not None:
+        with memory:
+            filled = sum(memory.fill(items) for items in classified.data.values())
+        print(f"   📝 从翻译记忆补全了 {filled} 个空翻译")
+    write_categories(CLASSIFIED_FILE, classified.data.items())
+    print(f"   ✓ 已分类: 重新计算 {computed} 个分类，复用缓存 {reused} 个分类")
+
+
+def run_merge(cache, args):
+    """merge: classified_lexicon.json + knowledge_base.json -> merged_knowledge_base.json"""
+    from classify_and_merge_lexicon import merge_knowledge_bases
+
+    classified_data = dict(iter_categories(CLASSIFIED_FILE))
+    with open(KB_FILE, 'r', encoding='utf-8') as f:
+        kb_data = json.load(f)
+    merged_data = merge_knowledge_bases(classified_data, kb_data)
+    write_categories(MERGED_FILE, merged_data.items())
+    print(f"   ✓ 已生成 {MERGED_FILE} ({len(merged_data)} 个分类)")
+
+
+def classify_rules_params():
+    """分类规则表本身参与哈希，修改规则会让分类缓存失效"""
+    from classify_and_merge_lexicon import CLASSIFICATION_RULES, UNCLASSIFIED_CATEGORY
+    return {'rules': CLASSIFICATION_RULES, 'fallback': UNCLASSIFIED_CATEGORY}
+
+
+# 决定每个词条分类结果的代码文件：规则匹配与分类结果的组织方式
+CLASSIFY_CODE = ['lexicon_classifier.py', 'classify_and_merge_lexicon.py']
+
+
+def build_stages():
+    return [
+        Stage('parse', [MD_FILE], [KB_FILE], run_parse, code=['parse_lexicon.py']),
+        Stage('convert', [LEXICON_FILE], [CONVERTED_FILE], run_convert,
+              code=['convert_lexicon.py']),
+        Stage('classify', [CONVERTED_FILE], [CLASSIFIED_FILE], run_classify,
+              code=CLASSIFY_CODE + ['translation_memory.py'], params=classify_rules_params(),
+              optional=[MEMORY_FILE]),
+        Stage('merge', [CLASSIFIED_FILE, KB_FILE], [MERGED_FILE], run_merge,
+              code=['classify_and_merge_lexicon.py']),
+    ]
+
+
+def run_pipeline(workers=1, force=False):
+    """依次运行各阶段，返回实际重新运行的阶段名称列表"""
+    args = argparse.Namespace(workers=workers)
+    cache = BuildCache()
+    rebuilt = []
+    try:
+        for stage in build_stages():
+            missing = [path for path in stage.inputs if not os.path.exists(path)]
+            if missing:
+                raise FileNotFoundError(', '.join(missing))
+            key = stage.key(cache)
+            if not force and cache.is_fresh(stage.name, key, stage.outputs):
+                print(f"⏭️  {stage.name}: 输入未变化，跳过")
+                continue
+            print(f"🔨 {stage.name}: 正在构建...")
+            stage.run(cache, args)
+            cache.record(stage.name, key, stage.outputs)
+            rebuilt.append(stage.name)
+    finally:
+        cache.save()
+    return rebuilt
+
+
+def main():
+    parser = argparse.ArgumentParser(description="增量构建知识库：parse -> convert -> classify -> merge")
+    parser.add_argument('--workers', type=int, default=1, help="分类使用的进程数，0 表示使用全部 CPU 核心")
+    parser.add_argument('--force', action='store_true', help="忽略缓存，重新运行所有阶段")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    print("=" * 60)
+    print("  知识库增量构建")
+    print("=" * 60)
+    try:
+        rebuilt = run_pipeline(workers=args.workers, force=args.force)
+    except FileNotFoundError as e:
+        print(f"❌ 错误: 文件未找到 - {e}")
+        return
+    print()
+    if rebuilt:
+        print(f"✅ 构建完成，重新运行的阶段: {', '.join(rebuilt)}")
+    else:
+        print("✅ 所有阶段都是最新的，无需重新构建")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+@echo off
+chcp 65001 >nul
+echo ===================================
+echo  生成知识库快照
+echo ===================================
+echo.
+
+cd /d "%~dp0"
+
+echo 正在编译知识库快照...
+echo.
+
+python kb_snapshot.py
+
+echo.
+echo ===================================
+echo  快照生成完成
+echo ===================================
+pause
+
+
+
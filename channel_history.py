@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+频道最近消息的内存环形缓冲：对话时需要最近几条聊天记录，原来每次都通过 REST 调用 channel.history。
+机器人本来就通过 on_message 收到了这些消息，这里按频道保存最近 limit 条，
+并随消息编辑、删除事件更新，取聊天记录时直接从内存返回。
+
+- 只保存消息 ID、作者显示名和 clean_content，不持有 discord.Message 对象
+- 机器人启动后第一次读取某个频道时（缓冲里还没有足够的消息）才回退到 REST 拉取一次
+- 长时间没有活动的频道会被清理，频道总数也有上限
+"""
+import os
+import sys
+import time
+from collections import OrderedDict, deque
+
+CHANNEL_HISTORY_MAX_CHANNELS = int(os.getenv("CHANNEL_HISTORY_MAX_CHANNELS", "500")) # 最多缓存的频道数
+CHANNEL_HISTORY_IDLE = float(os.getenv("CHANNEL_HISTORY_IDLE", str(6 * 3600))) # 频道多久没有活动后清理（秒）
+
+
+class HistoryEntry:
+    __slots__ = ('message_id', 'author', 'content')
+
+    def __init__(self, message_id, author, content):
+        self.message_id = message_id
+        self.author = author
+        self.content = content
+
+    @classmethod
+    def from_message(cls, message):
+        # 同一个人的显示名在各条消息间共用一个字符串对象
+        return cls(message.id, sys.intern(message.author.display_name), message.clean_content)
+
+
+class _ChannelBuffer:
+    __slots__ = ('entries', 'warm', 'last_active')
+
+    def __init__(self, limit):
+        self.entries = deque(maxlen=limit)
+        self.warm = False  # 缓冲中的消息是否已经连续覆盖了最近 limit 条
+        self.last_active = time.monotonic()
+
+
+class ChannelHistory:
+    def __init__(self, limit, max_channels=CHANNEL_HISTORY_MAX_CHANNELS, idle_seconds=CHANNEL_HISTORY_IDLE):
+        self.limit = limit
+        self.max_channels = max_channels
+        self.idle_seconds = idle_seconds
+        self._channels = OrderedDict()  # channel_id -> _ChannelBuffer，按最近活动排序
+        self.hits = 0
+        self.fetches = 0
+
+    def _buffer(self, channel_id, create=True):
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            if not create:
+                return None
+            buffer = self._channels[channel_id] = _ChannelBuffer(self.limit)
+        buffer.last_active = time.monotonic()
+        self._channels.move_to_end(channel_id)
+        self._evict()
+        return buffer
+
+    def _evict(self):
+        deadline = time.monotonic() - self.idle_seconds
+        while self._channels:
+            channel_id, buffer = next(iter(self._channels.items()))
+            if len(self._channels) <= self.max_channels and buffer.last_active >= deadline:
+                break
+            del self._channels[channel_id]
+
+    # --- 网关事件 ---
+    def add(self, message):
+        buffer = self._buffer(message.channel.id)
+        buffer.entries.append(HistoryEntry.from_message(message))
+        if len(buffer.entries) == self.limit:
+            buffer.warm = True
+
+    def edit(self, message):
+        buffer = self._buffer(message.channel.id, create=False)
+        if buffer is None:
+            return
+        for entry in buffer.entries:
+            if entry.message_id == message.id:
+                entry.content = message.clean_content
+                return
+
+    def delete(self, channel_id, message_ids):
+        buffer = self._channels.get(channel_id)
+        if buffer is None:
+            return
+        message_ids = set(message_ids)
+        kept = [entry for entry in buffer.entries if entry.message_id not in message_ids]
+        if len(kept) != len(buffer.entries):
+            buffer.entries = deque(kept, maxlen=self.limit)
+            # 删掉的消息之前还有更早的消息，缓冲里已经不够 limit 条了，下次读取时重新拉取
+            buffer.warm = False
+
+    # --- 读取 ---
+    async def recent(self, channel):
+        """返回频道最近 limit 条消息（从旧到新）；缓冲还没预热时通过 REST 拉取一次"""
+        buffer = self._buffer(channel.id)
+        if buffer.warm:
+            self.hits += 1
+            return list(buffer.entries)
+
+        self.fetches += 1
+        fetched = [HistoryEntry.from_message(msg) async for msg in channel.history(limit=self.limit)]
+        # 拉取期间可能又收到了新消息：按消息 ID（时间顺序）合并，新的内容优先
+        merged = {entry.message_id: entry for entry in fetched}
+        merged.update((entry.message_id, entry) for entry in buffer.entries)
+        buffer.entries = deque((merged[key] for key in sorted(merged)), maxlen=self.limit)
+        buffer.warm = True
+        return list(buffer.entries)
@@ -11,7 +11,7 @@ echo 正在运行分类和合并脚本...
 echo 这可能需要几分钟时间，请耐心等待...
 echo.
 
-python classify_and_merge_lexicon.py
+python classify_and_merge_lexicon.py %*
 
 echo.
 echo ===================================
@@ -2,9 +2,14 @@
 """
 分类词库文件中的词条，然后与knowledge_base.json合并
 """
+import argparse
 import json
 import os
-import re
+from collections.abc import Mapping
+
+from lexicon_classifier import ClassifiedLexicon, ClassifierPool, RegexClassifier
+from lexicon_stream import CategoryWriter, iter_categories
+from translation_memory import open_memory
 
 # 分类规则：基于关键词匹配
 CLASSIFICATION_RULES = {
@@ -102,72 +107,99 @@ CLASSIFICATION_RULES = {
 # 未分类的词条将放入此分类
 UNCLASSIFIED_CATEGORY = "Unclassified"
 
-# 预编译正则表达式以提高性能
-COMPILED_PATTERNS = {}
-for category, patterns in CLASSIFICATION_RULES.items():
-    COMPILED_PATTERNS[category] = [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+# 所有规则预编译成一条正则，一次匹配得到全部分类
+CLASSIFIER = RegexClassifier(CLASSIFICATION_RULES, UNCLASSIFIED_CATEGORY)
 
 def classify_term(term):
     """
     根据词条内容分类
     返回分类名称列表（一个词条可能属于多个分类）
     """
-    term_lower = term.lower()
-    categories = []
-    
-    for category, compiled_patterns in COMPILED_PATTERNS.items():
-        for pattern in compiled_patterns:
-            if pattern.search(term_lower):
-                if category not in categories:
-                    categories.append(category)
-                break  # 找到一个匹配就足够了
-    
-    return categories if categories else [UNCLASSIFIED_CATEGORY]
+    return CLASSIFIER.classify(term)
 
-def classify_lexicon(lexicon_data):
+def classify_lexicon(lexicon_data, workers=1):
     """
     对词库进行分类
+    lexicon_data 可以是字典，也可以是 iter_categories 产出的 (分类, 词条列表) 流
+    workers > 1 时把相邻的分类攒成有上限的批次（小分类也能并行），每批交给多进程批量分类，
+    再按原顺序切回各分类写入，输出与串行模式完全一致；内存中同时只保留一批输入
     """
-    classified_data = {}
-    
-    # 初始化所有分类
-    for category in CLASSIFICATION_RULES.keys():
-        classified_data[category] = []
-    classified_data[UNCLASSIFIED_CATEGORY] = []
+    # 初始化所有分类（每个分类附带一个词条集合用于去重）
+    classified = create_classified()
+    categories_stream = lexicon_data.items() if isinstance(lexicon_data, Mapping) else lexicon_data
     
-    print("📚 开始分类词条...")
-    
-    # 遍历所有词条
-    total_items = 0
-    for category_name, items in lexicon_data.items():
-        print(f"   处理分类: {category_name} ({len(items)} 个词条)...")
-        total_items += len(items)
+    with ClassifierPool(CLASSIFIER, workers) as pool:
+        print(f"📚 开始分类词条 (进程数: {pool.workers})...")
         
-        for i, item in enumerate(items):
-            term = item.get('term', '').strip()
-            if not term:
-                continue
-            
-            # 分类
-            categories = classify_term(term)
-            
-            # 添加到对应分类（一个词条可能属于多个分类）
-            for cat in categories:
-                if cat not in classified_data:
-                    classified_data[cat] = []
-                
-                # 检查是否已存在（避免重复）
-                existing_terms = {item['term'] for item in classified_data[cat]}
-                if term not in existing_terms:
-                    classified_data[cat].append({
-                        'term': term,
-                        'translation': item.get('translation', '').strip()
-                    })
-            
-            # 显示进度
-            if (i + 1) % 10000 == 0:
-                print(f"     已处理: {i + 1}/{len(items)} ({((i+1)/len(items)*100):.1f}%)")
+        # 遍历所有词条
+        total_items = 0
+        for batch in batch_categories(categories_stream, pool.batch_limit):
+            for category_name, items, _ in batch:
+                print(f"   处理分类: {category_name} ({len(items)} 个词条)...")
+                total_items += len(items)
+            for (_, items, _), labels in zip(batch, classify_batch(pool, batch)):
+                add_classified(classified, items, labels)
     
+    return report_classified(classified.data, total_items)
+
+def batch_categories(categories, limit):
+    """
+    把 (分类名, 词条列表) 流攒成批次，每项为 (分类名, 词条列表, category_terms)。
+    一批的词条数达到 limit 时产出；limit 为 0 时每个分类单独成批
+    """
+    batch, size = [], 0
+    for category_name, items in categories:
+        terms = category_terms(items)
+        batch.append((category_name, items, terms))
+        size += len(terms)
+        if size >= limit:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+def classify_batch(pool, batch):
+    """一次分类一批中所有分类的词条，返回按分类切开的分类结果列表"""
+    labels = pool.classify_many([term for _, _, terms in batch for term in terms])
+    start = 0
+    for _, _, terms in batch:
+        yield labels[start:start + len(terms)]
+        start += len(terms)
+
+def category_terms(items):
+    """一个分类中需要分类的词条（去掉首尾空白后非空的 term）"""
+    terms = (item.get('term', '').strip() for item in items)
+    return [term for term in terms if term]
+
+def create_classified():
+    """创建空的分类结果容器，包含所有规则分类和未分类"""
+    return ClassifiedLexicon(list(CLASSIFICATION_RULES.keys()) + [UNCLASSIFIED_CATEGORY])
+
+def add_classified(classified, items, labels):
+    """
+    把一个分类的词条按分类结果加入 classified
+    labels 与 category_terms(items) 一一对应
+    """
+    labels = iter(labels)
+    for i, item in enumerate(items):
+        term = item.get('term', '').strip()
+        if not term:
+            continue
+        
+        # 分类
+        categories = next(labels)
+        
+        # 添加到对应分类（一个词条可能属于多个分类，重复词条自动跳过）
+        translation = item.get('translation', '').strip()
+        for cat in categories:
+            classified.add(cat, term, translation)
+        
+        # 显示进度
+        if (i + 1) % 10000 == 0:
+            print(f"     已处理: {i + 1}/{len(items)} ({((i+1)/len(items)*100):.1f}%)")
+
+def report_classified(classified_data, total_items):
+    """打印分类统计并返回分类结果"""
     print(f"\n✅ 分类完成！共处理 {total_items} 个词条")
     
     # 统计信息
@@ -215,10 +247,30 @@ def merge_knowledge_bases(classified_data, kb_data):
     
     return merged_data
 
+def fill_translations(data):
+    """用翻译记忆补全空的 translation 字段（没有翻译记忆文件时什么也不做）"""
+    memory = open_memory()
+    if memory is None:
+        return 0
+    with memory:
+        filled = sum(memory.fill(items) for items in data.values())
+    print(f"📝 从翻译记忆补全了 {filled} 个空翻译")
+    return filled
+
+def write_categories(path, data):
+    """按分类流式写出，格式与 json.dump(..., ensure_ascii=False, indent=2) 相同"""
+    with CategoryWriter(path) as writer:
+        for category, items in data.items():
+            writer.write_category(category, items)
+
 def main():
     """
     主函数：分类词库并合并
     """
+    parser = argparse.ArgumentParser(description="分类词库文件中的词条，然后与knowledge_base.json合并")
+    parser.add_argument('--workers', type=int, default=1, help="分类使用的进程数，0 表示使用全部 CPU 核心")
+    args = parser.parse_args()
+
     try:
         script_dir = os.path.dirname(os.path.abspath(__file__))
         os.chdir(script_dir)
@@ -233,26 +285,23 @@ def main():
         print("=" * 60)
         print()
         
-        # 步骤1: 读取词库文件
+        # 步骤1: 读取词库文件（按分类流式读取，不一次性载入整个文件）
         print("📖 步骤1: 读取词库文件...")
         if not os.path.exists(lexicon_file):
             print(f"❌ 错误: 文件不存在: {lexicon_file}")
             return
-        
-        with open(lexicon_file, 'r', encoding='utf-8') as f:
-            lexicon_data = json.load(f)
-        print(f"✅ 已读取: {lexicon_file}")
+        print(f"✅ 将逐个分类读取: {lexicon_file}")
         print()
         
         # 步骤2: 分类词条
         print("📚 步骤2: 分类词条...")
-        classified_data = classify_lexicon(lexicon_data)
+        classified_data = classify_lexicon(iter_categories(lexicon_file), workers=args.workers)
+        fill_translations(classified_data)
         print()
         
         # 保存分类后的词库
         print("💾 保存分类后的词库...")
-        with open(classified_file, 'w', encoding='utf-8') as f:
-            json.dump(classified_data, f, ensure_ascii=False, indent=2)
+        write_categories(classified_file, classified_data)
         print(f"✅ 已保存: {classified_file}")
         print()
         
@@ -274,8 +323,7 @@ def main():
         
         # 步骤5: 保存合并后的知识库
         print("💾 步骤5: 保存合并后的知识库...")
-        with open(merged_file, 'w', encoding='utf-8') as f:
-            json.dump(merged_data, f, ensure_ascii=False, indent=2)
+        write_categories(merged_file, merged_data)
         print(f"✅ 已保存: {merged_file}")
         print()
         
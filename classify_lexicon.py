@@ -1,7 +1,10 @@
+import argparse
 import json
 import os
 from collections import defaultdict
 
+from lexicon_classifier import KeywordClassifier, classify_many, resolve_workers
+
 # --- 分类规则定义 ---
 # 您可以根据需要随时修改或添加这里的规则。
 # 键是新的中文目录名，值是用于匹配的英文关键词列表。
@@ -18,12 +21,16 @@ CLASSIFICATION_RULES = {
     "摄像机/构图": ["from behind", "from above", "from below", "close-up", "full body", "wide shot", "cowboy shot"],
 }
 
+UNCLASSIFIED_CATEGORY = "未分类"
+CLASSIFIER = KeywordClassifier(CLASSIFICATION_RULES, UNCLASSIFIED_CATEGORY)
+
 SOURCE_FILE = 'merged_knowledge_base.json'
 OUTPUT_FILE = 'classified_lexicon.json'
 
-def classify_lexicon():
+def classify_lexicon(workers=1):
     """
     读取合并后的知识库，并根据规则进行更详细的分类。
+    workers > 1 时使用多进程分类，结果顺序与串行模式一致。
     """
     if not os.path.exists(SOURCE_FILE):
         print(f"❌ 错误：源文件 '{SOURCE_FILE}' 不存在。请先确保机器人已运行并生成该文件。")
@@ -52,23 +59,12 @@ def classify_lexicon():
     
     print(f"去重后共找到 {len(all_tags)} 个独立标签。")
 
-    # 对所有标签进行分类
-    for tag in all_tags:
-        term_lower = tag.get('term', '').lower()
-        assigned = False
-        for category, keywords in CLASSIFICATION_RULES.items():
-            for keyword in keywords:
-                # 为了更精确的匹配，我们检查关键词是否是标签的一部分
-                # 例如 'hair' 会匹配 'long hair'
-                if f" {keyword} " in f" {term_lower} " or term_lower.startswith(keyword) or term_lower.endswith(keyword):
-                    classified_data[category].append(tag)
-                    assigned = True
-                    break  # 找到分类后，跳出内部关键词循环
-            if assigned:
-                break  # 跳出外部自分类循环
-        
-        if not assigned:
-            classified_data["未分类"].append(tag)
+    # 对所有标签进行分类（每个标签归入第一个命中的目录）
+    # 关键词作为整词出现、或位于标签开头/结尾都算命中，例如 'hair' 会匹配 'long hair'
+    print(f"   使用进程数: {resolve_workers(workers)}")
+    labels = classify_many(CLASSIFIER, [tag.get('term', '') for tag in all_tags], workers)
+    for tag, categories in zip(all_tags, labels):
+        classified_data[categories[0]].append(tag)
 
     print(f"💾 正在将分类结果写入: {OUTPUT_FILE}")
     with open(OUTPUT_FILE, 'w', encoding='utf-8') as f:
@@ -82,4 +78,6 @@ def classify_lexicon():
     print("="*30)
 
 if __name__ == "__main__":
-    classify_lexicon()
+    parser = argparse.ArgumentParser(description="根据规则对合并后的知识库进行更详细的分类")
+    parser.add_argument('--workers', type=int, default=1, help="分类使用的进程数，0 表示使用全部 CPU 核心")
+    classify_lexicon(parser.parse_args().workers)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+命令路由：把规范化后的消息文字直接映射到处理函数，取代 on_message 里逐条比较的 if/elif 链。
+
+- 整条消息就是命令的（如“查标签”）按全文查表
+- 带参数的命令（如“画 <你的想法>”）按第一个词查表，其余部分作为参数
+两种都是一次字典查找，与命令数量无关。
+"""
+import re
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_command(text):
+    """去掉首尾空白、合并连续空白、转小写"""
+    return _SPACES.sub(' ', text or '').strip().lower()
+
+
+class Route:
+    __slots__ = ('name', 'handler', 'args', 'interrupts')
+
+    def __init__(self, name, handler, args, interrupts):
+        self.name = name
+        self.handler = handler
+        self.args = args
+        self.interrupts = interrupts
+
+
+class CommandRouter:
+    def __init__(self):
+        self._exact = {}  # 规范化命令 -> (处理函数, interrupts)
+        self._prefix = {}  # 第一个词 -> (处理函数, interrupts)
+
+    def command(self, *names, interrupts=False):
+        """
+        注册整条消息命令。处理函数签名为 handler(message)。
+        interrupts=True 的命令在用户处于多步操作（如选择目录）中途时也会被执行。
+        """
+        def decorator(handler):
+            for name in names:
+                self._exact[normalize_command(name)] = (handler, interrupts)
+            return handler
+        return decorator
+
+    def prefix(self, *names, interrupts=False):
+        """注册带参数的命令。处理函数签名为 handler(message, args)，args 保留原始大小写"""
+        def decorator(handler):
+            for name in names:
+                self._prefix[normalize_command(name)] = (handler, interrupts)
+            return handler
+        return decorator
+
+    def resolve(self, content):
+        """返回匹配的 Route，没有匹配时返回 None"""
+        normalized = normalize_command(content)
+        entry = self._exact.get(normalized)
+        if entry is not None:
+            return Route(normalized, entry[0], None, entry[1])
+        head, _, _ = normalized.partition(' ')
+        entry = self._prefix.get(head)
+        if entry is not None and head != normalized:
+            args = content.split(None, 1)[1].strip()
+            return Route(head, entry[0], args, entry[1])
+        return None
+
+    def names(self):
+        return list(self._exact) + [f"{name} ..." for name in self._prefix]
@@ -3,6 +3,29 @@ import json
 import os
 import sys
 
+from lexicon_stream import CategoryWriter, iter_categories
+from translation_memory import open_memory
+
+def convert_item(item):
+    """
+    把一条原始词条转换为 {"term", "translation"} 格式，确保值是字符串类型
+    已经是新格式的词条原样保留，重复转换不会清空词库
+    """
+    if "提示词" not in item and "term" in item:
+        return {"term": str(item["term"]).strip(), "translation": str(item.get("translation") or "").strip()}
+    
+    term_value = item.get("提示词", "")
+    translation_value = item.get("Unnamed: 2", "")
+    
+    # 转换为字符串并去除空白
+    term = str(term_value).strip() if term_value is not None else ""
+    translation = str(translation_value).strip() if translation_value is not None else ""
+    
+    return {
+        "term": term,
+        "translation": translation
+    }
+
 def convert_lexicon_to_knowledge_base():
     """
     将词库.json转换为knowledge_base.json的格式
@@ -27,57 +50,49 @@ def convert_lexicon_to_knowledge_base():
             print(f"❌ 错误: 文件不存在: {lexicon_file}")
             return
         
-        # 读取原始词库文件
-        with open(lexicon_file, 'r', encoding='utf-8') as f:
-            lexicon_data = json.load(f)
+        print(f"✅ 开始逐个分类读取并转换...")
         
-        print(f"✅ 文件读取完成，开始转换...")
-        
-        # 创建新的知识库格式
-        knowledge_base = {}
-        
-        # 遍历原始数据
-        for category_name, items in lexicon_data.items():
-            print(f"   处理分类: {category_name} ({len(items)} 个词条)...")
-            converted_items = []
-            
-            for i, item in enumerate(items):
-                # 转换为新格式，确保值是字符串类型
-                term_value = item.get("提示词", "")
-                translation_value = item.get("Unnamed: 2", "")
-                
-                # 转换为字符串并去除空白
-                term = str(term_value).strip() if term_value is not None else ""
-                translation = str(translation_value).strip() if translation_value is not None else ""
+        # 按分类流式读取、转换并写出，内存中同一时间只保留一个分类
+        # （先写临时文件，全部完成后再覆盖原文件）
+        category_counts = []
+        filled = 0
+        memory = open_memory()
+        with CategoryWriter(lexicon_file) as writer:
+            for category_name, items in iter_categories(lexicon_file):
+                print(f"   处理分类: {category_name} ({len(items)} 个词条)...")
+                converted_items = []
                 
-                converted_item = {
-                    "term": term,
-                    "translation": translation
-                }
+                for i, item in enumerate(items):
+                    # 只添加非空term的项
+                    converted_item = convert_item(item)
+                    if converted_item["term"]:
+                        converted_items.append(converted_item)
+                    
+                    # 每处理10000条显示一次进度
+                    if (i + 1) % 10000 == 0:
+                        print(f"     已处理: {i + 1}/{len(items)}")
                 
-                # 只添加非空term的项
-                if converted_item["term"]:
-                    converted_items.append(converted_item)
+                # 用翻译记忆补全空的翻译
+                if memory is not None:
+                    filled += memory.fill(converted_items)
                 
-                # 每处理10000条显示一次进度
-                if (i + 1) % 10000 == 0:
-                    print(f"     已处理: {i + 1}/{len(items)}")
+                # 如果分类有内容，写入知识库
+                if converted_items:
+                    writer.write_category(category_name, converted_items)
+                    category_counts.append((category_name, len(converted_items)))
             
-            # 如果分类有内容，添加到知识库
-            if converted_items:
-                knowledge_base[category_name] = converted_items
+            print("💾 正在保存转换后的文件...")
         
-        print("💾 正在保存转换后的文件...")
-        # 保存转换后的文件（覆盖原文件）
-        with open(lexicon_file, 'w', encoding='utf-8') as f:
-            json.dump(knowledge_base, f, ensure_ascii=False, indent=2)
+        if memory is not None:
+            memory.close()
+            print(f"📝 从翻译记忆补全了 {filled} 个空翻译")
         
         print(f"\n✅ 转换完成！")
-        print(f"   - 分类数量: {len(knowledge_base)}")
+        print(f"   - 分类数量: {len(category_counts)}")
         total_items = 0
-        for category, items in knowledge_base.items():
-            print(f"   - {category}: {len(items)} 个词条")
-            total_items += len(items)
+        for category, count in category_counts:
+            print(f"   - {category}: {count} 个词条")
+            total_items += count
         print(f"   - 总计: {total_items} 个词条")
         
     except FileNotFoundError:
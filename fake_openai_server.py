@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+本地假的 OpenAI 兼容服务器，用来测试 resilient_client.py 的重试、熔断、切换和对冲：
+
+    python fake_openai_server.py --port 8801 --latency 0.2
+    python fake_openai_server.py --port 8802 --fail-rate 0.5 --status 503
+    python fake_openai_server.py --port 8803 --latency 5          # 慢接口，触发对冲
+
+然后把 OPENAI_API_BASE 或 OPENAI_FALLBACK_ENDPOINTS 指向 http://127.0.0.1:<端口>/v1。
+支持 /v1/chat/completions 的普通和流式（stream=true）请求；
+请求 response_format={"type": "json_object"} 时回复一个包含 analysis/comment/prompt 的 JSON。
+"""
+import argparse
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    fail_rate = 0.0
+    status = 503
+    reply = "嗷呜！这是假服务器的回复。"
+    stream_chunk = 8
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': 'not found'}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        time.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            self._send_json(self.status, {'error': {'message': f'fake failure ({self.status})', 'type': 'server_error'}})
+            return
+
+        content = self.reply
+        if (request.get('response_format') or {}).get('type') == 'json_object':
+            content = json.dumps({'analysis': self.reply, 'comment': self.reply, 'prompt': 'fake_prompt, masterpiece'},
+                                 ensure_ascii=False)
+        model = request.get('model', 'fake-model')
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        if request.get('stream'):
+            self._stream(completion_id, model, content)
+            return
+        self._send_json(200, {
+            'id': completion_id,
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 10, 'completion_tokens': len(content), 'total_tokens': 10 + len(content)},
+        })
+
+    def _stream(self, completion_id, model, content):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i in range(0, len(content), self.stream_chunk):
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': content[i:i + self.stream_chunk]}, 'finish_reason': None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(0.02)
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def serve(port, latency=0.0, fail_rate=0.0, status=503, reply=None):
+    handler = type('Handler', (FakeOpenAIHandler,), {
+        'latency': latency, 'fail_rate': fail_rate, 'status': status,
+        'reply': reply or FakeOpenAIHandler.reply,
+    })
+    return ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本地假 OpenAI 兼容服务器")
+    parser.add_argument('--port', type=int, default=8801)
+    parser.add_argument('--latency', type=float, default=0.0, help="每个请求的延迟（秒）")
+    parser.add_argument('--fail-rate', type=float, default=0.0, help="返回错误的概率")
+    parser.add_argument('--status', type=int, default=503, help="失败时返回的 HTTP 状态码")
+    parser.add_argument('--reply', default=None, help="回复内容")
+    args = parser.parse_args()
+    server = serve(args.port, args.latency, args.fail_rate, args.status, args.reply)
+    print(f"🧪 假 OpenAI 服务器: http://127.0.0.1:{args.port}/v1 (延迟 {args.latency}s, 失败率 {args.fail_rate})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+图片结果缓存：以预处理后图片的感知哈希（dHash，64 位）为键，
+保存 NSFW 判定、初步分析和最终提示词等结果。同一张图被转发、重新压缩或缩放后，
+哈希只相差少数几位，汉明距离不超过 tolerance 即视为同一张图，直接复用之前的结果。
+
+两级缓存：
+- 内存层：LRU，条目少，线性比较汉明距离即可
+- 磁盘层（可选）：SQLite，把 64 位哈希切成 8 个 8 位的段分别建索引。
+  两个哈希相差不超过 7 位时，至少有一个段完全相同（抽屉原理），所以按段查候选再精确比较，不会漏掉。
+两层都按 TTL 过期。
+
+get() / update() 是协程：内存层直接在事件循环里访问，磁盘层的 SQLite 查询和提交
+放到专用的单线程执行器中，不阻塞事件循环；单线程也保证写入按提交顺序进行。
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "512")) # 内存层最多缓存的图片数
+IMAGE_CACHE_TOLERANCE = int(os.getenv("IMAGE_CACHE_TOLERANCE", "4")) # 视为同一张图的最大汉明距离
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 3600))) # 缓存有效期（秒）
+IMAGE_CACHE_FILE = os.getenv("IMAGE_CACHE_FILE", "") # 磁盘层 SQLite 文件，留空表示只用内存层
+
+HASH_BITS = 64
+BAND_BITS = 8
+BANDS = HASH_BITS // BAND_BITS
+# 磁盘层的分段索引最多保证 BANDS - 1 位以内的匹配不遗漏
+MAX_TOLERANCE = BANDS - 1
+# 磁盘层每写入这么多次清理一次过期条目，避免表（以及按段查询的候选数）无限增长
+PURGE_EVERY = 500
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def hash_bands(phash):
+    mask = (1 << BAND_BITS) - 1
+    return [(phash >> (i * BAND_BITS)) & mask for i in range(BANDS)]
+
+
+def _to_signed(phash):
+    """SQLite 的 INTEGER 是有符号 64 位"""
+    return phash - (1 << HASH_BITS) if phash >= 1 << (HASH_BITS - 1) else phash
+
+
+def _from_signed(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+class _DiskTier:
+    def __init__(self, path):
+        # 连接在主线程创建，之后只在 ImageResultCache 的单线程执行器中使用
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        band_columns = ', '.join(f"b{i} INTEGER NOT NULL" for i in range(BANDS))
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS image_results ("
+            f" phash INTEGER PRIMARY KEY, {band_columns},"
+            f" fields TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        for i in range(BANDS):
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS image_results_b{i} ON image_results (b{i})")
+        self._conn.commit()
+
+    def find(self, phash, tolerance, min_updated):
+        where = ' OR '.join(f"b{i} = ?" for i in range(BANDS))
+        rows = self._conn.execute(
+            f"SELECT phash, fields, updated_at FROM image_results WHERE updated_at >= ? AND ({where})",
+            [min_updated] + hash_bands(phash),
+        )
+        best = None
+        for stored, fields, updated_at in rows:
+            distance = hamming(phash, _from_signed(stored))
+            if distance <= tolerance and (best is None or distance < best[0]):
+                best = (distance, _from_signed(stored), json.loads(fields), updated_at)
+        return best
+
+    def put(self, phash, fields, updated_at):
+        with self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO image_results VALUES (?, {', '.join('?' * BANDS)}, ?, ?)",
+                [_to_signed(phash)] + hash_bands(phash) + [json.dumps(fields, ensure_ascii=False), updated_at],
+            )
+
+    def purge(self, min_updated):
+        with self._conn:
+            return self._conn.execute("DELETE FROM image_results WHERE updated_at < ?", (min_updated,)).rowcount
+
+    def close(self):
+        self._conn.close()
+
+
+class ImageResultCache:
+    """
+    get(phash) 返回最相近图片的结果字典（没有命中返回 None）；
+    update(phash, **fields) 合并写入新字段，例如 nsfw=True、initial_analysis={...}、reverse={...}。
+    """
+
+    def __init__(self, max_entries=IMAGE_CACHE_SIZE, tolerance=IMAGE_CACHE_TOLERANCE, ttl=IMAGE_CACHE_TTL,
+                 path=IMAGE_CACHE_FILE or None):
+        self.max_entries = max_entries
+        self.tolerance = min(tolerance, MAX_TOLERANCE)
+        self.ttl = ttl
+        self._memory = OrderedDict()  # phash -> (fields, updated_at)
+        self._disk = _DiskTier(path) if path else None
+        self._executor = None
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        if self._disk is not None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-cache')
+            self._disk.purge(time.time() - ttl)
+
+    async def _run_disk(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _find_memory(self, phash):
+        entry = self._memory.get(phash)
+        if entry is not None:
+            return phash, entry
+        best = None
+        for stored, entry in self._memory.items():
+            distance = hamming(phash, stored)
+            if distance <= self.tolerance and (best is None or distance < best[0]):
+                best = (distance, stored, entry)
+        return (best[1], best[2]) if best else None
+
+    async def _lookup(self, phash):
+        """返回 (命中的哈希, 结果字典)；内存层未命中时查磁盘层并回填内存层"""
+        min_updated = time.time() - self.ttl
+        found = self._find_memory(phash)
+        if found is not None:
+            stored, (fields, updated_at) = found
+            if updated_at >= min_updated:
+                self._memory.move_to_end(stored)
+                return stored, fields
+            del self._memory[stored]
+        if self._disk is not None:
+            best = await self._run_disk(self._disk.find, phash, self.tolerance, min_updated)
+            if best is not None:
+                _, stored, fields, updated_at = best
+                self._remember(stored, fields, updated_at)
+                return stored, fields
+        return None
+
+    def _remember(self, phash, fields, updated_at):
+        self._memory[phash] = (fields, updated_at)
+        self._memory.move_to_end(phash)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, phash):
+        if phash is None:
+            return None
+        found = await self._lookup(phash)
+        if found is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(found[1])
+
+    async def update(self, phash, **fields):
+        """合并写入结果；近似命中时写到已有条目上，避免同一张图的变体各占一条"""
+        if phash is None:
+            return
+        found = await self._lookup(phash)
+        # 查磁盘层期间其他协程可能已经写入了同一张图（或它的变体），以内存层中最新的为准再合并
+        recent = self._find_memory(phash)
+        if recent is not None and recent[1][1] >= time.time() - self.ttl:
+            stored, merged = recent[0], dict(recent[1][0])
+        elif found is not None:
+            stored, merged = found[0], dict(found[1])
+        else:
+            stored, merged = phash, {}
+        merged.update(fields)
+        now = time.time()
+        self._remember(stored, merged, now)
+        if self._disk is not None:
+            await self._run_disk(self._disk.put, stored, merged, now)
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                await self._run_disk(self._disk.purge, now - self.ttl)
+
+    def close(self):
+        if self._disk is not None:
+            self._executor.shutdown()
+            self._disk.close()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+图片预处理：上传给视觉模型之前先解码、缩小到模型实际使用的分辨率、按设定质量重新编码，
+并标注正确的 MIME 类型。每张图片只处理一次，得到的 ImagePayload 可以在 NSFW 预检、分析等多次请求中复用。
+同时计算图片的感知哈希（dHash），用于识别被重复转发的同一张图（见 image_cache.py）。
+
+解码和编码都是 CPU 密集的同步操作，prepare_image() 会把它们放到线程池中执行，不阻塞事件循环。
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import os
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1536")) # 长边上限（像素），视觉模型一般不会使用更高的分辨率
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85")) # 重新编码的 JPEG 质量
+# 已经足够小的 JPEG/PNG/WEBP 原图直接使用，不再重新编码
+PASSTHROUGH_MAX_BYTES = 512 * 1024
+
+FORMAT_MIME = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif',
+}
+# 无法解码时根据文件头判断 MIME 类型
+MAGIC_MIME = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class ImagePayload:
+    """预处理后的图片：编码后的字节、MIME 类型、尺寸、感知哈希，以及可直接放进消息的 data URL"""
+
+    __slots__ = ('data', 'mime', 'width', 'height', 'source_size', 'digest', 'phash', '_data_url')
+
+    def __init__(self, data, mime, width=None, height=None, source_size=None, digest=None, phash=None):
+        self.data = data
+        self.mime = mime
+        self.width = width
+        self.height = height
+        self.source_size = len(data) if source_size is None else source_size
+        self.digest = digest or hashlib.sha256(data).hexdigest()
+        self.phash = phash
+        self._data_url = None
+
+    @property
+    def data_url(self):
+        if self._data_url is None:
+            self._data_url = f"data:{self.mime};base64,{base64.b64encode(self.data).decode('ascii')}"
+        return self._data_url
+
+    def image_part(self):
+        """OpenAI 兼容接口的图片消息片段"""
+        return {"type": "image_url", "image_url": {"url": self.data_url}}
+
+
+def sniff_mime(data):
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    for magic, mime in MAGIC_MIME:
+        if data.startswith(magic):
+            return mime
+    return 'application/octet-stream'
+
+
+def dhash(image, size=8):
+    """
+    差值哈希：缩成 (size+1) x size 的灰度图，比较每行相邻像素的明暗，得到 size*size 位整数。
+    缩放、重新压缩、轻微调色后的同一张图，哈希只相差很少几位。
+    """
+    small = _flatten(image).convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def _flatten(image):
+    """JPEG 不支持透明通道：带透明度的图片先铺在白底上"""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB') if image.mode != 'RGB' else image
+
+
+def preprocess_image(image_data, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY):
+    """同步预处理一张图片，返回 ImagePayload；无法解码时原样返回并按文件头标注 MIME"""
+    digest = hashlib.sha256(image_data).hexdigest()
+    try:
+        with Image.open(io.BytesIO(image_data)) as image:
+            source_format = image.format
+            image.seek(0)  # 动图只取第一帧
+            image = ImageOps.exif_transpose(image)
+            width, height = image.size
+            fits = max(width, height) <= max_side
+            if (fits and source_format in ('JPEG', 'PNG', 'WEBP')
+                    and len(image_data) <= PASSTHROUGH_MAX_BYTES):
+                return ImagePayload(image_data, FORMAT_MIME[source_format], width, height,
+                                    digest=digest, phash=dhash(image))
+
+            if not fits:
+                image.thumbnail((max_side, max_side), Image.LANCZOS)
+            image = _flatten(image)
+            # 在缩小后的图上计算，哈希与原图几乎相同，但快得多
+            phash = dhash(image)
+            out = io.BytesIO()
+            image.save(out, format='JPEG', quality=quality, optimize=True)
+            encoded = out.getvalue()
+    except Image.DecompressionBombError as e:
+        # 像素数超过 Pillow 的安全上限，不在本地解码，和以前一样把原图交给模型
+        print(f"⚠️ 图片尺寸过大，跳过预处理，使用原图: {e}")
+        return ImagePayload(image_data, sniff_mime(image_data), digest=digest)
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        print(f"⚠️ 图片预处理失败，使用原图: {e}")
+        return ImagePayload(image_data, sniff_mime(image_data), digest=digest)
+
+    if fits and source_format in FORMAT_MIME and len(encoded) >= len(image_data):
+        # 重新编码没有变小，保留原图
+        return ImagePayload(image_data, FORMAT_MIME[source_format], width, height, digest=digest, phash=phash)
+    return ImagePayload(encoded, 'image/jpeg', *image.size, source_size=len(image_data),
+                        digest=digest, phash=phash)
+
+
+async def prepare_image(image_data, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY):
+    """在线程池中预处理图片"""
+    return await asyncio.to_thread(preprocess_image, image_data, max_side, quality)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+增量 JSON 字段解析：模型以流式输出一个 JSON 对象时，边接收边取出顶层字符串字段的当前内容，
+例如 {"analysis": "这张图..., 还没收到结尾的引号时就能拿到 analysis 已经生成的部分。
+
+每个字符只处理一次，总耗时与输出长度成正比。只解析顶层对象的字符串值，
+数字、数组、嵌套对象等其他值会被跳过；最终结果仍应以完整文本的 json.loads 为准。
+"""
+import json
+
+_SIMPLE_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class JSONFieldStream:
+    """
+    feed(text) 接收新的一段输出，返回本次内容有变化的字段名集合；
+    fields 保存各字符串字段目前为止的内容，completed 保存已经收到结尾引号的字段名。
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self.completed = set()
+        self._state = 'start'
+        self._key = []
+        self._current = None  # 正在接收的字符串值对应的字段名
+        self._chars = []  # 正在接收的字符串值（分段累积，避免反复拼接长字符串）
+        self._escape = None  # 未处理完的转义序列
+        self._high_surrogate = None
+        self._depth = 0  # 跳过非字符串值时的嵌套深度
+        self._skip_in_string = False
+        self._skip_escape = False
+
+    def feed(self, text):
+        changed = set()
+        for ch in text:
+            self._step(ch, changed)
+        if self._current is not None and self._current in changed:
+            self.fields[self._current] = ''.join(self._chars)
+        return changed
+
+    def _step(self, ch, changed):
+        state = self._state
+        if state == 'string':
+            self._string_char(ch, changed)
+        elif state == 'key':
+            if self._escape is not None:
+                self._escape += ch
+                if self._escape_complete(self._escape):
+                    self._key.append(json.loads(f'"{self._escape}"'))
+                    self._escape = None
+            elif ch == '\\':
+                self._escape = '\\'
+            elif ch == '"':
+                self._state = 'colon'
+            else:
+                self._key.append(ch)
+        elif state == 'start':
+            if ch == '{':
+                self._state = 'key_or_end'
+        elif state == 'key_or_end':
+            if ch == '"':
+                self._key = []
+                self._state = 'key'
+            elif ch == '}':
+                self._state = 'done'
+        elif state == 'colon':
+            if ch == ':':
+                self._state = 'value'
+        elif state == 'value':
+            if ch == '"':
+                self._current = ''.join(self._key)
+                self._chars = []
+                self.fields[self._current] = ''
+                changed.add(self._current)
+                self._state = 'string'
+            elif not ch.isspace():
+                self._depth = 1 if ch in '[{' else 0
+                self._skip_in_string = False
+                self._state = 'skip'
+                if self._depth == 0 and ch in ',}':
+                    self._end_value(ch)
+        elif state == 'skip':
+            self._skip_char(ch)
+        elif state == 'after_value':
+            self._end_value(ch)
+
+    def _string_char(self, ch, changed):
+        if self._escape is not None:
+            self._escape += ch
+            if not self._escape_complete(self._escape):
+                return
+            decoded = self._decode_escape(self._escape)
+            self._escape = None
+            if decoded:
+                self._chars.append(decoded)
+                changed.add(self._current)
+        elif ch == '\\':
+            self._escape = '\\'
+        elif ch == '"':
+            self.fields[self._current] = ''.join(self._chars)
+            self.completed.add(self._current)
+            changed.add(self._current)
+            self._current = None
+            self._chars = []
+            self._state = 'after_value'
+        else:
+            self._chars.append(ch)
+            changed.add(self._current)
+
+    @staticmethod
+    def _escape_complete(escape):
+        if len(escape) < 2:
+            return False
+        return escape[1] != 'u' or len(escape) == 6
+
+    def _decode_escape(self, escape):
+        if escape[1] != 'u':
+            return _SIMPLE_ESCAPES.get(escape[1], escape[1])
+        code = int(escape[2:], 16)
+        if 0xD800 <= code < 0xDC00:
+            # 代理对的前半部分，等下一个 \\u 转义再合成一个字符
+            self._high_surrogate = code
+            return ''
+        if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+            code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+        self._high_surrogate = None
+        return chr(code)
+
+    def _skip_char(self, ch):
+        if self._skip_in_string:
+            if self._skip_escape:
+                self._skip_escape = False
+            elif ch == '\\':
+                self._skip_escape = True
+            elif ch == '"':
+                self._skip_in_string = False
+        elif ch == '"':
+            self._skip_in_string = True
+        elif ch in '[{':
+            self._depth += 1
+        elif ch in ']}':
+            if self._depth == 0:
+                self._end_value(ch)
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._state = 'after_value'
+        elif ch == ',' and self._depth == 0:
+            self._end_value(ch)
+
+    def _end_value(self, ch):
+        if ch == ',':
+            self._state = 'key_or_end'
+        elif ch == '}':
+            self._state = 'done'
+        else:
+            self._state = 'after_value'
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+知识库上下文构建：按 token 预算挑选与当前请求最相关的词条，
+拼成系统提示词里的“知识库示例”段落。每一代知识库对应一个 ContextBuilder，热重载时整体替换。
+"""
+from collections import OrderedDict
+
+from kb_index import normalize_term
+
+DEFAULT_TOKEN_BUDGET = 300
+# 默认上下文中每个分类展示的词条数
+TERMS_PER_CATEGORY = 10
+# 每个查询参与排序的候选词条数
+CANDIDATES_PER_QUERY = 20
+CACHE_SIZE = 256
+
+
+def estimate_tokens(text):
+    """粗略估算 token 数：ASCII 约 4 个字符 1 个 token，其余字符按 1 个字符 1 个 token 计"""
+    ascii_count = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+
+class ContextBuilder:
+    """
+    build(None) 返回按分类顺序排列的默认示例；build(查询) 返回与查询最相关的词条。
+    分类片段和最终结果都会缓存，重复请求几乎没有开销。
+    """
+
+    def __init__(self, knowledge_base, index):
+        self.knowledge_base = knowledge_base
+        self.index = index
+        self._fragments = {}          # 分类 -> 默认片段
+        self._cache = OrderedDict()   # (查询, 预算) -> 上下文
+
+    def category_fragment(self, category):
+        """分类的默认片段，例如 "Eyes: blue eyes, red eyes, ..." """
+        fragment = self._fragments.get(category)
+        if fragment is None:
+            items = self.knowledge_base[category][:TERMS_PER_CATEGORY * 2]
+            terms = [item.get('term', '') for item in items if item.get('term')]
+            fragment = f"{category}: {', '.join(terms[:TERMS_PER_CATEGORY])}" if terms else ""
+            self._fragments[category] = fragment
+        return fragment
+
+    def build(self, queries=None, budget=DEFAULT_TOKEN_BUDGET):
+        """queries 可以是一段描述，也可以是标签列表；没有查询时返回默认示例"""
+        if isinstance(queries, str):
+            queries = [queries]
+        queries = tuple(q for q in (normalize_term(q) for q in queries or ()) if q)
+        cache_key = (queries, budget)
+        context = self._cache.get(cache_key)
+        if context is not None:
+            self._cache.move_to_end(cache_key)
+            return context
+
+        context = self._build_relevant(queries, budget) if queries else self._build_default(budget)
+        self._cache[cache_key] = context
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return context
+
+    def _build_default(self, budget):
+        lines = []
+        used = 0
+        for category in self.knowledge_base:
+            fragment = self.category_fragment(category)
+            if not fragment:
+                continue
+            cost = estimate_tokens(fragment) + 1
+            if used + cost > budget:
+                break
+            lines.append(fragment)
+            used += cost
+        return "\n".join(lines)
+
+    def _rank(self, queries):
+        """合并各查询的排名：每个查询里排第 r 名的词条得 1/(r+1) 分"""
+        scored = {}
+        for query in queries:
+            ranked = self.index.search_text_ids(query, CANDIDATES_PER_QUERY)
+            ranked += [i for i in self.index.search_ids(query, CANDIDATES_PER_QUERY) if i not in ranked]
+            for rank, term_id in enumerate(ranked):
+                scored[term_id] = scored.get(term_id, 0.0) + 1.0 / (rank + 1)
+        return sorted(scored, key=lambda i: (-scored[i], self.index.keys[i]))
+
+    def _build_relevant(self, queries, budget):
+        """按相关度依次加入词条，按所属分类分行，超出预算即停止"""
+        lines = {}
+        used = 0
+        for term_id in self._rank(queries):
+            entry = self.index.entries[term_id][0]
+            category, term = entry['category'], entry['term']
+            cost = estimate_tokens(term) + 1
+            if category not in lines:
+                cost += estimate_tokens(category) + 2
+            if used + cost > budget:
+                break
+            lines.setdefault(category, []).append(term)
+            used += cost
+        return "\n".join(f"{category}: {', '.join(terms)}" for category, terms in lines.items())
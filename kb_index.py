@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+知识库检索索引
+
+- Aho-Corasick 自动机：一次扫描找出 query 中出现的所有词条 (term in query)
+- n-gram 倒排索引：按 1~3 字符片段快速定位包含 query 的词条 (query in term)
+- 译文倒排索引：中文按字二元组切分，支持用中文/中英混合描述查找标准英文词条
+
+所有结构都压平成 array，便于之后直接写入/映射快照文件。
+"""
+import math
+import re
+from array import array
+from bisect import bisect_left
+from collections import deque
+from collections.abc import Mapping
+
+# n-gram 索引的最大片段长度
+GRAM_SIZE = 3
+# 译文检索时每个 token 最多查看的 postings 数量，保证查询开销不随词库增长
+TRANSLATION_POSTINGS_CAP = 1000
+# 单次查询最多使用的 token 数量
+MAX_QUERY_TOKENS = 64
+
+CJK_PATTERN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def normalize_term(term):
+    """统一词条的索引键：去空白 + 小写"""
+    return str(term or '').strip().lower()
+
+
+def iter_grams(text, max_n=GRAM_SIZE):
+    """生成文本中所有长度为 1~max_n 的片段（去重）"""
+    grams = set()
+    for n in range(1, max_n + 1):
+        for i in range(len(text) - n + 1):
+            grams.add(text[i:i + n])
+    return grams
+
+
+def category_fragment(category, items):
+    """把单个分类整理成 {索引键: [条目...]}"""
+    fragment = {}
+    for item in items:
+        key = normalize_term(item.get('term', ''))
+        if key:
+            fragment.setdefault(key, []).append({
+                'category': category,
+                'term': item.get('term', ''),
+                'translation': item.get('translation', '')
+            })
+    return fragment
+
+
+def tokenize_translation(text):
+    """译文分词：中文按字二元组（单字保留单字），英文/数字按单词"""
+    text = str(text or '').lower()
+    tokens = set()
+    for run in CJK_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.add(run)
+        else:
+            tokens.update(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.update(WORD_PATTERN.findall(text))
+    return tokens
+
+
+def tokenize_query(text):
+    """查询分词：在译文分词基础上补充中文单字，用于命中单字译文"""
+    tokens = tokenize_translation(text)
+    for run in CJK_PATTERN.findall(str(text or '')):
+        if len(run) > 1:
+            tokens.update(run)
+    return tokens
+
+
+class AhoCorasick:
+    """压平存储的 Aho-Corasick 自动机，节点的边按字符码位排序后二分查找"""
+
+    def __init__(self, edge_start, edge_char, edge_child, fail, out, dict_link):
+        self.edge_start = edge_start
+        self.edge_char = edge_char
+        self.edge_child = edge_child
+        self.fail = fail
+        self.out = out
+        self.dict_link = dict_link
+
+    @classmethod
+    def build(cls, keys):
+        """根据词条列表构建自动机，out[node] 为在该节点结束的词条 id（无则为 -1）"""
+        children = [{}]
+        out = [-1]
+        for term_id, key in enumerate(keys):
+            node = 0
+            for ch in key:
+                nxt = children[node].get(ch)
+                if nxt is None:
+                    nxt = len(children)
+                    children[node][ch] = nxt
+                    children.append({})
+                    out.append(-1)
+                node = nxt
+            out[node] = term_id
+
+        # BFS 计算失败指针与输出链接
+        fail = [0] * len(children)
+        dict_link = [-1] * len(children)
+        queue = deque(children[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in children[node].items():
+                state = fail[node]
+                while state and ch not in children[state]:
+                    state = fail[state]
+                target = children[state].get(ch, 0)
+                fail[child] = target if target != child else 0
+                link = fail[child]
+                dict_link[child] = link if out[link] != -1 else dict_link[link]
+                queue.append(child)
+
+        edge_start = array('I', [0])
+        edge_char = array('I')
+        edge_child = array('I')
+        for edges in children:
+            for ch in sorted(edges, key=ord):
+                edge_char.append(ord(ch))
+                edge_child.append(edges[ch])
+            edge_start.append(len(edge_char))
+
+        return cls(edge_start, edge_char, edge_child,
+                   array('i', fail), array('i', out), array('i', dict_link))
+
+    def _goto(self, node, code):
+        lo, hi = self.edge_start[node], self.edge_start[node + 1]
+        pos = bisect_left(self.edge_char, code, lo, hi)
+        if pos < hi and self.edge_char[pos] == code:
+            return self.edge_child[pos]
+        return -1
+
+    def iter_matches(self, text):
+        """逐个产出 (结束位置, 词条 id)"""
+        state = 0
+        for pos, ch in enumerate(text):
+            code = ord(ch)
+            nxt = self._goto(state, code)
+            while nxt == -1 and state:
+                state = self.fail[state]
+                nxt = self._goto(state, code)
+            state = nxt if nxt != -1 else 0
+            node = state if self.out[state] != -1 else self.dict_link[state]
+            while node > 0:
+                yield pos, self.out[node]
+                node = self.dict_link[node]
+
+    def find_all(self, text):
+        """返回 text 中出现过的所有词条 id（去重）"""
+        return {term_id for _, term_id in self.iter_matches(text)}
+
+
+class GramIndex:
+    """n-gram 倒排索引：gram -> postings 中 [start, end) 区间内的词条 id（升序）"""
+
+    def __init__(self, spans, postings):
+        self.spans = spans
+        self.postings = postings
+
+    @classmethod
+    def build(cls, keys, max_n=GRAM_SIZE):
+        buckets = {}
+        for term_id, key in enumerate(keys):
+            for gram in iter_grams(key, max_n):
+                buckets.setdefault(gram, []).append(term_id)
+
+        spans = {}
+        postings = array('I')
+        for gram in sorted(buckets):
+            start = len(postings)
+            postings.extend(buckets[gram])
+            spans[gram] = (start, len(postings))
+        return cls(spans, postings)
+
+    def candidates(self, query, max_n=GRAM_SIZE):
+        """返回 query 中最稀有片段的 postings 区间；query 中有未收录片段时返回 None"""
+        if len(query) <= max_n:
+            return self.spans.get(query)
+        best = None
+        for i in range(len(query) - max_n + 1):
+            span = self.spans.get(query[i:i + max_n])
+            if span is None:
+                return None
+            if best is None or span[1] - span[0] < best[1] - best[0]:
+                best = span
+        return best
+
+
+class TranslationIndex:
+    """
+    译文倒排索引：token -> 词条 id。
+    每个 token 的 postings 按译文 token 数升序排列（越短越具体），查询时只看前 TRANSLATION_POSTINGS_CAP 个。
+    """
+
+    def __init__(self, spans, postings, lengths):
+        self.spans = spans
+        self.postings = postings
+        self.lengths = lengths  # 词条 id -> 译文 token 数
+
+    @classmethod
+    def build(cls, entries):
+        buckets = {}
+        lengths = array('I')
+        for term_id, items in enumerate(entries):
+            tokens = set()
+            for item in items:
+                tokens |= tokenize_translation(item.get('translation', ''))
+            lengths.append(len(tokens))
+            for token in tokens:
+                buckets.setdefault(token, []).append(term_id)
+
+        spans = {}
+        postings = array('I')
+        for token in sorted(buckets):
+            start = len(postings)
+            postings.extend(sorted(buckets[token], key=lambda i: (lengths[i], i)))
+            spans[token] = (start, len(postings))
+        return cls(spans, postings, lengths)
+
+    def score(self, text):
+        """
+        返回 {词条 id: 得分}，得分在 0~1 之间：
+        命中 token 的 idf 占查询 idf 的比例 × 命中 token 占该词条译文 token 的比例。
+        """
+        total = len(self.lengths)
+        weighted = []
+        for token in sorted(tokenize_query(text))[:MAX_QUERY_TOKENS]:
+            span = self.spans.get(token)
+            if span:
+                weighted.append((span, math.log(1 + total / (span[1] - span[0]))))
+        query_weight = sum(weight for _, weight in weighted)
+        if not query_weight:
+            return {}
+
+        matched = {}
+        for (start, end), weight in weighted:
+            for pos in range(start, min(end, start + TRANSLATION_POSTINGS_CAP)):
+                term_id = self.postings[pos]
+                hit_weight, hits = matched.get(term_id, (0.0, 0))
+                matched[term_id] = (hit_weight + weight, hits + 1)
+        return {
+            term_id: (hit_weight / query_weight) * min(1.0, hits / max(1, self.lengths[term_id]))
+            for term_id, (hit_weight, hits) in matched.items()
+        }
+
+
+class KnowledgeIndex:
+    """
+    知识库词条索引。
+    词条 id 按 (长度, 词条) 排序分配，所以 postings 遍历顺序即“越短越相关”的顺序。
+    """
+
+    def __init__(self, keys, entries, automaton, grams, translations, fragments=None):
+        self.keys = keys          # id -> 小写词条
+        self.entries = entries    # id -> [{'category', 'term', 'translation'}, ...]
+        self.automaton = automaton
+        self.grams = grams
+        self.translations = translations
+        self.fragments = fragments or {}  # 分类 -> (原始词条列表, 分类片段)，供增量重建复用
+
+    @classmethod
+    def build(cls, knowledge_base, previous=None):
+        """
+        从 {分类: [词条...]} 结构构建索引。
+        传入上一代索引时，内容未变的分类直接复用其片段；词条集合不变时连自动机和 n-gram 索引也一并复用，
+        所有分类都未变时译文索引同样复用。
+        """
+        old_fragments = previous.fragments if previous else {}
+        fragments = {}
+        grouped = {}
+        unchanged = previous is not None and len(old_fragments) == len(knowledge_base)
+        for category, items in knowledge_base.items():
+            cached = old_fragments.get(category)
+            if cached and cached[0] == items:
+                fragment = cached[1]
+            else:
+                fragment = category_fragment(category, items)
+                unchanged = False
+            fragments[category] = (list(items), fragment)
+            for key, entries in fragment.items():
+                grouped.setdefault(key, []).extend(entries)
+
+        keys = sorted(grouped, key=lambda k: (len(k), k))
+        entries = [grouped[key] for key in keys]
+        if previous is not None and len(previous.keys) == len(keys) and list(previous.keys) == keys:
+            automaton, grams = previous.automaton, previous.grams
+        else:
+            automaton, grams = AhoCorasick.build(keys), GramIndex.build(keys)
+        translations = previous.translations if unchanged else TranslationIndex.build(entries)
+        return cls(keys, entries, automaton, grams, translations, fragments)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, key):
+        """精确查找词条 id，keys 按 (长度, 词条) 有序，直接二分即可"""
+        key = normalize_term(key)
+        pos = bisect_left(self.keys, (len(key), key), key=lambda k: (len(k), k))
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return pos
+        return -1
+
+    def terms(self):
+        """兼容旧的 KNOWLEDGE_BASE_TERMS: {小写词条: [条目...]} 只读视图"""
+        return TermsView(self)
+
+    def _contained_by(self, query, limit):
+        """query in term：按长度从短到长验证候选，收集够 limit 个即停止"""
+        span = self.grams.candidates(query)
+        if span is None:
+            return []
+        hits = []
+        for pos in range(span[0], span[1]):
+            term_id = self.grams.postings[pos]
+            key = self.keys[term_id]
+            if key != query and query in key:
+                hits.append(term_id)
+                if len(hits) >= limit:
+                    break
+        return hits
+
+    def search_ids(self, query, limit=5):
+        """
+        返回按相关度排序的词条 id 列表。
+        相关度 = 重叠长度 / 较长一方长度：完全匹配为 1，越接近越高。
+        """
+        query = normalize_term(query)
+        if not query:
+            return []
+        scored = {}
+        for term_id in self.automaton.find_all(query):
+            scored[term_id] = len(self.keys[term_id]) / len(query)
+        for term_id in self._contained_by(query, limit):
+            scored[term_id] = len(query) / len(self.keys[term_id])
+        return sorted(scored, key=lambda i: (-scored[i], self.keys[i]))[:limit]
+
+    def search_text_ids(self, text, limit=5):
+        """
+        中英混合的自由文本检索，一次返回排序后的标准词条 id。
+        中文部分走译文索引；英文部分用自动机找出按整词出现的词条，得分为其占英文部分的长度比例。
+        两部分得分相加，同时命中中英文的词条排在最前。
+        """
+        scored = self.translations.score(text)
+        latin = ' '.join(WORD_PATTERN.findall(str(text or '').lower()))
+        if latin:
+            for end, term_id in self.automaton.iter_matches(latin):
+                key = self.keys[term_id]
+                start = end - len(key) + 1
+                if (start == 0 or latin[start - 1] == ' ') and (end + 1 == len(latin) or latin[end + 1] == ' '):
+                    scored[term_id] = scored.get(term_id, 0.0) + len(key) / len(latin)
+        return sorted(scored, key=lambda i: (-scored[i], self.keys[i]))[:limit]
+
+    def search_text(self, text, limit=5):
+        """search_text_ids 的条目版本"""
+        return self._collect(self.search_text_ids(text, limit), limit)
+
+    def search(self, query, limit=5):
+        """返回按相关度排序、按 (term, category) 去重后的词条条目"""
+        return self._collect(self.search_ids(query, limit), limit)
+
+    def _collect(self, term_ids, limit):
+        results = []
+        seen = set()
+        for term_id in term_ids:
+            for item in self.entries[term_id]:
+                marker = (item['term'], item['category'])
+                if marker not in seen:
+                    seen.add(marker)
+                    results.append(item)
+            if len(results) >= limit:
+                break
+        return results[:limit]
+
+
+class TermsView(Mapping):
+    """KnowledgeIndex 上的只读映射视图，不额外复制词条"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, key):
+        term_id = self.index.lookup(key) if isinstance(key, str) else -1
+        if term_id < 0:
+            raise KeyError(key)
+        return self.index.entries[term_id]
+
+    def __iter__(self):
+        return iter(self.index.keys)
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+知识库二进制快照：把 JSON 知识库和预构建的检索索引编译成一个带版本号的文件，
+机器人启动时直接 mmap 映射，无需 json.load 和重建索引，多个进程还能共享同一份内存页。
+
+每个快照文件名里带有来源文件指纹（knowledge_base.<指纹>.snapshot），新一代快照写成新文件，
+不覆盖正在被映射的旧文件（Windows 上无法替换已映射的文件）；旧文件在不再被占用后清理。
+
+用法: python kb_snapshot.py [源 JSON 文件]
+"""
+import glob
+import hashlib
+import json
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Mapping, Sequence
+
+from kb_index import AhoCorasick, GramIndex, KnowledgeIndex, TranslationIndex, category_fragment, normalize_term
+
+SNAPSHOT_FILE = 'knowledge_base.snapshot' # 快照文件名模板，实际文件名中插入来源指纹
+# 与机器人加载 JSON 时的优先级一致
+KB_SOURCE_FILES = ('classified_lexicon.json', 'merged_knowledge_base.json')
+
+SNAPSHOT_MAGIC = b'XHKBSNAP'
+SNAPSHOT_VERSION = 2
+
+# 字段值类型：普通字符串 / 非字符串值以 JSON 文本保存
+FIELD_STR = 0
+FIELD_JSON = 1
+
+
+def find_kb_source():
+    """返回机器人会优先加载的 JSON 知识库路径，不存在时返回 None"""
+    return next((path for path in KB_SOURCE_FILES if os.path.exists(path)), None)
+
+
+def source_fingerprint(path):
+    """用文件名、大小和修改时间判断快照是否过期"""
+    stat = os.stat(path)
+    return {'name': os.path.basename(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def snapshot_path(source_path, base=SNAPSHOT_FILE):
+    """来源文件对应的快照路径：来源内容（指纹）或快照格式变化时文件名随之变化"""
+    stem, ext = os.path.splitext(base)
+    fingerprint = json.dumps([SNAPSHOT_VERSION, source_fingerprint(source_path)], sort_keys=True)
+    return f"{stem}.{hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()[:12]}{ext}"
+
+
+def prune_snapshots(keep, base=SNAPSHOT_FILE):
+    """删除除 keep 以外的旧快照；仍被映射的文件在 Windows 上删不掉，留到下次再清理"""
+    stem, ext = os.path.splitext(base)
+    for path in glob.glob(f"{glob.escape(stem)}.*{ext}") + [base]:
+        if os.path.abspath(path) == os.path.abspath(keep) or not os.path.exists(path):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class _StringPool:
+    """字符串驻留表：相同字符串只保存一次"""
+
+    def __init__(self):
+        self.ids = {}
+        self.blob = bytearray()
+        self.offsets = array('I', [0])
+
+    def add(self, text):
+        sid = self.ids.get(text)
+        if sid is None:
+            sid = len(self.offsets) - 1
+            self.ids[text] = sid
+            self.blob += text.encode('utf-8')
+            self.offsets.append(len(self.blob))
+        return sid
+
+
+def compile_snapshot(knowledge_base, source_path, out_path=None, index=None):
+    """
+    把知识库及其索引写成快照文件（先写临时文件再改名），返回快照路径。
+    out_path 默认按来源指纹命名；同名快照已存在时内容必然相同（可能正被映射），直接复用。
+    """
+    out_path = out_path or snapshot_path(source_path)
+    if os.path.exists(out_path):
+        return out_path
+    index = index or KnowledgeIndex.build(knowledge_base)
+    pool = _StringPool()
+    sections = {}
+
+    # 分类与原始词条（保留全部字段，供“查标签”等功能还原）
+    cat_names, cat_start = array('I'), array('I', [0])
+    item_start = array('I', [0])
+    field_name, field_value, field_kind = array('I'), array('I'), bytearray()
+    items_by_key = {}
+    item_no = 0
+    for category, items in knowledge_base.items():
+        cat_names.append(pool.add(category))
+        for item in items:
+            for name, value in item.items():
+                field_name.append(pool.add(name))
+                if isinstance(value, str):
+                    field_value.append(pool.add(value))
+                    field_kind.append(FIELD_STR)
+                else:
+                    field_value.append(pool.add(json.dumps(value, ensure_ascii=False)))
+                    field_kind.append(FIELD_JSON)
+            item_start.append(len(field_name))
+            key = normalize_term(item.get('term', ''))
+            if key:
+                items_by_key.setdefault(key, []).append(item_no)
+            item_no += 1
+        cat_start.append(item_no)
+
+    # 词条索引：keys 顺序与 KnowledgeIndex 一致，entries 指回原始词条序号
+    key_ids, entry_start, entry_item = array('I'), array('I', [0]), array('I')
+    for key in index.keys:
+        key_ids.append(pool.add(key))
+        entry_item.extend(items_by_key[key])
+        entry_start.append(len(entry_item))
+
+    gram_ids, gram_start = array('I'), array('I', [0])
+    grams = index.grams
+    postings = array('I')
+    for gram in sorted(grams.spans):
+        start, end = grams.spans[gram]
+        gram_ids.append(pool.add(gram))
+        postings.extend(grams.postings[start:end])
+        gram_start.append(len(postings))
+
+    tr_ids, tr_start = array('I'), array('I', [0])
+    translations = index.translations
+    tr_postings = array('I')
+    for token in sorted(translations.spans):
+        start, end = translations.spans[token]
+        tr_ids.append(pool.add(token))
+        tr_postings.extend(translations.postings[start:end])
+        tr_start.append(len(tr_postings))
+
+    ac = index.automaton
+    parts = [
+        ('str_blob', 'B', pool.blob), ('str_offsets', 'I', pool.offsets),
+        ('cat_names', 'I', cat_names), ('cat_start', 'I', cat_start),
+        ('item_start', 'I', item_start), ('field_name', 'I', field_name),
+        ('field_value', 'I', field_value), ('field_kind', 'B', field_kind),
+        ('key_ids', 'I', key_ids), ('entry_start', 'I', entry_start), ('entry_item', 'I', entry_item),
+        ('gram_ids', 'I', gram_ids), ('gram_start', 'I', gram_start), ('postings', 'I', postings),
+        ('tr_ids', 'I', tr_ids), ('tr_start', 'I', tr_start), ('tr_postings', 'I', tr_postings),
+        ('tr_lengths', 'I', translations.lengths),
+        ('ac_edge_start', 'I', ac.edge_start), ('ac_edge_char', 'I', ac.edge_char),
+        ('ac_edge_child', 'I', ac.edge_child), ('ac_fail', 'i', ac.fail),
+        ('ac_out', 'i', ac.out), ('ac_dict_link', 'i', ac.dict_link),
+    ]
+
+    payload = bytearray()
+    for name, typecode, data in parts:
+        payload += b'\0' * (-len(payload) % 8)
+        raw = bytes(data) if typecode == 'B' else array(typecode, data).tobytes()
+        sections[name] = [len(payload), len(raw), typecode]
+        payload += raw
+
+    header = json.dumps({
+        'version': SNAPSHOT_VERSION,
+        'byteorder': sys.byteorder,
+        'source': source_fingerprint(source_path),
+        'sections': sections,
+    }).encode('utf-8')
+    header_size = len(SNAPSHOT_MAGIC) + 8 + len(header)
+    header += b' ' * (-header_size % 8)
+
+    tmp_path = f"{out_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(array('I', [SNAPSHOT_VERSION, len(header)]).tobytes())
+        f.write(header)
+        f.write(payload)
+    os.replace(tmp_path, out_path)
+    prune_snapshots(out_path)
+    return out_path
+
+
+class _StringTable(Sequence):
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, sid):
+        return str(self.blob[self.offsets[sid]:self.offsets[sid + 1]], 'utf-8')
+
+
+class _StringView(Sequence):
+    """按字符串 id 数组惰性解码的只读字符串序列"""
+
+    def __init__(self, strings, ids):
+        self.strings = strings
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.strings[self.ids[i]]
+
+
+class _SortedSpans:
+    """快照中的 gram/token -> postings 区间，键已排序，二分查找"""
+
+    def __init__(self, grams, starts):
+        self.grams = grams
+        self.starts = starts
+
+    def get(self, gram):
+        pos = bisect_left(self.grams, gram)
+        if pos < len(self.grams) and self.grams[pos] == gram:
+            return self.starts[pos], self.starts[pos + 1]
+        return None
+
+    def __iter__(self):
+        return iter(self.grams)
+
+    def __len__(self):
+        return len(self.grams)
+
+    def __getitem__(self, gram):
+        span = self.get(gram)
+        if span is None:
+            raise KeyError(gram)
+        return span
+
+
+class Snapshot:
+    """一个已映射的快照文件"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mm)
+        magic_size = len(SNAPSHOT_MAGIC)
+        if bytes(view[:magic_size]) != SNAPSHOT_MAGIC:
+            raise ValueError("不是知识库快照文件")
+        version, header_len = view[magic_size:magic_size + 8].cast('I')
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"快照版本不匹配: {version}")
+        base = magic_size + 8
+        self.header = json.loads(bytes(view[base:base + header_len]))
+        if self.header['byteorder'] != sys.byteorder:
+            raise ValueError("快照字节序与当前平台不一致")
+        base += header_len
+        self.sections = {}
+        for name, (offset, length, typecode) in self.header['sections'].items():
+            section = view[base + offset:base + offset + length]
+            self.sections[name] = section if typecode == 'B' else section.cast(typecode)
+
+        s = self.sections
+        self.strings = _StringTable(s['str_blob'], s['str_offsets'])
+
+    def is_fresh(self, source_path):
+        return bool(source_path) and self.header['source'] == source_fingerprint(source_path)
+
+    def knowledge_base(self):
+        return SnapshotKnowledgeBase(self)
+
+    def index(self):
+        s = self.sections
+        automaton = AhoCorasick(s['ac_edge_start'], s['ac_edge_char'], s['ac_edge_child'],
+                                s['ac_fail'], s['ac_out'], s['ac_dict_link'])
+        grams = GramIndex(_SortedSpans(_StringView(self.strings, s['gram_ids']), s['gram_start']),
+                          s['postings'])
+        translations = TranslationIndex(_SortedSpans(_StringView(self.strings, s['tr_ids']), s['tr_start']),
+                                        s['tr_postings'], s['tr_lengths'])
+        return KnowledgeIndex(_StringView(self.strings, s['key_ids']), _SnapshotEntries(self),
+                              automaton, grams, translations, _SnapshotFragments(self))
+
+    def item(self, item_no):
+        s = self.sections
+        item = {}
+        for pos in range(s['item_start'][item_no], s['item_start'][item_no + 1]):
+            value = self.strings[s['field_value'][pos]]
+            item[self.strings[s['field_name'][pos]]] = value if s['field_kind'][pos] == FIELD_STR else json.loads(value)
+        return item
+
+    def category_of(self, item_no):
+        return bisect_right(self.sections['cat_start'], item_no) - 1
+
+
+class SnapshotKnowledgeBase(Mapping):
+    """{分类: [词条...]} 的只读视图，分类在首次访问时才解码"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.names = _StringView(snapshot.strings, snapshot.sections['cat_names'])
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        self._cache = {}
+
+    def __getitem__(self, category):
+        items = self._cache.get(category)
+        if items is None:
+            pos = self.positions[category]
+            cat_start = self.snapshot.sections['cat_start']
+            items = [self.snapshot.item(n) for n in range(cat_start[pos], cat_start[pos + 1])]
+            self._cache[category] = items
+        return items
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+
+class _SnapshotFragments(Mapping):
+    """
+    KnowledgeIndex.fragments 的快照版本：分类 -> (原始词条列表, 分类片段)，访问时才从快照解码。
+    从快照启动后第一次热重载时，内容未变的分类仍然可以复用，不必全部重建。
+    """
+
+    def __init__(self, snapshot):
+        self.kb = SnapshotKnowledgeBase(snapshot)
+
+    def __getitem__(self, category):
+        items = self.kb[category]
+        return items, category_fragment(category, items)
+
+    def __iter__(self):
+        return iter(self.kb)
+
+    def __len__(self):
+        return len(self.kb)
+
+
+class _SnapshotEntries(Sequence):
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.names = _StringView(snapshot.strings, snapshot.sections['cat_names'])
+
+    def __len__(self):
+        return len(self.snapshot.sections['entry_start']) - 1
+
+    def __getitem__(self, term_id):
+        s = self.snapshot.sections
+        entries = []
+        for pos in range(s['entry_start'][term_id], s['entry_start'][term_id + 1]):
+            item_no = s['entry_item'][pos]
+            item = self.snapshot.item(item_no)
+            entries.append({
+                'category': self.names[self.snapshot.category_of(item_no)],
+                'term': item.get('term', ''),
+                'translation': item.get('translation', '')
+            })
+        return entries
+
+
+def load_snapshot(source_path, path=None):
+    """映射 source_path 对应的快照；不存在、损坏或已过期时返回 None"""
+    path = path or snapshot_path(source_path)
+    if not os.path.exists(path):
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"⚠️ 知识库快照无法读取，将回退到 JSON: {e}")
+        return None
+    if not snapshot.is_fresh(source_path):
+        print(f"♻️ 知识库快照已过期: {path}")
+        return None
+    return snapshot
+
+
+def main():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(script_dir)
+    source_path = sys.argv[1] if len(sys.argv) > 1 else find_kb_source()
+    if not source_path or not os.path.exists(source_path):
+        print(f"❌ 错误: 找不到知识库文件 ({' / '.join(KB_SOURCE_FILES)})")
+        return
+    print(f"📖 正在读取: {source_path}")
+    with open(source_path, 'r', encoding='utf-8') as f:
+        knowledge_base = json.load(f)
+    print("⚙️ 正在构建索引并写入快照...")
+    out_path = compile_snapshot(knowledge_base, source_path)
+    print(f"✅ 已生成快照: {out_path} ({os.path.getsize(out_path) / 1024 / 1024:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+词库分类引擎：把所有分类规则编译成一条正则，并用集合维护每个分类已有的词条，
+分类耗时随词库大小线性增长。词条较多时可以用 classify_many 分块交给多个进程并行分类。
+"""
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+# 每个进程大约分到的块数，块太大负载不均，块太小进程间通信开销大
+CHUNKS_PER_WORKER = 4
+MIN_CHUNK_SIZE = 2000
+
+
+def compile_rules(rules):
+    """
+    把 {分类: [正则...]} 编译成一条正则。
+    每个分类对应一个可选的前瞻分组 (?=(?P<cN>.*?(规则1|规则2...)))?，
+    在字符串开头匹配一次即可得到所有命中的分类，结果与逐条 search 完全一致。
+    """
+    parts = []
+    group_names = {}
+    for i, (category, patterns) in enumerate(rules.items()):
+        name = f"c{i}"
+        group_names[name] = category
+        alternation = '|'.join(f"(?:{pattern})" for pattern in patterns)
+        parts.append(f"(?=(?P<{name}>.*?(?:{alternation})))?")
+    return re.compile('^' + ''.join(parts), re.IGNORECASE | re.DOTALL), group_names
+
+
+class RegexClassifier:
+    """按 CLASSIFICATION_RULES 给词条打多个分类标签，未命中任何规则时归入 fallback"""
+
+    def __init__(self, rules, fallback):
+        self.categories = list(rules)
+        self.fallback = fallback
+        self.pattern, self.group_names = compile_rules(rules)
+
+    def classify(self, term):
+        """返回分类名称列表，顺序与规则定义顺序一致"""
+        match = self.pattern.match(term.lower())
+        categories = [self.group_names[name] for name, value in match.groupdict().items() if value is not None]
+        return categories if categories else [self.fallback]
+
+
+class KeywordClassifier:
+    """
+    classify_lexicon.py 使用的关键词规则：按规则顺序找到第一个命中的分类。
+    关键词作为整词出现、或位于词条开头/结尾都算命中。
+    """
+
+    def __init__(self, rules, fallback):
+        self.rules = [(category, tuple(keywords)) for category, keywords in rules.items()]
+        self.fallback = fallback
+
+    def classify(self, term):
+        term_lower = term.lower()
+        padded = f" {term_lower} "
+        for category, keywords in self.rules:
+            for keyword in keywords:
+                if f" {keyword} " in padded or term_lower.startswith(keyword) or term_lower.endswith(keyword):
+                    return [category]
+        return [self.fallback]
+
+
+_worker_classifier = None
+
+
+def _init_worker(classifier):
+    global _worker_classifier
+    _worker_classifier = classifier
+
+
+def _classify_chunk(terms):
+    return [_worker_classifier.classify(term) for term in terms]
+
+
+def resolve_workers(workers):
+    """workers <= 0 表示使用全部 CPU 核心"""
+    return workers if workers and workers > 0 else (os.cpu_count() or 1)
+
+
+def default_chunk_size(total, workers):
+    """让每个进程分到约 CHUNKS_PER_WORKER 块，但每块不少于 MIN_CHUNK_SIZE 个词条"""
+    return max(MIN_CHUNK_SIZE, -(-total // (workers * CHUNKS_PER_WORKER)))
+
+
+class ClassifierPool:
+    """
+    可复用的分类进程池，适合分多批（例如逐个分类）提交词条。
+    workers == 1 或批次较小时直接在当前进程分类；进程池在第一次需要时才创建。
+    """
+
+    def __init__(self, classifier, workers=1):
+        self.classifier = classifier
+        self.workers = resolve_workers(workers)
+        self._executor = None
+
+    @property
+    def batch_limit(self):
+        """
+        跨分类攒批时每批的词条数：够每个进程分到 CHUNKS_PER_WORKER 个最小块即可，
+        再大只会多占内存；workers == 1 时为 0，表示不攒批，逐个分类处理。
+        """
+        return 0 if self.workers == 1 else self.workers * CHUNKS_PER_WORKER * MIN_CHUNK_SIZE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        return False
+
+    def classify_many(self, terms, chunk_size=None):
+        """
+        批量分类，返回与 terms 一一对应的分类列表。
+        executor.map 按提交顺序返回结果，合并后顺序与串行完全一致。
+        """
+        terms = list(terms)
+        if self.workers == 1 or len(terms) <= MIN_CHUNK_SIZE:
+            return [self.classifier.classify(term) for term in terms]
+
+        chunk_size = chunk_size or default_chunk_size(len(terms), self.workers)
+        chunks = [terms[i:i + chunk_size] for i in range(0, len(terms), chunk_size)]
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 initializer=_init_worker, initargs=(self.classifier,))
+        results = []
+        for labels in self._executor.map(_classify_chunk, chunks):
+            results.extend(labels)
+        return results
+
+
+def classify_many(classifier, terms, workers=1, chunk_size=None):
+    """一次性批量分类，workers > 1 时按块分发给进程池"""
+    with ClassifierPool(classifier, workers) as pool:
+        return pool.classify_many(terms, chunk_size)
+
+
+class ClassifiedLexicon:
+    """分类结果容器：每个分类一个有序列表 + 一个词条集合，去重为 O(1)"""
+
+    def __init__(self, categories):
+        self.data = {category: [] for category in categories}
+        self.members = {category: set() for category in categories}
+
+    def add(self, category, term, translation):
+        members = self.members.get(category)
+        if members is None:
+            self.data[category] = []
+            members = self.members[category] = set()
+        if term not in members:
+            members.add(term)
+            self.data[category].append({'term': term, 'translation': translation})
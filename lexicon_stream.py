@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+词库文件的流式读写：按 “分类 -> 词条列表” 逐个分类读入、逐个分类写出，
+峰值内存只取决于最大的那个分类，而不是整个词库。
+
+读：  for category, items in iter_categories('词库.json'): ...
+写：  with CategoryWriter('out.json') as writer: writer.write_category(category, items)
+写出的文件与 json.dump(data, f, ensure_ascii=False, indent=2) 逐字节相同。
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+
+READ_CHUNK_SIZE = 1 << 20
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_DECODER = json.JSONDecoder()
+
+
+class _StreamReader:
+    """在分块读取的缓冲区上逐个解码 JSON 值"""
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def _error(self, message):
+        return json.JSONDecodeError(message, self.buf, self.pos)
+
+    def peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+
+    def take(self, expected):
+        ch = self.peek()
+        if ch not in expected:
+            raise self._error(f"Expecting one of {expected!r}")
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # 值被缓冲区截断，读入更多内容后重试
+                if self._fill():
+                    continue
+                raise
+            # 位于缓冲区末尾的数字可能还没读完
+            if end == len(self.buf) and self._fill():
+                continue
+            self.pos = end
+            return obj
+
+
+def iter_categories(path):
+    """逐个产出 (分类名, 词条列表)；数组按元素增量解析，不会一次读入整个文件"""
+    with open(path, 'r', encoding='utf-8') as f:
+        reader = _StreamReader(f)
+        reader.take('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.value()
+            reader.take(':')
+            if reader.peek() == '[':
+                reader.take('[')
+                items = []
+                if reader.peek() == ']':
+                    reader.take(']')
+                else:
+                    while True:
+                        items.append(reader.value())
+                        if reader.take(',]') == ']':
+                            break
+            else:
+                items = reader.value()
+            yield name, items
+            if reader.take(',}') == '}':
+                return
+
+
+class CategoryWriter:
+    """
+    按分类流式写出 {分类: [词条...]}。
+    先写临时文件，正常结束时原子替换目标文件，所以可以安全地覆盖正在读取的源文件。
+    指定 order 时，各分类先分别暂存到磁盘，最后按 order（其余按写入顺序）拼接。
+    """
+
+    def __init__(self, path, indent=2, order=None):
+        self.path = path
+        self.indent = indent
+        self.order = list(order) if order is not None else None
+        self.count = 0
+        self._spool_dir = None
+        self._spooled = []
+
+    def __enter__(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, self._tmp_path = tempfile.mkstemp(prefix='.lexicon-', suffix='.tmp', dir=directory)
+        self._out = os.fdopen(fd, 'w', encoding='utf-8')
+        if self.order is not None:
+            self._spool_dir = tempfile.mkdtemp(prefix='.lexicon-spool-', dir=directory)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self._finish()
+                self._out.close()
+                os.replace(self._tmp_path, self.path)
+        finally:
+            if not self._out.closed:
+                self._out.close()
+            if os.path.exists(self._tmp_path):
+                os.remove(self._tmp_path)
+            if self._spool_dir:
+                shutil.rmtree(self._spool_dir, ignore_errors=True)
+        return False
+
+    def write_category(self, name, items):
+        """写出一个分类；items 可以是任意可迭代对象"""
+        if self._spool_dir is None:
+            self._write_entry(self._out, name, items)
+        else:
+            spool_path = os.path.join(self._spool_dir, f"{len(self._spooled)}.part")
+            with open(spool_path, 'w', encoding='utf-8') as f:
+                self._write_entry(f, name, items)
+            self._spooled.append((name, spool_path))
+
+    def _write_entry(self, f, name, items):
+        pad = ' ' * self.indent
+        if self._spool_dir is None:
+            f.write('{\n' if self.count == 0 else ',\n')
+        f.write(f"{pad}{json.dumps(name, ensure_ascii=False)}: ")
+        if isinstance(items, (str, dict)) or not hasattr(items, '__iter__'):
+            f.write(self._dumps(items, 1))
+        else:
+            empty = True
+            for item in items:
+                f.write('[\n' if empty else ',\n')
+                f.write(pad * 2 + self._dumps(item, 2))
+                empty = False
+            f.write('[]' if empty else f"\n{pad}]")
+        self.count += 1
+
+    def _dumps(self, value, depth):
+        """与 json.dump 缩进一致：除首行外每行补上所在层级的缩进"""
+        text = json.dumps(value, ensure_ascii=False, indent=self.indent)
+        return text.replace('\n', '\n' + ' ' * (self.indent * depth))
+
+    def _finish(self):
+        if self._spool_dir is not None:
+            rank = {name: i for i, name in enumerate(self.order)}
+            parts = sorted(enumerate(self._spooled),
+                           key=lambda p: (rank.get(p[1][0], len(rank)), p[0]))
+            for i, (_, (_, spool_path)) in enumerate(parts):
+                self._out.write('{\n' if i == 0 else ',\n')
+                with open(spool_path, 'r', encoding='utf-8') as f:
+                    shutil.copyfileobj(f, self._out)
+        self._out.write('\n}' if self.count else '{}')
@@ -5,6 +5,9 @@
 import json
 import os
 
+from lexicon_stream import CategoryWriter, iter_categories
+from translation_memory import open_memory
+
 def merge_knowledge_bases():
     """
     合并两个知识库文件
@@ -19,61 +22,70 @@ def merge_knowledge_bases():
         
         print("📖 正在读取文件...")
         
-        # 读取词库.json
-        print(f"   读取: {lexicon_file}")
-        with open(lexicon_file, 'r', encoding='utf-8') as f:
-            lexicon_data = json.load(f)
-        
-        # 读取knowledge_base.json
+        # 读取knowledge_base.json（体积很小，直接整体读取）
         print(f"   读取: {kb_file}")
         with open(kb_file, 'r', encoding='utf-8') as f:
             kb_data = json.load(f)
         
-        print("✅ 文件读取完成，开始合并...")
+        # 词库.json 体积很大，按分类流式读取
+        if not os.path.exists(lexicon_file):
+            raise FileNotFoundError(lexicon_file)
+        print(f"   流式读取: {lexicon_file}")
         
-        # 创建合并后的知识库
-        merged_kb = {}
+        print("✅ 开始合并...")
         
-        # 先添加knowledge_base.json的所有分类（优先级更高，更详细）
+        # 先登记knowledge_base.json的所有分类（优先级更高，更详细，输出时排在最前面）
+        category_counts = {}
         for category, items in kb_data.items():
-            merged_kb[category] = items
+            category_counts[category] = len(items)
             print(f"   ✓ 添加分类: {category} ({len(items)} 个词条)")
         
-        # 添加词库.json的分类
-        for category, items in lexicon_data.items():
-            if category in merged_kb:
-                # 如果分类已存在，合并词条（去重）
-                print(f"   ⚠ 分类 '{category}' 已存在，正在合并去重...")
-                existing_terms = {item['term']: item for item in merged_kb[category]}
-                new_count = 0
-                for item in items:
-                    term = item.get('term', '').strip()
-                    if term and term not in existing_terms:
-                        existing_terms[term] = item
-                        new_count += 1
-                merged_kb[category] = list(existing_terms.values())
-                print(f"     添加了 {new_count} 个新词条，总计 {len(merged_kb[category])} 个词条")
-            else:
-                # 新分类，直接添加
-                merged_kb[category] = items
-                print(f"   ✓ 添加分类: {category} ({len(items)} 个词条)")
+        # 逐个分类合并词库.json 并写出，内存中同一时间只保留一个分类
+        memory = open_memory()
+        filled = 0
+        with CategoryWriter(merged_file, order=kb_data.keys()) as writer:
+            for category, items in iter_categories(lexicon_file):
+                # 用翻译记忆补全空的翻译
+                if memory is not None:
+                    filled += memory.fill(items)
+                if category in kb_data:
+                    # 如果分类已存在，合并词条（去重）
+                    print(f"   ⚠ 分类 '{category}' 已存在，正在合并去重...")
+                    existing_terms = {item['term']: item for item in kb_data.pop(category)}
+                    new_count = 0
+                    for item in items:
+                        term = item.get('term', '').strip()
+                        if term and term not in existing_terms:
+                            existing_terms[term] = item
+                            new_count += 1
+                    writer.write_category(category, existing_terms.values())
+                    category_counts[category] = len(existing_terms)
+                    print(f"     添加了 {new_count} 个新词条，总计 {len(existing_terms)} 个词条")
+                elif category not in category_counts:
+                    # 新分类，直接添加
+                    writer.write_category(category, items)
+                    category_counts[category] = len(items)
+                    print(f"   ✓ 添加分类: {category} ({len(items)} 个词条)")
+            
+            # 未与词库重叠的knowledge_base.json分类原样写出
+            for category, items in kb_data.items():
+                writer.write_category(category, items)
+            
+            print("💾 正在保存合并后的知识库...")
         
-        print("💾 正在保存合并后的知识库...")
-        with open(merged_file, 'w', encoding='utf-8') as f:
-            json.dump(merged_kb, f, ensure_ascii=False, indent=2)
+        if memory is not None:
+            memory.close()
+            print(f"📝 从翻译记忆补全了 {filled} 个空翻译")
         
         print(f"\n✅ 合并完成！")
         print(f"   - 输出文件: {merged_file}")
-        print(f"   - 分类数量: {len(merged_kb)}")
-        total_items = 0
-        for category, items in merged_kb.items():
-            total_items += len(items)
-        print(f"   - 总计: {total_items} 个词条")
+        print(f"   - 分类数量: {len(category_counts)}")
+        print(f"   - 总计: {sum(category_counts.values())} 个词条")
         
         # 统计信息
         print(f"\n📊 分类统计:")
-        for category, items in sorted(merged_kb.items(), key=lambda x: len(x[1]), reverse=True):
-            print(f"   - {category}: {len(items)} 个词条")
+        for category, count in sorted(category_counts.items(), key=lambda x: x[1], reverse=True):
+            print(f"   - {category}: {count} 个词条")
         
     except FileNotFoundError as e:
         print(f"❌ 错误: 文件未找到 - {e}")
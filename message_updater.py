@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+消息编辑合并器：流式回复和进度提示都要频繁编辑同一条消息，直接调用 message.edit 很容易耗尽
+Discord 的频道限额，触发 429 后整个机器人的请求都会被卡住。所有编辑都交给这里：
+
+- 每个频道一个令牌桶，限制编辑频率
+- 同一条消息还没来得及发出的编辑会被合并，只发送最新的内容；内容没有变化时不发送
+- update() 只登记内容、立即返回，不阻塞流式接收；flush() 等到最新内容真正发出（用于最终消息）
+- 根据观察到的限流情况自动调整速率：遇到 429（或 discord.py 内部等待限流导致编辑明显变慢）时速率减半，
+  异常响应里带有 X-RateLimit-Reset-After 时暂停到重置为止；连续成功后再逐步恢复
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from rate_limit import TokenBucket
+
+EDIT_RATE = float(os.getenv("EDIT_RATE", "1.0")) # 每个频道每秒最多编辑次数
+EDIT_BURST = int(os.getenv("EDIT_BURST", "3")) # 允许的突发编辑次数
+EDIT_MIN_RATE = 0.2 # 限流时速率的下限
+SLOW_EDIT_SECONDS = 1.5 # 单次编辑超过这个耗时，视为 discord.py 在内部等待限流
+RECOVER_AFTER = 10 # 连续成功多少次后提高一档速率
+DELIVERED_MEMORY = 64 # 每个频道记住最近多少条消息的已发送内容，用于跳过重复编辑
+
+
+class _ChannelQueue:
+    __slots__ = ('bucket', 'pending', 'delivered', 'task', 'successes')
+
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        self.pending = OrderedDict()  # message.id -> [message, content, [等待发送完成的 future]]
+        self.delivered = OrderedDict()  # message.id -> 最近一次成功发送的内容
+        self.task = None
+        self.successes = 0
+
+
+def _rate_limit_headers(error):
+    """从 discord.HTTPException 中取出限流相关的响应头（没有则返回 None）"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if getattr(error, 'status', None) != 429 and not (headers and headers.get('X-RateLimit-Remaining') == '0'):
+        return None
+    return headers or {}
+
+
+class MessageUpdater:
+    def __init__(self, rate=EDIT_RATE, burst=EDIT_BURST, min_rate=EDIT_MIN_RATE):
+        self.max_rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self._channels = {}
+        self.sent = 0
+        self.merged = 0
+        self.skipped = 0
+        self.rate_limited = 0
+
+    def _queue(self, message):
+        channel_id = message.channel.id
+        queue = self._channels.get(channel_id)
+        if queue is None:
+            queue = self._channels[channel_id] = _ChannelQueue(self.max_rate, self.burst)
+        return channel_id, queue
+
+    def _enqueue(self, message, content, future=None):
+        channel_id, queue = self._queue(message)
+        entry = queue.pending.get(message.id)
+        if entry is None:
+            entry = queue.pending[message.id] = [message, content, []]
+        else:
+            # 还没发出去的旧内容直接被新内容替换
+            entry[1] = content
+            self.merged += 1
+        if future is not None:
+            entry[2].append(future)
+        if queue.task is None or queue.task.done():
+            queue.task = asyncio.create_task(self._drain(channel_id, queue))
+
+    def update(self, message, content):
+        """登记最新内容，稍后按频道限额发送；立即返回"""
+        self._enqueue(message, content)
+
+    async def flush(self, message, content=None):
+        """发送最新内容并等待完成；发送失败时抛出对应的异常（例如 discord.NotFound）"""
+        future = asyncio.get_running_loop().create_future()
+        if content is None:
+            _, queue = self._queue(message)
+            entry = queue.pending.get(message.id)
+            if entry is None:
+                return
+            content = entry[1]
+        self._enqueue(message, content, future)
+        await future
+
+    async def _drain(self, channel_id, queue):
+        while queue.pending:
+            await queue.bucket.acquire()
+            if not queue.pending:
+                break
+            message_id, (message, content, futures) = queue.pending.popitem(last=False)
+            if queue.delivered.get(message_id) == content:
+                self.skipped += 1
+                _resolve(futures)
+                continue
+
+            started = time.monotonic()
+            try:
+                await message.edit(content=content)
+            except Exception as e:
+                self._observe(queue, time.monotonic() - started, e)
+                print(f"⚠️ 编辑消息失败 (channel: {channel_id}): {e}")
+                _resolve(futures, e)
+                continue
+            self.sent += 1
+            queue.delivered[message_id] = content
+            queue.delivered.move_to_end(message_id)
+            while len(queue.delivered) > DELIVERED_MEMORY:
+                queue.delivered.popitem(last=False)
+            self._observe(queue, time.monotonic() - started)
+            _resolve(futures)
+
+    def _observe(self, queue, elapsed, error=None):
+        """根据本次编辑的结果调整该频道的速率"""
+        bucket = queue.bucket
+        headers = _rate_limit_headers(error) if error is not None else None
+        if headers is not None or (error is None and elapsed > SLOW_EDIT_SECONDS):
+            self.rate_limited += 1
+            queue.successes = 0
+            bucket.rate = max(self.min_rate, bucket.rate / 2)
+            reset_after = headers.get('X-RateLimit-Reset-After') if headers else None
+            if reset_after:
+                # 令牌设为负数：令牌桶会等到限额重置后才放行下一次编辑
+                bucket.tokens = -float(reset_after) * bucket.rate
+            return
+        if error is None:
+            queue.successes += 1
+            if queue.successes >= RECOVER_AFTER and bucket.rate < self.max_rate:
+                queue.successes = 0
+                bucket.rate = min(self.max_rate, bucket.rate * 1.5)
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'merged': self.merged,
+            'skipped': self.skipped,
+            'rate_limited': self.rate_limited,
+            'pending': sum(len(q.pending) for q in self._channels.values()),
+        }
+
+
+def _resolve(futures, error=None):
+    for future in futures:
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+模型调用调度器：所有对 client_openai 的请求都先在这里领取名额。
+- 同时进行的请求数有上限，避免高峰期触发上游 429
+- 名额不够时按优先级排队：对话 > 反推/画/图片评论 > 后台任务（随机插话等），同优先级先来先服务
+- 排队人数和等待时间都有上限，超出时抛出 ModelQueueFull，由调用方回复“排队已满”
+- stats() 提供排队长度、等待时间等指标
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+
+MODEL_MAX_CONCURRENCY = int(os.getenv("MODEL_MAX_CONCURRENCY", "4")) # 同时进行的模型请求数上限
+MODEL_MAX_QUEUE = int(os.getenv("MODEL_MAX_QUEUE", "32")) # 排队请求数上限
+MODEL_MAX_WAIT = float(os.getenv("MODEL_MAX_WAIT", "30")) # 排队最长等待时间（秒）
+
+PRIORITY_CHAT = 0
+PRIORITY_IMAGE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_CHAT: "对话", PRIORITY_IMAGE: "图片/绘图", PRIORITY_BACKGROUND: "后台"}
+
+
+class ModelQueueFull(Exception):
+    """排队人数或等待时间超出上限"""
+
+    def __init__(self, message="嗷呜~找本哈的人太多啦，排队已满，请稍后再试！"):
+        super().__init__(message)
+
+
+class _WaitStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'avg_wait': self.total / self.count if self.count else 0.0,
+            'max_wait': self.max,
+        }
+
+
+class ModelScheduler:
+    """
+    用法：
+        async with scheduler.slot(PRIORITY_CHAT):
+            response = await client_openai.chat.completions.create(...)
+    流式请求应在 slot 内读完整个流。
+    """
+
+    def __init__(self, max_concurrency=MODEL_MAX_CONCURRENCY, max_queue=MODEL_MAX_QUEUE, max_wait=MODEL_MAX_WAIT):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._heap = []  # (priority, seq, future)
+        self._seq = itertools.count()
+        self._waiting = 0
+        self._wait_stats = {priority: _WaitStats() for priority in PRIORITY_NAMES}
+        self.completed = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    @property
+    def queue_depth(self):
+        return self._waiting
+
+    async def acquire(self, priority=PRIORITY_IMAGE):
+        started = time.monotonic()
+        if self.active < self.max_concurrency and not self._waiting:
+            self.active += 1
+            self._record_wait(priority, 0.0)
+            return
+        if self._waiting >= self.max_queue:
+            self.rejected_full += 1
+            raise ModelQueueFull()
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except asyncio.TimeoutError:
+            self.rejected_timeout += 1
+            raise ModelQueueFull() from None
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额刚分配过来就被取消了，转交给下一个
+                self.release()
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                # 超时或取消后 future 留在堆里，release() 时跳过
+                self._waiting -= 1
+        self._record_wait(priority, time.monotonic() - started)
+
+    def release(self):
+        """归还名额：直接交给优先级最高的排队者，没有排队者时空出一个名额"""
+        while self._heap:
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self._waiting -= 1
+            future.set_result(None)
+            return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority=PRIORITY_IMAGE):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.completed += 1
+            self.release()
+
+    def _record_wait(self, priority, seconds):
+        self._wait_stats.setdefault(priority, _WaitStats()).add(seconds)
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'max_concurrency': self.max_concurrency,
+            'queue_depth': self._waiting,
+            'max_queue': self.max_queue,
+            'completed': self.completed,
+            'rejected_full': self.rejected_full,
+            'rejected_timeout': self.rejected_timeout,
+            'wait': {PRIORITY_NAMES.get(p, str(p)): s.as_dict() for p, s in self._wait_stats.items()},
+        }
+
+    def describe(self):
+        """给“模型队列”命令使用的简短文字"""
+        stats = self.stats()
+        lines = [
+            f"进行中 {stats['active']}/{stats['max_concurrency']}，排队 {stats['queue_depth']}/{stats['max_queue']}",
+            f"已完成 {stats['completed']}，排队已满拒绝 {stats['rejected_full']}，等待超时 {stats['rejected_timeout']}",
+        ]
+        for name, wait in stats['wait'].items():
+            lines.append(f"{name}: {wait['count']} 次，平均等待 {wait['avg_wait']:.2f}s，最长 {wait['max_wait']:.2f}s")
+        return "\n".join(lines)
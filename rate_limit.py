@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+异步限速工具：翻译引擎（translation_engine.py）和消息编辑合并器（message_updater.py）共用。
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """令牌桶：平均每秒 rate 个请求，最多允许 capacity 个请求的突发"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+高可用的模型客户端：包在 OpenAI 兼容客户端外面，所有模型请求都经过这里。
+
+- 可以配置多个接口地址（或同一地址的多个模型），按顺序优先使用，失败时切换到下一个
+- 可重试的错误（超时、连接失败、429、5xx）按带随机抖动的指数退避重试；
+  400/401 等请求本身的问题直接抛出，不重试
+- 每个接口一个熔断器：连续失败达到阈值后暂时不再使用，冷却后放行一个试探请求，成功才恢复
+- 可选的对冲请求：主接口超过其 p95 延迟还没返回时，向下一个接口再发一份，先返回的结果胜出
+- 流式请求只在建立连接阶段重试和切换；已经开始输出后出错不再重试
+
+只依赖客户端的 client.chat.completions.create(**kwargs) 接口，可以用 fake_openai_server.py
+启动本地假服务器，把接口地址指向它来测试各种故障。
+"""
+import asyncio
+import os
+import random
+import time
+from collections import deque
+
+MODEL_MAX_RETRIES = int(os.getenv("MODEL_MAX_RETRIES", "3")) # 每次调用最多重试次数（不含第一次）
+MODEL_RETRY_BASE_DELAY = float(os.getenv("MODEL_RETRY_BASE_DELAY", "0.5")) # 退避基数（秒）
+MODEL_RETRY_MAX_DELAY = float(os.getenv("MODEL_RETRY_MAX_DELAY", "8")) # 单次退避上限（秒）
+MODEL_ATTEMPT_TIMEOUT = float(os.getenv("MODEL_ATTEMPT_TIMEOUT", "30")) # 单次尝试的超时（秒）
+MODEL_BREAKER_THRESHOLD = int(os.getenv("MODEL_BREAKER_THRESHOLD", "5")) # 连续失败多少次后熔断
+MODEL_BREAKER_COOLDOWN = float(os.getenv("MODEL_BREAKER_COOLDOWN", "30")) # 熔断后多久放行试探请求（秒）
+MODEL_HEDGE = os.getenv("MODEL_HEDGE", "false").lower() == "true" # 是否启用对冲请求
+MODEL_HEDGE_MIN_SAMPLES = 20 # 延迟样本少于这个数时不对冲（p95 还不可靠）
+LATENCY_WINDOW = 200 # 每个接口保留最近多少次成功请求的延迟
+
+# 这些 HTTP 状态码说明是服务端或限流问题，换个时间或换个接口可能就好了
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class ModelUnavailable(Exception):
+    """所有接口都不可用（熔断中或重试耗尽）"""
+
+    def __init__(self, message="嗷呜~本哈的大脑暂时连不上了，请稍后再试！"):
+        super().__init__(message)
+
+
+def is_retryable(error):
+    """判断错误是否值得重试；不依赖具体的 SDK 异常类型，按状态码和类名判断"""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # openai.APIConnectionError / APITimeoutError、httpx.TransportError 等
+    name = type(error).__name__
+    return 'Timeout' in name or 'Connect' in name or 'Transport' in name or 'Network' in name
+
+
+class CircuitBreaker:
+    """closed：正常；open：熔断中，拒绝请求；half_open：冷却结束，放行一个试探请求"""
+
+    def __init__(self, threshold=MODEL_BREAKER_THRESHOLD, cooldown=MODEL_BREAKER_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self._clock() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.threshold:
+            self.opened_at = self._clock()
+        self._probing = False
+
+    def release(self):
+        """放行的请求没有结果（例如被取消）时归还试探名额"""
+        self._probing = False
+
+
+class Endpoint:
+    """一个接口：客户端、在该接口上使用的模型名、熔断器和延迟统计"""
+
+    def __init__(self, name, client, model, breaker=None):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.calls = 0
+        self.failures = 0
+
+    def p95(self):
+        if len(self.latencies) < MODEL_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+class ResilientClient:
+    def __init__(self, endpoints, max_retries=MODEL_MAX_RETRIES, base_delay=MODEL_RETRY_BASE_DELAY,
+                 max_delay=MODEL_RETRY_MAX_DELAY, attempt_timeout=MODEL_ATTEMPT_TIMEOUT, hedge=MODEL_HEDGE):
+        if not endpoints:
+            raise ValueError("至少需要一个接口")
+        self.endpoints = list(endpoints)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.hedge = hedge
+        self.retries = 0
+        self.hedged = 0
+
+    # --- 接口选择 ---
+    def _candidates(self):
+        """按配置顺序返回熔断器允许的接口（half_open 的接口会占用它的试探名额）"""
+        return [endpoint for endpoint in self.endpoints if endpoint.breaker.allow()]
+
+    def _backoff(self, attempt):
+        # full jitter：在 [0, 上限] 内均匀取值，避免大量请求同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    # --- 单次尝试 ---
+    async def _call(self, endpoint, kwargs):
+        endpoint.calls += 1
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(
+                endpoint.client.chat.completions.create(**{**kwargs, 'model': endpoint.model}),
+                self.attempt_timeout,
+            )
+        except asyncio.CancelledError:
+            endpoint.breaker.release()
+            raise
+        except Exception as e:
+            endpoint.failures += 1
+            if is_retryable(e):
+                endpoint.breaker.record_failure()
+            else:
+                # 请求本身有问题，不代表接口坏了
+                endpoint.breaker.release()
+            raise
+        endpoint.latencies.append(time.monotonic() - started)
+        endpoint.breaker.record_success()
+        return result
+
+    async def _hedged_call(self, primary, backup, kwargs):
+        """主接口超过 p95 还没返回时向备用接口再发一份，取先成功的结果"""
+        first = asyncio.create_task(self._call(primary, kwargs))
+        delay = primary.p95()
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not backup.breaker.allow():
+            return await first
+        self.hedged += 1
+        second = asyncio.create_task(self._call(backup, kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    # --- 对外接口 ---
+    async def create(self, **kwargs):
+        """非流式请求：失败时切换接口、退避重试；stream=True 请改用 create_stream"""
+        return await self._with_retries(kwargs, hedge=self.hedge and not kwargs.get('stream'))
+
+    async def create_stream(self, **kwargs):
+        """流式请求：只在拿到流对象之前重试和切换，返回值可直接 async for"""
+        return await self._with_retries({**kwargs, 'stream': True}, hedge=False)
+
+    async def _with_retries(self, kwargs, hedge):
+        last_error = None
+        tried = set()
+        for attempt in range(self.max_retries + 1):
+            candidates = self._candidates()
+            if not candidates:
+                break
+            # 优先用这次调用还没失败过的接口；都失败过了就回到第一个
+            fresh = [endpoint for endpoint in candidates if endpoint.name not in tried]
+            endpoint = (fresh or candidates)[0]
+            for other in candidates:
+                if other is not endpoint:
+                    other.breaker.release()
+            if attempt and not fresh:
+                # 同一个接口再试一次之前先退避
+                await asyncio.sleep(self._backoff(attempt - 1))
+            backup = next((e for e in self.endpoints if e is not endpoint and e.name not in tried), None)
+            try:
+                if hedge and backup is not None and endpoint.p95() is not None:
+                    return await self._hedged_call(endpoint, backup, kwargs)
+                return await self._call(endpoint, kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                tried.add(endpoint.name)
+                self.retries += 1
+                print(f"⚠️ 模型接口 {endpoint.name} 请求失败，准备重试 ({attempt + 1}/{self.max_retries + 1}): {e}")
+        if last_error is not None:
+            raise ModelUnavailable() from last_error
+        raise ModelUnavailable()
+
+    def describe(self):
+        lines = []
+        for endpoint in self.endpoints:
+            p95 = endpoint.p95()
+            lines.append(
+                f"{endpoint.name} ({endpoint.model}): {endpoint.breaker.state}，"
+                f"调用 {endpoint.calls} 次，失败 {endpoint.failures} 次"
+                + (f"，p95 {p95:.2f}s" if p95 is not None else "")
+            )
+        lines.append(f"重试 {self.retries} 次，对冲 {self.hedged} 次")
+        return "\n".join(lines)
+
+
+def parse_endpoints(spec, default_key, default_model):
+    """
+    解析备用接口配置：多个接口用分号分隔，每个接口写作 “地址|密钥|模型”，
+    密钥和模型可以省略（沿用主接口的），例如
+        https://backup.example.com/v1||gpt-4o-mini;https://other.example.com/v1|sk-xxx
+    返回 [(地址, 密钥, 模型), ...]
+    """
+    endpoints = []
+    for item in (spec or '').split(';'):
+        parts = [part.strip() for part in item.split('|')]
+        if not parts[0]:
+            continue
+        key = parts[1] if len(parts) > 1 and parts[1] else default_key
+        model = parts[2] if len(parts) > 2 and parts[2] else default_model
+        endpoints.append((parts[0], key, model))
+    return endpoints
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+用户会话存储：替代 bot.py 里无限增长的 user_states 字典。
+
+- 每个用户最多一个会话，Session 使用 __slots__，只保存状态、过期时间和回复次数
+- 按用户 ID 查找是一次字典访问；过期的会话在查找时视为不存在
+- 过期时间放在最小堆里，后台 sweep() 定期清理，不必等用户再次发言；会话总数有上限，
+  超出时先淘汰最早过期的会话
+- 可选的持久化后端（JSONSessionBackend），重启后未过期的会话继续有效
+"""
+import asyncio
+import heapq
+import json
+import os
+import time
+
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000")) # 最多同时保存的会话数
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL", "30")) # 清理过期会话的间隔（秒）
+SESSION_STORE_FILE = os.getenv("SESSION_STORE_FILE", "") # 会话持久化文件，留空表示只保存在内存中
+
+STATE_CHATTING = 'chatting'
+STATE_CATEGORY_CHOICE = 'awaiting_category_choice'
+
+
+class Session:
+    __slots__ = ('user_id', 'state', 'expires_at', 'replies')
+
+    def __init__(self, user_id, state, expires_at, replies=0):
+        self.user_id = user_id
+        self.state = state
+        self.expires_at = expires_at
+        self.replies = replies
+
+    def as_dict(self):
+        return {'user_id': self.user_id, 'state': self.state, 'expires_at': self.expires_at, 'replies': self.replies}
+
+
+class JSONSessionBackend:
+    """把会话整体写入一个 JSON 文件（先写临时文件再替换）；过期时间用墙上时间保存"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 读取会话文件失败: {e}")
+            return []
+
+    def save(self, sessions):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(sessions, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+class SessionStore:
+    def __init__(self, max_sessions=SESSION_MAX, backend=None, clock=time.time):
+        self.max_sessions = max_sessions
+        self.backend = backend
+        self._clock = clock
+        self._sessions = {}  # user_id -> Session
+        self._heap = []  # (expires_at, user_id)；会话续期后旧的条目留在堆里，清理时跳过
+        self._dirty = False
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is not None and session.expires_at <= self._clock():
+            self._remove(user_id)
+            self.expired += 1
+            return None
+        return session
+
+    def start(self, user_id, state, ttl):
+        """开始（或替换）一个会话"""
+        session = Session(user_id, state, self._clock() + ttl)
+        self._sessions[user_id] = session
+        heapq.heappush(self._heap, (session.expires_at, user_id))
+        self._dirty = True
+        self._enforce_limit()
+        return session
+
+    def touch(self, session, ttl):
+        """续期：从现在起再保持 ttl 秒"""
+        if self._sessions.get(session.user_id) is not session:
+            return
+        session.expires_at = self._clock() + ttl
+        heapq.heappush(self._heap, (session.expires_at, session.user_id))
+        self._dirty = True
+        if len(self._heap) > 2 * len(self._sessions) + 64:
+            self._rebuild_heap()
+
+    def end(self, user_id):
+        if user_id in self._sessions:
+            self._remove(user_id)
+
+    def _remove(self, user_id):
+        del self._sessions[user_id]
+        self._dirty = True
+
+    def _rebuild_heap(self):
+        """续期多了以后堆里的失效条目会变多，重建一次"""
+        self._heap = [(s.expires_at, s.user_id) for s in self._sessions.values()]
+        heapq.heapify(self._heap)
+
+    def _pop_earliest(self):
+        """弹出堆顶；堆顶对应仍然有效的会话时删除它，返回是否删除了会话"""
+        expires_at, user_id = heapq.heappop(self._heap)
+        session = self._sessions.get(user_id)
+        if session is None or session.expires_at != expires_at:
+            return False
+        self._remove(user_id)
+        return True
+
+    def _enforce_limit(self):
+        while len(self._sessions) > self.max_sessions and self._heap:
+            if self._pop_earliest():
+                self.evicted += 1
+
+    def sweep(self):
+        """删除所有已过期的会话，返回删除的数量"""
+        now = self._clock()
+        removed = 0
+        while self._heap and self._heap[0][0] <= now:
+            if self._pop_earliest():
+                removed += 1
+        self.expired += removed
+        return removed
+
+    # --- 持久化 ---
+    def load(self):
+        if self.backend is None:
+            return 0
+        now = self._clock()
+        for data in self.backend.load():
+            if data.get('expires_at', 0) > now:
+                session = Session(data['user_id'], data['state'], data['expires_at'], data.get('replies', 0))
+                self._sessions[session.user_id] = session
+        self._rebuild_heap()
+        self._enforce_limit()
+        self._dirty = False
+        return len(self._sessions)
+
+    def save(self):
+        if self.backend is None or not self._dirty:
+            return False
+        self.backend.save([session.as_dict() for session in self._sessions.values()])
+        self._dirty = False
+        return True
+
+    async def run_sweeper(self, interval=SESSION_SWEEP_INTERVAL):
+        """后台任务：定期清理过期会话，并把变化写入持久化后端"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                removed = self.sweep()
+                if removed:
+                    print(f"🧹 已清理 {removed} 个过期会话")
+                self.save()
+            except Exception as e:
+                print(f"⚠️ 清理会话时出错: {e}")
+
+
+def create_session_store():
+    """按环境变量创建会话存储：设置了 SESSION_STORE_FILE 时启用 JSON 持久化"""
+    backend = JSONSessionBackend(SESSION_STORE_FILE) if SESSION_STORE_FILE else None
+    return SessionStore(backend=backend)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+单飞（single-flight）请求合并：同一个键的请求正在进行时，后来的相同请求不再重新执行，
+而是等待同一个结果。例如很多人在几秒内对同一张热门图片回复“反推”，
+模型调用和在线搜索只做一次，每个人仍然各自收到一条回复。
+
+执行函数会收到一个 progress(update) 回调，用来向所有等待者广播进度（例如更新各自的“加载中”消息，
+update 可以是文字，也可以是生成到一半的结果，由各等待者自行格式化）；
+中途加入的等待者会先收到最近一次的进度。
+
+共享的任务不会因为某一个等待者被取消而中断；执行结束后（无论成功还是异常）键立即释放，
+之后的请求会重新执行（结果复用交给 image_cache.py 等缓存层）。
+"""
+import asyncio
+
+
+class _Flight:
+    __slots__ = ('task', 'listeners', 'last_progress', 'waiters')
+
+    def __init__(self):
+        self.task = None
+        self.listeners = []
+        self.last_progress = None
+        self.waiters = 0
+
+    async def progress(self, update):
+        self.last_progress = update
+        # 各等待者的消息同时更新，不必一个个排队
+        await asyncio.gather(*(_notify(listener, update) for listener in list(self.listeners)))
+
+
+async def _notify(listener, update):
+    try:
+        await listener(update)
+    except Exception as e:
+        # 某个等待者的进度消息更新失败（例如消息被删除）不影响共享的任务
+        print(f"⚠️ 进度更新失败: {e}")
+
+
+class SingleFlight:
+    """
+    do(key, run, on_progress=None)：key 没有正在进行的请求时执行 run(progress)，
+    否则等待正在进行的那一次；所有等待者得到同一个结果或同一个异常。
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self.started = 0  # 实际执行的次数
+        self.coalesced = 0  # 被合并、直接等待已有结果的次数
+
+    def in_flight(self, key):
+        return key in self._flights
+
+    async def do(self, key, run, on_progress=None):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._run(key, flight, run))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            if on_progress is not None and flight.last_progress is not None:
+                await _notify(on_progress, flight.last_progress)
+
+        if on_progress is not None:
+            flight.listeners.append(on_progress)
+        flight.waiters += 1
+        try:
+            # shield：一个等待者被取消时，其他人仍在等待同一个任务
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if on_progress is not None and on_progress in flight.listeners:
+                flight.listeners.remove(on_progress)
+            if flight.waiters == 0 and not flight.task.done():
+                # 所有等待者都已离开，没有必要再继续；键立即释放，之后的请求重新执行
+                flight.task.cancel()
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+
+    async def _run(self, key, flight, run):
+        try:
+            return await run(flight.progress)
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
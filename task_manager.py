@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+后台任务管理：图片评论、反推、绘图构思和对话这类耗时流程不再在 on_message 里直接 await，
+而是交给 TaskManager 在后台运行，on_message 很快返回，可以继续处理下一条消息。
+
+- 同时运行的任务数有上限，超出的任务排队等待
+- 每个用户同时进行的任务数有上限，可以按用户取消自己的任务
+- 任务中没有被捕获的异常会被记录下来，不会变成 "Task exception was never retrieved"
+- submit() 可以带一个 on_done 回调，任务无论完成、失败、被取消（包括还在排队、甚至还没开始运行时）
+  还是没能提交，都会调用且只调用一次，用于退还额度预留之类的清理
+- describe_user() 列出某个用户正在进行的任务，用于回复“我的任务”
+"""
+import asyncio
+import itertools
+import os
+import time
+import traceback
+
+TASK_MAX_CONCURRENCY = int(os.getenv("TASK_MAX_CONCURRENCY", "16")) # 同时运行的后台任务数上限
+TASK_MAX_PER_USER = int(os.getenv("TASK_MAX_PER_USER", "2")) # 每个用户同时进行（含排队）的任务数上限
+
+
+class Job:
+    __slots__ = ('job_id', 'user_id', 'label', 'created_at', 'started_at', 'task')
+
+    def __init__(self, job_id, user_id, label):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.label = label
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.task = None
+
+    @property
+    def running(self):
+        return self.started_at is not None
+
+
+class TaskManager:
+    def __init__(self, max_concurrency=TASK_MAX_CONCURRENCY, max_per_user=TASK_MAX_PER_USER, on_error=None):
+        self.max_per_user = max_per_user
+        self.on_error = on_error
+        self._semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        self._jobs = {}  # job_id -> Job
+        self._by_user = {}  # user_id -> {job_id: Job}
+        self._ids = itertools.count(1)
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def user_jobs(self, user_id):
+        return list(self._by_user.get(user_id, {}).values())
+
+    def can_submit(self, user_id):
+        return user_id is None or len(self._by_user.get(user_id, ())) < self.max_per_user
+
+    def submit(self, user_id, label, coro, on_done=None):
+        """
+        在后台运行 coro，返回 Job；用户的任务数已达上限时返回 None（coro 会被关闭，不会运行）。
+        user_id 为 None 的任务（例如随机插话）不受每用户上限限制，也不能按用户取消。
+        on_done() 在任务结束或没能提交时调用。
+        """
+        if not self.can_submit(user_id):
+            coro.close()
+            if on_done is not None:
+                on_done()
+            return None
+        job = Job(next(self._ids), user_id, label)
+        self._jobs[job.job_id] = job
+        if user_id is not None:
+            self._by_user.setdefault(user_id, {})[job.job_id] = job
+        job.task = asyncio.create_task(self._run(job, coro))
+        # 清理放在完成回调里：任务在第一次运行前就被取消时 _run 的 finally 不会执行，回调总会执行
+        job.task.add_done_callback(lambda task: self._finish(job, coro, on_done))
+        return job
+
+    async def _run(self, job, coro):
+        try:
+            async with self._semaphore:
+                job.started_at = time.monotonic()
+                await coro
+            self.completed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"❌ 后台任务出错 ({job.label}, user: {job.user_id}): {e}")
+            traceback.print_exc()
+            if self.on_error is not None:
+                try:
+                    await self.on_error(job, e)
+                except Exception as report_error:
+                    print(f"⚠️ 报告后台任务错误时出错: {report_error}")
+
+    def _finish(self, job, coro, on_done):
+        if job.task.cancelled():
+            self.cancelled += 1
+        coro.close()  # 排队时就被取消的协程从未开始运行，关闭它以免出现 "never awaited" 警告
+        self._jobs.pop(job.job_id, None)
+        user_jobs = self._by_user.get(job.user_id)
+        if user_jobs is not None:
+            user_jobs.pop(job.job_id, None)
+            if not user_jobs:
+                del self._by_user[job.user_id]
+        if on_done is not None:
+            try:
+                on_done()
+            except Exception as e:
+                print(f"⚠️ 后台任务结束回调出错 ({job.label}): {e}")
+
+    def cancel_user(self, user_id):
+        """取消某个用户的全部任务，返回取消的数量"""
+        jobs = self.user_jobs(user_id)
+        for job in jobs:
+            job.task.cancel()
+        return len(jobs)
+
+    def describe_user(self, user_id):
+        now = time.monotonic()
+        lines = []
+        for job in self.user_jobs(user_id):
+            if job.running:
+                lines.append(f"- {job.label}：进行中，已经 {now - job.started_at:.0f} 秒")
+            else:
+                lines.append(f"- {job.label}：排队中，已经等了 {now - job.created_at:.0f} 秒")
+        return "\n".join(lines)
+
+    def stats(self):
+        running = sum(1 for job in self._jobs.values() if job.running)
+        return {
+            'running': running,
+            'queued': len(self._jobs) - running,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled,
+        }
+
+    async def shutdown(self):
+        """取消所有任务并等待它们结束"""
+        tasks = [job.task for job in self._jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
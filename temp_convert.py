@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
-import json
 import os
 
+from lexicon_stream import CategoryWriter, iter_categories
+
 # 使用当前文件所在目录
 script_dir = os.path.dirname(os.path.abspath(__file__))
 os.chdir(script_dir)
@@ -10,50 +11,44 @@ lexicon_file = os.path.join(script_dir, '词库.json')
 print(f"📖 正在读取词库.json文件...")
 print(f"   文件路径: {lexicon_file}")
 
-# 读取原始词库文件
-with open(lexicon_file, 'r', encoding='utf-8') as f:
-    lexicon_data = json.load(f)
-
-print(f"✅ 文件读取完成，开始转换...")
-
-# 创建新的知识库格式
-knowledge_base = {}
-
-# 遍历原始数据
-for category_name, items in lexicon_data.items():
-    print(f"   处理分类: {category_name} ({len(items)} 个词条)...")
-    converted_items = []
-    
-    for i, item in enumerate(items):
-        # 转换为新格式
-        converted_item = {
-            "term": item.get("提示词", "").strip(),
-            "translation": item.get("Unnamed: 2", "").strip()
-        }
+print(f"✅ 开始逐个分类读取并转换...")
+
+# 按分类流式读取、转换并写出，内存中同一时间只保留一个分类
+category_counts = []
+with CategoryWriter(lexicon_file) as writer:
+    for category_name, items in iter_categories(lexicon_file):
+        print(f"   处理分类: {category_name} ({len(items)} 个词条)...")
+        converted_items = []
         
-        # 只添加非空term的项
-        if converted_item["term"]:
-            converted_items.append(converted_item)
+        for i, item in enumerate(items):
+            # 转换为新格式
+            converted_item = {
+                "term": item.get("提示词", "").strip(),
+                "translation": item.get("Unnamed: 2", "").strip()
+            }
+            
+            # 只添加非空term的项
+            if converted_item["term"]:
+                converted_items.append(converted_item)
+            
+            # 每处理10000条显示一次进度
+            if (i + 1) % 10000 == 0:
+                print(f"     已处理: {i + 1}/{len(items)}")
         
-        # 每处理10000条显示一次进度
-        if (i + 1) % 10000 == 0:
-            print(f"     已处理: {i + 1}/{len(items)}")
-    
-    # 如果分类有内容，添加到知识库
-    if converted_items:
-        knowledge_base[category_name] = converted_items
-
-print("💾 正在保存转换后的文件...")
-# 保存转换后的文件（覆盖原文件）
-with open(lexicon_file, 'w', encoding='utf-8') as f:
-    json.dump(knowledge_base, f, ensure_ascii=False, indent=2)
+        # 如果分类有内容，写入知识库
+        if converted_items:
+            writer.write_category(category_name, converted_items)
+            category_counts.append((category_name, len(converted_items)))
+
+    # 保存转换后的文件（先写临时文件，再覆盖原文件）
+    print("💾 正在保存转换后的文件...")
 
 print(f"\n✅ 转换完成！")
-print(f"   - 分类数量: {len(knowledge_base)}")
+print(f"   - 分类数量: {len(category_counts)}")
 total_items = 0
-for category, items in knowledge_base.items():
-    print(f"   - {category}: {len(items)} 个词条")
-    total_items += len(items)
+for category, count in category_counts:
+    print(f"   - {category}: {count} 个词条")
+    total_items += count
 print(f"   - 总计: {total_items} 个词条")
 
 
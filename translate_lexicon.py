@@ -1,79 +1,133 @@
+import argparse
+import asyncio
 import json
 import os
-import time
-import translators as ts
+import shutil
+import tempfile
 from tqdm import tqdm
 
+from lexicon_stream import CategoryWriter
+from translation_engine import FakeTranslator, TranslationEngine, TranslatorsBackend
+from translation_memory import MEMORY_FILE, TranslationMemory
+
 # --- 配置 ---
 SOURCE_FILE = 'classified_lexicon.json'
 # 您可以尝试不同的翻译器，例如 'google', 'bing', 'deepl'。'google' 通常最稳定。
 TRANSLATOR_SERVICE = 'google' 
 # 目标语言代码，'zh-CN' 代表简体中文
 TARGET_LANGUAGE = 'zh-CN' 
-# 每次翻译请求之间的延迟（秒），以避免被服务屏蔽
-DELAY_BETWEEN_REQUESTS = 0.2 
+# 每秒最多发出的翻译请求数，以避免被服务屏蔽
+REQUESTS_PER_SECOND = 5
+# 每个请求一次翻译的标签数
+BATCH_SIZE = 20
+# 同时进行的翻译请求数
+CONCURRENCY = 4
+# 翻译进度检查点，中断后重新运行会从这里继续
+CHECKPOINT_FILE = 'translate_lexicon.checkpoint.json'
+# 每隔多少秒保存一次检查点
+CHECKPOINT_INTERVAL = 10
+
+def needs_translation(tag):
+    """只翻译 translation 字段为空或与 term 相同的标签"""
+    term = tag.get('term')
+    return bool(term) and (not tag.get('translation') or tag.get('translation') == term)
 
-def translate_lexicon():
+def translate_lexicon(backend=None, batch_size=BATCH_SIZE, concurrency=CONCURRENCY, rate=REQUESTS_PER_SECOND,
+                      source_file=SOURCE_FILE, checkpoint_file=CHECKPOINT_FILE, memory_file=MEMORY_FILE):
     """
     读取分类后的知识库，并使用免费翻译服务翻译标签。
+    标签分批并发翻译，进度定期写入检查点，中断后重新运行会跳过已翻译的标签。
     """
-    if not os.path.exists(SOURCE_FILE):
-        print(f"❌ 错误：源文件 '{SOURCE_FILE}' 不存在。请先运行 classify_lexicon.py 生成该文件。")
+    if not os.path.exists(source_file):
+        print(f"❌ 错误：源文件 '{source_file}' 不存在。请先运行 classify_lexicon.py 生成该文件。")
         return
 
-    print(f"📖 正在读取源知识库: {SOURCE_FILE}")
-    with open(SOURCE_FILE, 'r', encoding='utf-8') as f:
+    print(f"📖 正在读取源知识库: {source_file}")
+    with open(source_file, 'r', encoding='utf-8') as f:
         data = json.load(f)
 
     print("🚀 开始翻译任务...")
+    print(f"\n⏭️ 跳过 '未分类' 目录...")
+    
+    terms = [tag['term'] for category, tags in data.items() if category != "未分类"
+             for tag in tags if needs_translation(tag)]
     
-    total_tags_to_translate = 0
+    if not terms:
+        print("✅ 所有标签都已有翻译，无需执行翻译任务。")
+        return
+
+    with TranslationMemory(memory_file) as memory:
+        # 先把词库里已有的译文收进翻译记忆，同一标签出现在其他分类时不必再请求
+        memory.put_many(((tag['term'], tag.get('translation')) for tags in data.values()
+                         for tag in tags if tag.get('term') and not needs_translation(tag)),
+                        TARGET_LANGUAGE, source='lexicon', overwrite=False)
+        translations, failed = run_engine(terms, memory=memory, backend=backend,
+                                          batch_size=batch_size, concurrency=concurrency, rate=rate,
+                                          checkpoint_file=checkpoint_file)
+
     for category, tags in data.items():
         if category == "未分类":
             continue
         for tag in tags:
-            # 只翻译 translation 字段为空或与 term 相同的标签
-            if not tag.get('translation') or tag.get('translation') == tag.get('term'):
-                total_tags_to_translate += 1
-    
-    if total_tags_to_translate == 0:
-        print("✅ 所有标签都已有翻译，无需执行翻译任务。")
-        return
+            if needs_translation(tag) and tag['term'] in translations:
+                tag['translation'] = translations[tag['term']]
 
-    # 使用 tqdm 创建一个进度条
-    with tqdm(total=total_tags_to_translate, desc="翻译进度") as pbar:
+    print(f"\n💾 正在将翻译结果写回: {source_file}")
+    with CategoryWriter(source_file) as writer:
         for category, tags in data.items():
-            if category == "未分类":
-                print(f"\n⏭️ 跳过 '未分类' 目录...")
-                continue
-            
-            # print(f"\n🔍 正在处理目录: {category}")
-            for tag in tags:
-                term_to_translate = tag.get('term')
-                # 检查是否需要翻译
-                if term_to_translate and (not tag.get('translation') or tag.get('translation') == term_to_translate):
-                    try:
-                        # 执行翻译
-                        translated_text = ts.translate_text(
-                            term_to_translate,
-                            translator=TRANSLATOR_SERVICE,
-                            to_language=TARGET_LANGUAGE
-                        )
-                        tag['translation'] = translated_text
-                        pbar.set_postfix_str(f"{term_to_translate} -> {translated_text}")
-                        time.sleep(DELAY_BETWEEN_REQUESTS) # 增加延迟
-                    except Exception as e:
-                        pbar.set_postfix_str(f"翻译 '{term_to_translate}' 时出错: {e}")
-                        time.sleep(1) # 如果出错，稍微多等一下
-                    finally:
-                        pbar.update(1) # 更新进度条
-
-    print(f"\n💾 正在将翻译结果写回: {SOURCE_FILE}")
-    with open(SOURCE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+            writer.write_category(category, tags)
 
+    if failed:
+        print(f"⚠️ 有 {len(failed)} 个标签翻译失败，重新运行脚本会只重试这些标签。")
     print("\n🎉 翻译任务完成！ 🎉")
 
+def translate_lexicon_sandboxed(backend, **kwargs):
+    """
+    在临时目录里完整跑一遍翻译流程（测试假翻译器用）：
+    源文件和翻译记忆都先复制一份，检查点也写在临时目录中，运行结束后整个目录删除，真实数据不受影响。
+    """
+    with tempfile.TemporaryDirectory(prefix='translate-sandbox-') as sandbox:
+        source_file = os.path.join(sandbox, os.path.basename(SOURCE_FILE))
+        memory_file = os.path.join(sandbox, os.path.basename(MEMORY_FILE))
+        for src, dst in ((SOURCE_FILE, source_file), (MEMORY_FILE, memory_file)):
+            if os.path.exists(src):
+                shutil.copyfile(src, dst)
+        print(f"🧪 沙盒模式：结果只写入临时目录 {sandbox}，不会修改 {SOURCE_FILE} 和 {MEMORY_FILE}")
+        translate_lexicon(backend, source_file=source_file, memory_file=memory_file,
+                          checkpoint_file=os.path.join(sandbox, os.path.basename(CHECKPOINT_FILE)), **kwargs)
+
+def run_engine(terms, memory, backend, batch_size, concurrency, rate, checkpoint_file=CHECKPOINT_FILE):
+    """用翻译引擎翻译 terms，返回 ({词条: 译文}, 失败的词条)"""
+    engine = TranslationEngine(
+        backend or TranslatorsBackend(TRANSLATOR_SERVICE),
+        TARGET_LANGUAGE,
+        batch_size=batch_size,
+        concurrency=concurrency,
+        rate=rate,
+        checkpoint_path=checkpoint_file,
+        checkpoint_interval=CHECKPOINT_INTERVAL,
+        memory=memory,
+    )
+    pending = engine.pending(terms)
+    unique_count = len(set(terms))
+    if len(pending) < unique_count:
+        print(f"♻️ 从检查点和翻译记忆中恢复 {unique_count - len(pending)} 个已翻译的标签")
+
+    # 使用 tqdm 创建一个进度条
+    with tqdm(total=len(pending), desc="翻译进度") as pbar:
+        def on_batch(batch, translations):
+            if translations is None:
+                pbar.set_postfix_str(f"翻译 {len(batch)} 个标签时出错: {engine.failed[batch[0]]}")
+            else:
+                pbar.set_postfix_str(f"{batch[-1]} -> {translations[-1]}")
+            pbar.update(len(batch))
+
+        translations = asyncio.run(engine.translate(terms, progress=on_batch))
+
+    if not engine.failed:
+        engine.checkpoint.remove()
+    return translations, engine.failed
+
 if __name__ == "__main__":
     print("="*50)
     print("知识库标签翻译脚本".center(50))
@@ -81,11 +135,22 @@ if __name__ == "__main__":
     print(f"源文件: {SOURCE_FILE}")
     print(f"翻译服务: {TRANSLATOR_SERVICE}")
     print(f"目标语言: {TARGET_LANGUAGE}")
-    print("注意：翻译过程可能需要较长时间，具体取决于需要翻译的标签数量。")
+    print("注意：翻译过程可能需要较长时间，具体取决于需要翻译的标签数量。中断后重新运行会从检查点继续。")
     print("="*50)
     
+    parser = argparse.ArgumentParser(description="知识库标签翻译脚本")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="每个请求翻译的标签数")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="同时进行的翻译请求数")
+    parser.add_argument('--rate', type=float, default=REQUESTS_PER_SECOND, help="每秒最多发出的请求数")
+    parser.add_argument('--fake', action='store_true', help="使用本地假翻译器在临时目录中运行（测试用，不联网，不修改真实数据）")
+    args = parser.parse_args()
+    
     try:
-        translate_lexicon()
+        options = dict(batch_size=args.batch_size, concurrency=args.concurrency, rate=args.rate)
+        if args.fake:
+            translate_lexicon_sandboxed(FakeTranslator(), **options)
+        else:
+            translate_lexicon(**options)
     except Exception as e:
         print(f"\n❌ 发生严重错误: {e}")
         print("请检查您的网络连接和依赖库是否已正确安装。")
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+并发、可断点续传的批量翻译引擎。
+
+    engine = TranslationEngine(TranslatorsBackend('google'), 'zh-CN', checkpoint_path='translate.checkpoint.json')
+    translations = asyncio.run(engine.translate(terms))
+
+- 多个 worker 并发处理批次，每个批次一次请求翻译多个词条
+- 令牌桶限制请求速率，替代固定的 sleep
+- 定期把已完成的结果写入检查点文件，中断后重新运行会跳过已翻译的词条
+- 翻译后端可替换：TranslatorsBackend 调用 translators 库，FakeTranslator 用于本地测试
+- 可选的翻译记忆（translation_memory.TranslationMemory）：发请求前先查记忆，翻译结果写回记忆
+"""
+import asyncio
+import json
+import os
+import tempfile
+
+from rate_limit import TokenBucket
+
+CHECKPOINT_VERSION = 1
+
+
+class TranslatorsBackend:
+    """
+    基于 translators 库的后端。一个批次的词条用换行拼接后一次翻译，
+    返回的行数对不上时退回逐条翻译，保证结果与词条一一对应。
+    """
+
+    separator = '\n'
+
+    def __init__(self, service='google'):
+        import translators  # 只有真正使用这个后端时才需要安装
+        self._ts = translators
+        self.service = service
+        self.name = f"translators:{service}"
+
+    def _translate(self, text, target_language):
+        return self._ts.translate_text(text, translator=self.service, to_language=target_language)
+
+    def _translate_batch(self, terms, target_language):
+        if len(terms) > 1:
+            lines = self._translate(self.separator.join(terms), target_language).split(self.separator)
+            if len(lines) == len(terms):
+                return [line.strip() for line in lines]
+        return [self._translate(term, target_language).strip() for term in terms]
+
+    async def translate_batch(self, terms, target_language):
+        # translators 是同步库，放到线程里执行，避免阻塞事件循环
+        return await asyncio.to_thread(self._translate_batch, list(terms), target_language)
+
+
+class FakeTranslator:
+    """本地假翻译器：返回 "[语言] 词条"，可模拟延迟和失败，并记录每次调用"""
+
+    name = 'fake'
+
+    def __init__(self, delay=0.0, fail_times=0):
+        self.delay = delay
+        self.fail_times = fail_times
+        self.calls = []
+
+    async def translate_batch(self, terms, target_language):
+        self.calls.append(list(terms))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise RuntimeError("fake translator failure")
+        return [f"[{target_language}] {term}" for term in terms]
+
+
+class Checkpoint:
+    """已完成的翻译结果，定期原子写入磁盘；后端或目标语言不同的检查点会被忽略"""
+
+    def __init__(self, path, backend_name, target_language):
+        self.path = path
+        self.meta = {'version': CHECKPOINT_VERSION, 'backend': backend_name, 'target_language': target_language}
+        self.translations = {}
+        self.dirty = False
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+                if all(saved.get(key) == value for key, value in self.meta.items()):
+                    self.translations = saved.get('translations', {})
+            except (OSError, ValueError):
+                pass
+
+    def update(self, terms, translations):
+        self.translations.update(zip(terms, translations))
+        self.dirty = True
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.translate-', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(dict(self.meta, translations=self.translations), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.dirty = False
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class TranslationEngine:
+    """
+    把词条分批交给 concurrency 个 worker 并发翻译。
+    失败的批次按指数退避重试 max_retries 次，仍失败的词条记录在 failed 中，不会中断其他批次。
+    """
+
+    def __init__(self, backend, target_language, batch_size=20, concurrency=4, rate=5.0, burst=None,
+                 checkpoint_path=None, checkpoint_interval=10.0, max_retries=3, retry_delay=1.0, memory=None):
+        self.backend = backend
+        self.memory = memory
+        self.remembered = {}
+        self.target_language = target_language
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst or concurrency)
+        self.checkpoint = Checkpoint(checkpoint_path, getattr(backend, 'name', type(backend).__name__),
+                                     target_language)
+        self.checkpoint_interval = checkpoint_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.failed = {}
+
+    def pending(self, terms):
+        """去重后仍需翻译的词条（检查点或翻译记忆里已有的跳过），保持首次出现的顺序"""
+        done = self.checkpoint.translations
+        pending = [term for term in dict.fromkeys(terms) if term not in done]
+        if self.memory is not None:
+            self.remembered.update(self.memory.get_many(pending, self.target_language))
+            pending = [term for term in pending if term not in self.remembered]
+        return pending
+
+    async def _translate_batch(self, batch):
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire()
+            try:
+                translations = await self.backend.translate_batch(batch, self.target_language)
+                if len(translations) != len(batch):
+                    raise ValueError(f"expected {len(batch)} translations, got {len(translations)}")
+                return translations
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.retry_delay * (2 ** attempt))
+
+    async def _worker(self, queue, progress):
+        while True:
+            batch = await queue.get()
+            try:
+                translations = await self._translate_batch(batch)
+                self.checkpoint.update(batch, translations)
+                if self.memory is not None:
+                    self.memory.put_many(zip(batch, translations), self.target_language,
+                                         source=self.checkpoint.meta['backend'])
+                if progress:
+                    progress(batch, translations)
+            except Exception as e:
+                for term in batch:
+                    self.failed[term] = str(e)
+                if progress:
+                    progress(batch, None)
+            finally:
+                queue.task_done()
+
+    async def _autosave(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            self.checkpoint.save()
+
+    async def translate(self, terms, progress=None):
+        """
+        翻译 terms，返回 {词条: 译文}（包括从检查点和翻译记忆中恢复的结果）。
+        progress(batch, translations) 在每个批次完成时调用，失败时 translations 为 None。
+        """
+        pending = self.pending(terms)
+        queue = asyncio.Queue()
+        for i in range(0, len(pending), self.batch_size):
+            queue.put_nowait(pending[i:i + self.batch_size])
+
+        workers = [asyncio.create_task(self._worker(queue, progress))
+                   for _ in range(min(self.concurrency, queue.qsize()))]
+        autosave = asyncio.create_task(self._autosave())
+        try:
+            await queue.join()
+        finally:
+            for task in workers + [autosave]:
+                task.cancel()
+            await asyncio.gather(*workers, autosave, return_exceptions=True)
+            self.checkpoint.save()
+        return {**self.remembered, **self.checkpoint.translations}
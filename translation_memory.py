@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+持久化翻译记忆：SQLite 表，以 (规范化词条, 目标语言) 为主键保存译文。
+translate_lexicon.py 在发出翻译请求前先查这里，翻译结果也写回这里；
+convert_lexicon.py 和各个合并工具用它补全空的 translation 字段，重复运行几乎不需要联网。
+"""
+import os
+import re
+import sqlite3
+
+MEMORY_FILE = 'translation_memory.sqlite3'
+DEFAULT_LANGUAGE = 'zh-CN'
+# SQLite 单条语句的参数个数有上限，批量查询时分段进行
+QUERY_CHUNK_SIZE = 500
+# 这些来源写入的是测试用的假译文（translation_engine.FakeTranslator），查询时忽略，真实译文可以覆盖它们
+IGNORED_SOURCES = ('fake',)
+_NOT_IGNORED = f"source NOT IN ({','.join('?' * len(IGNORED_SOURCES))})"
+
+_SEPARATORS = re.compile(r'[\s_]+')
+
+
+def memory_key(term):
+    """规范化词条：小写，下划线和连续空白统一为一个空格，"long_hair" 与 "Long Hair" 共用一条记忆"""
+    return _SEPARATORS.sub(' ', str(term or '')).strip().lower()
+
+
+class TranslationMemory:
+    """
+    translations 表：(key, language) -> translation，并记录原始词条和来源。
+    可以用作上下文管理器，退出时关闭连接。
+    """
+
+    def __init__(self, path=MEMORY_FILE):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            " key TEXT NOT NULL,"
+            " language TEXT NOT NULL,"
+            " term TEXT NOT NULL,"
+            " translation TEXT NOT NULL,"
+            " source TEXT NOT NULL DEFAULT '',"
+            " updated_at REAL NOT NULL DEFAULT (julianday('now')),"
+            " PRIMARY KEY (key, language))"
+        )
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def close(self):
+        self._conn.close()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+
+    def get(self, term, language=DEFAULT_LANGUAGE):
+        row = self._conn.execute(
+            f"SELECT translation FROM translations WHERE key = ? AND language = ? AND {_NOT_IGNORED}",
+            (memory_key(term), language, *IGNORED_SOURCES),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, terms, language=DEFAULT_LANGUAGE):
+        """批量查询，返回 {原始词条: 译文}，只包含命中的词条（假翻译器写入的记忆不算命中）"""
+        by_key = {}
+        for term in terms:
+            by_key.setdefault(memory_key(term), []).append(term)
+        keys = list(by_key)
+        found = {}
+        for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+            chunk = keys[i:i + QUERY_CHUNK_SIZE]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT key, translation FROM translations"
+                f" WHERE language = ? AND {_NOT_IGNORED} AND key IN ({placeholders})",
+                [language, *IGNORED_SOURCES] + chunk,
+            )
+            for key, translation in rows:
+                for term in by_key[key]:
+                    found[term] = translation
+        return found
+
+    def put_many(self, pairs, language=DEFAULT_LANGUAGE, source='', overwrite=True):
+        """
+        写入 (词条, 译文) 对；空译文和与原词相同的译文不会写入。
+        overwrite=False 时已有的记忆保持不变（用于从词库中收集已有译文），但假翻译器写入的记忆总会被覆盖。
+        """
+        rows = [(memory_key(term), language, term, translation, source)
+                for term, translation in pairs
+                if memory_key(term) and translation and translation.strip() != term.strip()]
+        sql = ("INSERT INTO translations (key, language, term, translation, source) VALUES (?, ?, ?, ?, ?)"
+               " ON CONFLICT (key, language) DO UPDATE SET term = excluded.term, translation = excluded.translation,"
+               " source = excluded.source, updated_at = julianday('now')")
+        if not overwrite:
+            sql += f" WHERE translations.source IN ({','.join('?' * len(IGNORED_SOURCES))})"
+            rows = [row + IGNORED_SOURCES for row in rows]
+        with self._conn:
+            self._conn.executemany(sql, rows)
+        return len(rows)
+
+    def fill(self, items, language=DEFAULT_LANGUAGE):
+        """给 translation 为空的词条补上记忆中的译文，返回补全的数量"""
+        missing = [item for item in items if item.get('term') and not item.get('translation')]
+        if not missing:
+            return 0
+        found = self.get_many([item['term'] for item in missing], language)
+        filled = 0
+        for item in missing:
+            translation = found.get(item['term'])
+            if translation:
+                item['translation'] = translation
+                filled += 1
+        return filled
+
+
+def open_memory(path=MEMORY_FILE):
+    """翻译记忆文件存在时打开它，否则返回 None（还没有运行过翻译的环境不受影响）"""
+    return TranslationMemory(path) if os.path.exists(path) else None
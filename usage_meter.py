@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+模型调用计量与额度：按用户和服务器统计滑动时间窗口内的模型调用次数和估算 token 数，
+超出额度时拒绝新的请求，避免少数人连续触发图片评论（每次四个模型请求加在线搜索）占满所有名额。
+
+- 计数只保存在内存中，按 USAGE_BUCKET 秒分桶，窗口滑动时整桶丢弃，内存占用与窗口长度无关
+- 后台任务定期把计数写入 USAGE_SNAPSHOT_FILE，重启后从快照恢复，额度不会因为重启而清零
+- 模型请求记在“当前请求者”名下：on_message 开头调用 attribute_to() 设置，
+  之后创建的任务（包括被合并请求共享的任务）会继承这个上下文
+- 预检时用 reserve() 预留这次请求最多需要的调用次数，预留的次数和已记录的次数一起参与额度判断，
+  同一用户并发的多个请求不会都通过预检再一起超额；请求结束后退还没有用完的预留
+"""
+import contextvars
+import json
+import os
+import time
+from collections import deque
+
+from kb_context import estimate_tokens
+
+USAGE_WINDOW = float(os.getenv("USAGE_WINDOW", "3600")) # 额度统计窗口（秒）
+USAGE_BUCKET = float(os.getenv("USAGE_BUCKET", "60")) # 分桶粒度（秒）
+USER_CALL_QUOTA = int(os.getenv("USER_CALL_QUOTA", "40")) # 每个用户窗口内的模型调用次数上限，0 表示不限
+USER_TOKEN_QUOTA = int(os.getenv("USER_TOKEN_QUOTA", "80000")) # 每个用户窗口内的 token 上限，0 表示不限
+GUILD_CALL_QUOTA = int(os.getenv("GUILD_CALL_QUOTA", "400")) # 每个服务器窗口内的模型调用次数上限，0 表示不限
+GUILD_TOKEN_QUOTA = int(os.getenv("GUILD_TOKEN_QUOTA", "800000")) # 每个服务器窗口内的 token 上限，0 表示不限
+USAGE_SNAPSHOT_FILE = os.getenv("USAGE_SNAPSHOT_FILE", "usage_snapshot.json")
+USAGE_SNAPSHOT_INTERVAL = float(os.getenv("USAGE_SNAPSHOT_INTERVAL", "60")) # 快照间隔（秒），0 表示不写快照
+# 图片按固定 token 数估算（接口没有返回 usage 时使用）
+IMAGE_TOKEN_ESTIMATE = 1000
+
+_requester = contextvars.ContextVar('usage_requester', default=(None, None))
+_reservation = contextvars.ContextVar('usage_reservation', default=None)
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, scope, retry_after):
+        self.scope = scope
+        self.retry_after = retry_after
+        minutes = max(1, int(retry_after // 60) + 1)
+        who = "你" if scope == 'user' else "这个服务器"
+        super().__init__(f"嗷呜~{who}最近找本哈干的活太多啦，本哈要歇一歇，大约 {minutes} 分钟后再来吧！")
+
+
+def estimate_message_tokens(messages):
+    """估算 OpenAI 格式消息列表的 token 数"""
+    total = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+            continue
+        for part in content or ():
+            if part.get('type') == 'text':
+                total += estimate_tokens(part.get('text', ''))
+            elif part.get('type') == 'image_url':
+                total += IMAGE_TOKEN_ESTIMATE
+    return total
+
+
+class SlidingWindow:
+    """分桶的滑动窗口计数器：buckets 中每项为 [桶编号, 调用次数, token 数]"""
+
+    __slots__ = ('buckets', 'calls', 'tokens')
+
+    def __init__(self):
+        self.buckets = deque()
+        self.calls = 0
+        self.tokens = 0
+
+    def expire(self, oldest_bucket):
+        while self.buckets and self.buckets[0][0] < oldest_bucket:
+            _, calls, tokens = self.buckets.popleft()
+            self.calls -= calls
+            self.tokens -= tokens
+
+    def add(self, bucket, calls, tokens):
+        if self.buckets and self.buckets[-1][0] == bucket:
+            self.buckets[-1][1] += calls
+            self.buckets[-1][2] += tokens
+        else:
+            self.buckets.append([bucket, calls, tokens])
+        self.calls += calls
+        self.tokens += tokens
+
+
+class Reservation:
+    """一次请求预留的调用次数；calls 是还没有被实际调用抵扣的部分"""
+
+    __slots__ = ('user_id', 'guild_id', 'calls')
+
+    def __init__(self, user_id, guild_id, calls):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.calls = calls
+
+
+class UsageMeter:
+    def __init__(self, window=USAGE_WINDOW, bucket=USAGE_BUCKET,
+                 user_calls=USER_CALL_QUOTA, user_tokens=USER_TOKEN_QUOTA,
+                 guild_calls=GUILD_CALL_QUOTA, guild_tokens=GUILD_TOKEN_QUOTA,
+                 path=USAGE_SNAPSHOT_FILE):
+        self.window = window
+        self.bucket = bucket
+        self.quotas = {'user': (user_calls, user_tokens), 'guild': (guild_calls, guild_tokens)}
+        self.path = path
+        self._counters = {}  # (scope, id) -> SlidingWindow
+        self._reserved = {}  # (scope, id) -> 已预留、尚未抵扣的调用次数
+        self._dirty = False
+
+    # --- 请求者上下文 ---
+    @staticmethod
+    def attribute_to(user_id, guild_id):
+        """
+        把当前任务之后的模型调用记在这个用户/服务器名下。
+        discord.py 的每个事件都在独立的任务中运行，设置不会影响其他消息。
+        """
+        _requester.set((user_id, guild_id))
+
+    @staticmethod
+    def current():
+        return _requester.get()
+
+    # --- 计数 ---
+    def _bucket_of(self, now):
+        return int(now // self.bucket)
+
+    def _oldest_bucket(self, now):
+        return self._bucket_of(now - self.window) + 1
+
+    def _window(self, scope, key, now, create=False):
+        counter = self._counters.get((scope, key))
+        if counter is None:
+            if not create:
+                return None
+            counter = self._counters[(scope, key)] = SlidingWindow()
+        counter.expire(self._oldest_bucket(now))
+        return counter
+
+    def usage(self, scope, key, now=None):
+        """返回 (调用次数, token 数)"""
+        counter = self._window(scope, key, now or time.time())
+        return (counter.calls, counter.tokens) if counter else (0, 0)
+
+    def record(self, calls=1, tokens=0, user_id=None, guild_id=None, now=None):
+        """
+        记录一次模型调用；user_id/guild_id 省略时使用当前请求者，
+        并从当前上下文中的预留（见 hold）里抵扣相应的次数。
+        """
+        reservation = None
+        if user_id is None and guild_id is None:
+            user_id, guild_id = _requester.get()
+            reservation = _reservation.get()
+        now = now or time.time()
+        bucket = self._bucket_of(now)
+        for scope, key in (('user', user_id), ('guild', guild_id)):
+            if key is not None:
+                self._window(scope, key, now, create=True).add(bucket, calls, tokens)
+                self._dirty = True
+        if reservation is not None:
+            self._unreserve(reservation, min(calls, reservation.calls))
+
+    def check(self, user_id, guild_id, calls=1, now=None):
+        """预计再调用 calls 次是否超出额度（已预留的次数也算在内）；超出时抛出 QuotaExceeded"""
+        now = now or time.time()
+        for scope, key in (('user', user_id), ('guild', guild_id)):
+            if key is None:
+                continue
+            call_quota, token_quota = self.quotas[scope]
+            counter = self._window(scope, key, now)
+            used_calls, used_tokens = (counter.calls, counter.tokens) if counter else (0, 0)
+            reserved = self._reserved.get((scope, key), 0)
+            if (call_quota and used_calls + reserved + calls > call_quota) or (token_quota and used_tokens >= token_quota):
+                raise QuotaExceeded(scope, self._retry_after(counter, now) if counter else self.bucket)
+
+    # --- 预留 ---
+    def reserve(self, user_id, guild_id, calls, now=None):
+        """
+        预检并预留 calls 次调用，返回 Reservation；超出额度时抛出 QuotaExceeded。
+        预检和预留之间没有 await，并发的请求会依次看到彼此的预留。
+        """
+        if calls:
+            self.check(user_id, guild_id, calls, now)
+        reservation = Reservation(user_id, guild_id, calls)
+        for scope, key in (('user', user_id), ('guild', guild_id)):
+            if key is not None and calls:
+                self._reserved[(scope, key)] = self._reserved.get((scope, key), 0) + calls
+        return reservation
+
+    def _unreserve(self, reservation, calls):
+        if calls <= 0:
+            return
+        reservation.calls -= calls
+        for scope, key in (('user', reservation.user_id), ('guild', reservation.guild_id)):
+            if key is None:
+                continue
+            left = self._reserved.get((scope, key), 0) - calls
+            if left > 0:
+                self._reserved[(scope, key)] = left
+            else:
+                self._reserved.pop((scope, key), None)
+
+    def release(self, reservation):
+        """退还预留中没有用完的次数（请求结束、失败、被取消或没能启动时调用）"""
+        self._unreserve(reservation, reservation.calls)
+
+    @staticmethod
+    def hold(reservation):
+        """
+        让当前任务之后创建的任务（例如交给 TaskManager 的后台任务）从这个预留中抵扣模型调用。
+        只设置上下文，不负责退还：请在任务结束时调用 release()（例如作为 TaskManager.submit 的 on_done）。
+        """
+        _reservation.set(reservation)
+
+    def _retry_after(self, counter, now):
+        """最早的一个桶滑出窗口还需要的秒数"""
+        if not counter.buckets:
+            return 0.0
+        return max(0.0, (counter.buckets[0][0] + 1) * self.bucket + self.window - now)
+
+    def prune(self, now=None):
+        """丢掉窗口内已经没有计数的用户和服务器"""
+        now = now or time.time()
+        for key in [key for key, counter in self._counters.items()
+                    if not self._window(key[0], key[1], now).buckets]:
+            del self._counters[key]
+
+    # --- 快照 ---
+    def save(self, force=False):
+        if not self.path or not (self._dirty or force):
+            return False
+        self.prune()
+        data = {
+            'window': self.window,
+            'bucket': self.bucket,
+            'counters': [[scope, key, list(counter.buckets)] for (scope, key), counter in self._counters.items()],
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        return True
+
+    def load(self):
+        """从快照恢复计数；分桶粒度变了的快照直接忽略"""
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 读取用量快照失败: {e}")
+            return 0
+        if data.get('bucket') != self.bucket:
+            return 0
+        oldest = self._oldest_bucket(time.time())
+        for scope, key, buckets in data.get('counters', []):
+            counter = SlidingWindow()
+            for bucket, calls, tokens in buckets:
+                if bucket >= oldest:
+                    counter.add(bucket, calls, tokens)
+            if counter.buckets:
+                self._counters[(scope, key)] = counter
+        return len(self._counters)
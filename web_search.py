@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+图片评论第 3 阶段的在线搜索：
+- 多个查询同时进行，每个查询有独立的超时，超时或失败的查询直接跳过
+- 同步的搜索库在专用的有界线程池中运行，不占用 asyncio 默认线程池（图片预处理、知识库重建等都在那里）
+- 结果按规范化后的查询缓存一段时间，相同或只差大小写/空白的查询不再联网
+- 搜索后端可替换：DDGSBackend 访问 DuckDuckGo，FakeSearchBackend 用于本地测试和压测
+
+    python web_search.py --fake    # 用假后端对比串行与并行的耗时
+"""
+import argparse
+import asyncio
+import os
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+SEARCH_WORKERS = int(os.getenv("SEARCH_WORKERS", "4")) # 搜索线程池大小
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", "8")) # 单个查询的超时（秒）
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", str(6 * 3600))) # 搜索结果缓存有效期（秒）
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "256")) # 最多缓存的查询数
+
+_SPACES = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    return _SPACES.sub(' ', str(query or '')).strip().lower()
+
+
+class DDGSBackend:
+    """DuckDuckGo 文本搜索；每次搜索新建 DDGS 实例，多个线程同时搜索时互不影响"""
+
+    name = 'duckduckgo'
+
+    def search(self, query, max_results):
+        from duckduckgo_search import DDGS
+
+        # 只保留需要的字段，防止返回的对象类型问题
+        return [
+            {'title': r.get('title'), 'body': r.get('body'), 'href': r.get('href')}
+            for r in DDGS().text(query, max_results=max_results) or []
+        ]
+
+
+class FakeSearchBackend:
+    """本地假后端：固定延迟后返回编造的结果，fail_queries 中的查询抛出异常"""
+
+    name = 'fake'
+
+    def __init__(self, delay=0.5, fail_queries=()):
+        self.delay = delay
+        self.fail_queries = {normalize_query(q) for q in fail_queries}
+        self.calls = 0
+
+    def search(self, query, max_results):
+        self.calls += 1
+        time.sleep(self.delay)
+        if normalize_query(query) in self.fail_queries:
+            raise RuntimeError(f"fake failure for {query!r}")
+        return [{'title': f"{query} #{i + 1}", 'body': f"result {i + 1} for {query}", 'href': f"https://example.com/{i + 1}"}
+                for i in range(max_results)]
+
+
+class WebSearch:
+    def __init__(self, backend=None, workers=SEARCH_WORKERS, timeout=SEARCH_TIMEOUT,
+                 ttl=SEARCH_CACHE_TTL, cache_size=SEARCH_CACHE_SIZE):
+        self.backend = backend or DDGSBackend()
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='web-search')
+        self._cache = OrderedDict()  # (规范化查询, max_results) -> (结果, 写入时间)
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+
+    def _cached(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        results, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return results
+
+    def _store(self, key, results):
+        self._cache[key] = (results, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def search(self, query, max_results=3):
+        """搜索一个查询；超时抛出 asyncio.TimeoutError，其余错误原样抛出"""
+        key = (normalize_query(query), max_results)
+        results = self._cached(key)
+        if results is not None:
+            self.hits += 1
+            return results
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, self.backend.search, query, max_results)
+        try:
+            # 超时后线程里的搜索仍会跑完，但线程池有上限，不会无限堆积
+            results = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        self._store(key, results)
+        return results
+
+    async def search_many(self, queries, max_results=3):
+        """同时搜索多个查询，返回 {查询: 结果}；失败或超时的查询不出现在结果中"""
+        # 只差大小写或空白的查询只搜一次
+        unique = {}
+        for query in queries:
+            unique.setdefault(normalize_query(query), query)
+        queries = list(unique.values())
+        outcomes = await asyncio.gather(*(self.search(q, max_results) for q in queries), return_exceptions=True)
+        found = {}
+        for query, outcome in zip(queries, outcomes):
+            if isinstance(outcome, asyncio.TimeoutError):
+                print(f"⚠️ {self.backend.name} 搜索超时 (query: {query})")
+            elif isinstance(outcome, Exception):
+                print(f"⚠️ {self.backend.name} 搜索失败 (query: {query}): {outcome}")
+            else:
+                found[query] = outcome
+        return found
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+async def _benchmark(queries, delay):
+    backend = FakeSearchBackend(delay=delay)
+    started = time.perf_counter()
+    for query in queries:
+        await asyncio.to_thread(backend.search, query, 3)
+    sequential = time.perf_counter() - started
+
+    search = WebSearch(backend)
+    started = time.perf_counter()
+    await search.search_many(queries)
+    parallel = time.perf_counter() - started
+    started = time.perf_counter()
+    await search.search_many(queries)
+    cached = time.perf_counter() - started
+    search.close()
+    print(f"串行: {sequential:.3f}s  并行: {parallel:.3f}s  缓存命中: {cached:.4f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="在线搜索阶段压测")
+    parser.add_argument('--fake', action='store_true', help="使用本地假后端（不联网）")
+    parser.add_argument('--delay', type=float, default=0.5, help="假后端每次搜索的延迟（秒）")
+    parser.add_argument('queries', nargs='*', default=['watercolor landscape artist', 'ukiyo-e style illustration'])
+    args = parser.parse_args()
+    if args.fake:
+        asyncio.run(_benchmark(args.queries, args.delay))
+    else:
+        results = asyncio.run(WebSearch().search_many(args.queries))
+        for query, items in results.items():
+            print(f"🔎 {query}")
+            for item in items:
+                print(f"   - {item['title']} ({item['href']})")